@@ -0,0 +1,142 @@
+"""Synthetic datasets of configurable size for the benchmarks.
+
+All fields are generated lazily (and deterministically) with dask, so that datasets
+with long time axes and high resolutions can be benchmarked without any downloads or
+large memory requirements.
+"""
+
+import dask.array as dsa
+import numpy as np
+import xarray as xr
+from ocean_emulators.channels import DEFAULT_PREDICTION_LAYOUT
+from ocean_emulators.preprocessing import INPUT_VARIABLES
+
+# (x, y) sizes of the standard grids
+RESOLUTIONS = {"2deg": (180, 90), "1deg": (360, 180), "0.5deg": (720, 360)}
+N_LEV = 19
+
+
+def _wetmask(nx: int, ny: int, n_lev: int, seed: int = 0) -> xr.DataArray:
+    """Columns of random depth"""
+    rng = np.random.default_rng(seed)
+    n_wet = rng.integers(0, n_lev + 1, size=[nx, ny])
+    return xr.DataArray(
+        np.arange(n_lev)[None, None, :] < n_wet[:, :, None], dims=["x", "y", "lev"]
+    )
+
+
+def synthetic_input_dataset(
+    n_time: int = 12,
+    resolution: str = "1deg",
+    n_lev: int = N_LEV,
+    time_chunk: int = 1,
+    seed: int = 0,
+) -> xr.Dataset:
+    """Standardized input dataset (passes `input_data_test` with `expected_sizes`)
+    with masked random fields"""
+    nx, ny = RESOLUTIONS[resolution]
+    state = dsa.random.RandomState(seed)
+    wetmask = _wetmask(nx, ny, n_lev, seed)
+    x = np.arange(nx) * 360 / nx
+    y = np.linspace(-90, 90, ny + 1)[:-1] + 90 / ny
+    dz = np.linspace(5, 1000, n_lev)
+    coords = {
+        "x": x,
+        "y": y,
+        "lev": np.cumsum(dz) - dz / 2,
+        "time": np.arange(n_time),
+        "dz": ("lev", dz),
+        "areacello": (["x", "y"], np.cos(np.deg2rad(y))[None, :].repeat(nx, axis=0)),
+        "wetmask": wetmask,
+        "lon": (["x", "y"], x[:, None].repeat(ny, axis=1)),
+        "lat": (["x", "y"], y[None, :].repeat(nx, axis=0)),
+    }
+    data_vars = {}
+    for var in INPUT_VARIABLES:
+        if var in ["thetao", "so", "uo", "vo"]:
+            dims = ["time", "lev", "y", "x"]
+            chunks = (time_chunk, -1, -1, -1)
+            mask = wetmask
+        else:
+            dims = ["time", "y", "x"]
+            chunks = (time_chunk, -1, -1)
+            mask = wetmask.isel(lev=0)
+        shape = [{"time": n_time, "lev": n_lev, "y": ny, "x": nx}[di] for di in dims]
+        data = state.random_sample(shape, chunks=chunks).astype(np.float32)
+        data_vars[var] = xr.DataArray(data, dims=dims).where(mask)
+    return xr.Dataset(
+        data_vars,
+        coords=coords,
+        attrs={"m2lines/ocean-emulators_git_hash": "benchmark"},
+    )
+
+
+def synthetic_raw_prediction(
+    n_time: int = 12, resolution: str = "1deg", time_chunk: int = 1, seed: int = 1
+) -> xr.Dataset:
+    """Raw emulator output with the default channel layout"""
+    nx, ny = RESOLUTIONS[resolution]
+    state = dsa.random.RandomState(seed)
+    data = state.random_sample(
+        [n_time, ny, nx, DEFAULT_PREDICTION_LAYOUT.n_channels],
+        chunks=(time_chunk, -1, -1, -1),
+    ).astype(np.float32)
+    return xr.DataArray(data, dims=["time", "y", "x", "var"]).to_dataset(
+        name="__xarray_dataarray_variable__"
+    )
+
+
+def synthetic_cmip_dataset(
+    n_time: int = 12,
+    resolution: str = "1deg",
+    n_lev: int = 35,
+    time_chunk: int = 1,
+    seed: int = 2,
+) -> xr.Dataset:
+    """CMIP-like dataset on a z* grid (input to `vertical_regrid`)"""
+    nx, ny = RESOLUTIONS[resolution]
+    state = dsa.random.RandomState(seed)
+    lev_bounds = np.concatenate([[0], np.cumsum(np.geomspace(2, 500, n_lev))])
+    wetmask = _wetmask(nx, ny, n_lev, seed)
+    thkcello = xr.DataArray(
+        np.broadcast_to(np.diff(lev_bounds), wetmask.shape).copy(),
+        dims=["x", "y", "lev"],
+    ).where(wetmask)
+    deptho = thkcello.sum("lev").where(wetmask.any("lev"))
+    zos = xr.DataArray(
+        state.random_sample([n_time, ny, nx], chunks=(time_chunk, -1, -1)) - 0.5,
+        dims=["time", "y", "x"],
+    ).where(wetmask.isel(lev=0))
+
+    def _field():
+        data = state.random_sample(
+            [n_time, n_lev, ny, nx], chunks=(time_chunk, -1, -1, -1)
+        )
+        return xr.DataArray(data, dims=["time", "lev", "y", "x"]).where(wetmask)
+
+    return xr.Dataset(
+        {"thetao": _field(), "so": _field(), "zos": zos},
+        coords={
+            "x": np.arange(nx),
+            "y": np.arange(ny),
+            "lev": (lev_bounds[1:] + lev_bounds[:-1]) / 2,
+            "time": np.arange(n_time),
+            "lev_bounds": (
+                ["lev", "bnds"],
+                np.stack([lev_bounds[:-1], lev_bounds[1:]], axis=1),
+            ),
+            "thkcello": thkcello,
+            "deptho": deptho,
+        },
+    )
+
+
+def synthetic_grid_bounds(resolution: str = "1deg") -> xr.Dataset:
+    """Global lon/lat cell bounds in the xesmf format (`lon_b`/`lat_b`)"""
+    nx, ny = RESOLUTIONS[resolution]
+    lon_b, lat_b = np.meshgrid(
+        np.linspace(0, 360, nx + 1), np.linspace(-90, 90, ny + 1)
+    )
+    return xr.Dataset(
+        coords={"lon_b": (["y_b", "x_b"], lon_b), "lat_b": (["y_b", "x_b"], lat_b)}
+    )
@@ -0,0 +1,17 @@
+from ocean_emulators.diagnostics import compute_diagnostics
+from .datasets import synthetic_input_dataset
+
+
+class QCDiagnostics:
+    params = ([12, 48], ["2deg", "1deg"])
+    param_names = ["n_time", "resolution"]
+    timeout = 600
+
+    def setup(self, n_time, resolution):
+        self.ds = synthetic_input_dataset(n_time, resolution)
+
+    def time_compute_diagnostics(self, *args):
+        compute_diagnostics(self.ds)
+
+    def peakmem_compute_diagnostics(self, *args):
+        compute_diagnostics(self.ds)
@@ -0,0 +1,13 @@
+# seconds allowed for `import ocean_emulators.postprocessing` in a fresh interpreter
+IMPORT_TIME_BUDGET = 2.0
+# dependencies that are only imported by the functions that need them
+LAZY_IMPORTS = ["xgcm", "xesmf", "cf_xarray", "matplotlib", "xarrayutils", "numba"]
+
+
+class Imports:
+    # inference and validation workers only need the postprocessing
+    def timeraw_import_postprocessing(self):
+        return "import ocean_emulators.postprocessing"
+
+    def timeraw_import_preprocessing(self):
+        return "import ocean_emulators.preprocessing"
@@ -0,0 +1,18 @@
+from ocean_emulators.postprocessing import post_processor
+from .datasets import synthetic_input_dataset, synthetic_raw_prediction
+
+
+class PostProcessor:
+    params = ([12, 48], ["2deg", "1deg"])
+    param_names = ["n_time", "resolution"]
+    timeout = 600
+
+    def setup(self, n_time, resolution):
+        self.ds_truth = synthetic_input_dataset(n_time, resolution)
+        self.ds_raw = synthetic_raw_prediction(n_time, resolution)
+
+    def time_post_processor(self, *args):
+        post_processor(self.ds_raw, self.ds_truth).sum().compute()
+
+    def peakmem_post_processor(self, *args):
+        post_processor(self.ds_raw, self.ds_truth).sum().compute()
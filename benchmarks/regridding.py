@@ -0,0 +1,81 @@
+import numpy as np
+import scipy.sparse
+from ocean_emulators.preprocessing import (
+    HorizontalRemapOperator,
+    _sparse_regrid,
+    infer_vertical_cell_extent,
+    regrid_3d,
+    vertical_regrid,
+)
+from .datasets import RESOLUTIONS, synthetic_cmip_dataset
+
+TARGET_DEPTH_BOUNDS = np.array(
+    [0, 5, 15, 30, 50, 80, 130, 200, 300, 450, 650, 900, 1200, 1600, 2100, 2700]
+    + [3500, 4500, 5500, 6500.0]
+)
+
+
+class VerticalRegrid:
+    params = ([12, 48], ["2deg", "1deg"], ["batched", "zstar", "xgcm"])
+    param_names = ["n_time", "resolution", "engine"]
+    timeout = 600
+
+    def setup(self, n_time, resolution, engine):
+        self.ds = infer_vertical_cell_extent(synthetic_cmip_dataset(n_time, resolution))
+
+    def time_vertical_regrid(self, n_time, resolution, engine):
+        vertical_regrid(self.ds, TARGET_DEPTH_BOUNDS, engine=engine).sum().compute()
+
+    def peakmem_vertical_regrid(self, n_time, resolution, engine):
+        vertical_regrid(self.ds, TARGET_DEPTH_BOUNDS, engine=engine).sum().compute()
+
+
+def coarsening_operator(resolution: str) -> HorizontalRemapOperator:
+    """Sparse operator averaging 2x2 blocks of cells (a stand-in for xesmf weights)"""
+    nx, ny = RESOLUTIONS[resolution]
+
+    def _pairs(n):
+        return scipy.sparse.kron(scipy.sparse.eye(n // 2), np.full((1, 2), 0.5))
+
+    weights = scipy.sparse.kron(_pairs(ny), _pairs(nx))
+    return HorizontalRemapOperator(
+        weights, ("y", "x"), (ny, nx), ("y", "x"), (ny // 2, nx // 2)
+    )
+
+
+class HorizontalRegrid:
+    params = (["2deg", "1deg"], [1, 4])
+    param_names = ["resolution", "n_threads"]
+
+    def setup(self, resolution, n_threads):
+        self.ds = synthetic_cmip_dataset(12, resolution)[["thetao", "so"]].compute()
+        self.operator = coarsening_operator(resolution)
+
+    def time_sparse(self, resolution, n_threads):
+        self.operator(self.ds.thetao.values, n_threads=n_threads)
+
+    def time_sparse_skipna(self, resolution, n_threads):
+        self.operator(self.ds.thetao.values, skipna=True, n_threads=n_threads)
+
+
+class Regrid3D:
+    params = (["2deg", "1deg"], ["separate", "combined"])
+    param_names = ["resolution", "mode"]
+    timeout = 600
+
+    def setup(self, resolution, mode):
+        self.ds = infer_vertical_cell_extent(synthetic_cmip_dataset(12, resolution))
+        self.operator = coarsening_operator(resolution)
+
+    def _regrid(self, mode):
+        if mode == "separate":
+            # the intermediate dataset of two separate passes
+            ds = vertical_regrid(self.ds, TARGET_DEPTH_BOUNDS)
+            return _sparse_regrid(ds, self.operator)
+        return regrid_3d(self.ds, None, TARGET_DEPTH_BOUNDS, horizontal=self.operator)
+
+    def time_regrid(self, resolution, mode):
+        self._regrid(mode).sum().compute()
+
+    def peakmem_regrid(self, resolution, mode):
+        self._regrid(mode).sum().compute()
@@ -0,0 +1,83 @@
+from ocean_emulators.preprocessing import (
+    bounds_error_mask,
+    input_data_test,
+    split_2d_3d,
+    test_nan_consistency,
+    test_nan_consistency_streaming,
+)
+from ocean_emulators.utils import WetMask, apply_mask, assert_mask_match
+from .datasets import RESOLUTIONS, synthetic_grid_bounds, synthetic_input_dataset
+
+
+class NanConsistency:
+    params = ([12, 48], ["2deg", "1deg"], [1, 12])
+    param_names = ["n_time", "resolution", "time_chunk"]
+    timeout = 600
+
+    def setup(self, n_time, resolution, time_chunk):
+        _, self.ds = split_2d_3d(
+            synthetic_input_dataset(n_time, resolution, time_chunk=time_chunk)
+        )
+
+    def time_full(self, *args):
+        test_nan_consistency(self.ds)
+
+    def peakmem_full(self, *args):
+        test_nan_consistency(self.ds)
+
+    def time_streaming(self, *args):
+        test_nan_consistency_streaming(self.ds)
+
+    def peakmem_streaming(self, *args):
+        test_nan_consistency_streaming(self.ds)
+
+
+class FormatChecks:
+    params = list(RESOLUTIONS)
+    param_names = ["resolution"]
+
+    def setup(self, resolution):
+        self.ds = synthetic_input_dataset(12, resolution)
+        self.expected_sizes = {di: self.ds.sizes[di] for di in ["x", "y", "lev"]}
+
+    def time_input_data_test(self, resolution):
+        input_data_test(self.ds, expected_sizes=self.expected_sizes)
+
+
+class BoundsValidation:
+    params = list(RESOLUTIONS)
+    param_names = ["resolution"]
+
+    def setup(self, resolution):
+        self.ds = synthetic_grid_bounds(resolution)
+
+    def time_bounds_error_mask(self, resolution):
+        bounds_error_mask(self.ds)
+
+    def peakmem_bounds_error_mask(self, resolution):
+        bounds_error_mask(self.ds)
+
+
+class Mask:
+    params = ([12, 48], ["2deg", "1deg"], ["DataArray", "WetMask"])
+    param_names = ["n_time", "resolution", "mask"]
+    timeout = 600
+
+    def setup(self, n_time, resolution, mask):
+        self.ds = synthetic_input_dataset(n_time, resolution)[["thetao", "so", "zos"]]
+        self.mask = self.ds.wetmask
+        if mask == "WetMask":
+            self.mask = WetMask(self.mask)
+        self.ds = self.ds.reset_coords(drop=True)
+
+    def time_apply_mask(self, *args):
+        apply_mask(self.ds, self.mask).sum().compute()
+
+    def peakmem_apply_mask(self, *args):
+        apply_mask(self.ds, self.mask).sum().compute()
+
+    def time_assert_mask_match(self, *args):
+        assert_mask_match(self.ds, self.mask)
+
+    def peakmem_assert_mask_match(self, *args):
+        assert_mask_match(self.ds, self.mask)
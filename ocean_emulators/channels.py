@@ -0,0 +1,177 @@
+"""Mapping between the flat channel axis of emulator tensors and (variable, level) pairs"""
+
+import json
+from typing import Optional
+import numpy as np
+import xarray as xr
+from ocean_emulators.utils import WetMask, apply_mask
+
+CHANNEL_LAYOUT_ATTR = "ocean_emulators/channel_layout"
+
+
+def _concatenate(arrays: list, axis: int):
+    if any(hasattr(a, "dask") for a in arrays):
+        import dask.array as dsa
+
+        return dsa.concatenate(arrays, axis=axis)
+    return np.concatenate(arrays, axis=axis)
+
+
+def _stack(arrays: list, axis: int):
+    if any(hasattr(a, "dask") for a in arrays):
+        import dask.array as dsa
+
+        return dsa.stack(arrays, axis=axis)
+    return np.stack(arrays, axis=axis)
+
+
+def _gather(data, index: np.ndarray):
+    """Select `index` along the last axis. Contiguous indices are sliced (a view for numpy arrays)."""
+    start = int(index[0])
+    if np.array_equal(index, np.arange(start, start + len(index))):
+        return data[..., start : start + len(index)]
+    return data[..., index]
+
+
+class ChannelLayout:
+    """Describes which (variable, level) is stored in every channel of a flat channel axis.
+
+    `variables` is a list of `(name, n_lev)` in channel order, where `n_lev` is None for
+    2D variables. 3D variables occupy `n_lev` consecutive channels.
+    """
+
+    def __init__(self, variables: list):
+        self.variables = [
+            (name, None if n is None else int(n)) for name, n in variables
+        ]
+        offsets = np.cumsum([0] + [1 if n is None else n for _, n in self.variables])
+        self.n_channels = int(offsets[-1])
+        self._index = {
+            name: np.arange(start, stop)
+            for (name, _), start, stop in zip(self.variables, offsets[:-1], offsets[1:])
+        }
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, ChannelLayout) and self.variables == other.variables
+
+    def __repr__(self) -> str:
+        return f"ChannelLayout({self.variables})"
+
+    @property
+    def groups(self) -> dict:
+        """Variable names grouped by their number of levels (None for 2D variables)"""
+        groups = {}
+        for name, n_lev in self.variables:
+            groups.setdefault(n_lev, []).append(name)
+        return groups
+
+    def channels(self) -> list:
+        """(variable, level index) for every channel (level index is None for 2D variables)"""
+        channels = []
+        for name, n_lev in self.variables:
+            if n_lev is None:
+                channels.append((name, None))
+            else:
+                channels.extend((name, i) for i in range(n_lev))
+        return channels
+
+    def channel_index(self, name: str) -> np.ndarray:
+        """Channel indices of variable `name`"""
+        return self._index[name]
+
+    def to_attrs(self) -> dict:
+        return {CHANNEL_LAYOUT_ATTR: json.dumps(self.variables)}
+
+    @classmethod
+    def from_attrs(cls, attrs: dict) -> Optional["ChannelLayout"]:
+        if CHANNEL_LAYOUT_ATTR not in attrs:
+            return None
+        return cls(json.loads(attrs[CHANNEL_LAYOUT_ATTR]))
+
+    @classmethod
+    def from_dataset(cls, ds: xr.Dataset, variables: list, lev_dim: str = "lev"):
+        """Layout for `variables` of `ds`, using the size of `lev_dim` for 3D variables"""
+        return cls(
+            [
+                (var, ds.sizes[lev_dim] if lev_dim in ds[var].dims else None)
+                for var in variables
+            ]
+        )
+
+    def gather(self, da: xr.DataArray, channel_dim: str = "var", lev_dim="lev"):
+        """Gather the channels of `da` into one array per group of variables with the same
+        number of levels. Returns a dict of arrays with dimensions `(..., "variable", lev_dim)`
+        (or `(..., "variable")` for 2D variables)."""
+        if da.sizes[channel_dim] != self.n_channels:
+            raise ValueError(
+                f"Expected {self.n_channels} channels along `{channel_dim}`, got {da.sizes[channel_dim]}"
+            )
+        da = da.transpose(..., channel_dim)
+        other_dims = [di for di in da.dims if di != channel_dim]
+        gathered = {}
+        for n_lev, names in self.groups.items():
+            index = np.concatenate([self.channel_index(name) for name in names])
+            data = _gather(da.data, index)
+            dims = other_dims + ["variable"]
+            if n_lev is not None:
+                data = data.reshape(data.shape[:-1] + (len(names), n_lev))
+                dims = dims + [lev_dim]
+            gathered[n_lev] = xr.DataArray(data, dims=dims, coords={"variable": names})
+        return gathered
+
+    def unpack(
+        self,
+        da: xr.DataArray,
+        mask: Optional[WetMask] = None,
+        channel_dim: str = "var",
+        lev_dim: str = "lev",
+    ) -> xr.Dataset:
+        """Split the channel axis of `da` into separate variables. If given, `mask` is
+        applied once per group of variables (before splitting)."""
+        gathered = self.gather(da, channel_dim=channel_dim, lev_dim=lev_dim)
+        if mask is not None:
+            ds_gathered = apply_mask(
+                xr.Dataset({str(k): v for k, v in gathered.items()}), mask
+            )
+            gathered = {k: ds_gathered[str(k)] for k in gathered}
+        ds_out = xr.Dataset()
+        for name, n_lev in self.variables:
+            ds_out[name] = gathered[n_lev].sel(variable=name).drop_vars("variable")
+        return ds_out
+
+    def pack(
+        self, ds: xr.Dataset, channel_dim: str = "var", lev_dim: str = "lev"
+    ) -> xr.DataArray:
+        """Stack the variables of `ds` into a single array with a flat channel axis
+        (the inverse of `unpack`). The layout is stored in the attributes."""
+        names = [name for name, _ in self.variables]
+        other_dims = [di for di in ds[names[0]].dims if di != lev_dim]
+        blocks = []
+        block_index = []
+        for n_lev, group in self.groups.items():
+            core = [] if n_lev is None else [lev_dim]
+            data = _stack(
+                [ds[name].transpose(*other_dims, *core).data for name in group],
+                axis=len(other_dims),
+            )
+            blocks.append(data.reshape(data.shape[: len(other_dims)] + (-1,)))
+            block_index.append(
+                np.concatenate([self.channel_index(name) for name in group])
+            )
+        data = _concatenate(blocks, axis=-1)
+        # reorder the grouped channels into the layout order
+        data = _gather(data, np.argsort(np.concatenate(block_index)))
+        return xr.DataArray(
+            data,
+            dims=other_dims + [channel_dim],
+            coords={
+                co: ds[co] for co in ds.coords if set(ds[co].dims).issubset(other_dims)
+            },
+            attrs=self.to_attrs(),
+        )
+
+
+# Layout of the current emulator predictions
+DEFAULT_PREDICTION_LAYOUT = ChannelLayout(
+    [("uo", 19), ("vo", 19), ("thetao", 19), ("so", 19), ("zos", None)]
+)
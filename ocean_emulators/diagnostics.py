@@ -0,0 +1,123 @@
+"""Area/volume weighted diagnostics of standardized datasets, computed in a single pass"""
+
+import hashlib
+import json
+import os
+from typing import Optional
+import numpy as np
+import xarray as xr
+from ocean_emulators.preprocessing import GIT_HASH_ATTR
+
+
+def _normalize(weights: xr.DataArray, dims: list) -> xr.DataArray:
+    total = weights.sum(dims)
+    return weights / total.where(total != 0)
+
+
+def diagnostic_weights(ds: xr.Dataset) -> dict:
+    """Normalized weights built from `areacello`, `dz` and `wetmask`.
+
+    Returns a dict of weights for 3D ("3d") and 2D ("2d", the surface of the wetmask)
+    variables, each holding `horizontal` (sums to one over x/y on every level), `zonal`
+    (sums to one over x) and for 3D variables `volume` (sums to one over x/y/lev)
+    weights. Dry cells have zero weight.
+    """
+    wetmask = ds.wetmask.reset_coords(drop=True).astype(bool)
+    area = ds.areacello.reset_coords(drop=True).where(wetmask, 0.0)
+    volume = area * ds.dz.reset_coords(drop=True)
+    weights = {}
+    for key, area_masked in [("3d", area), ("2d", area.isel(lev=0, drop=True))]:
+        weights[key] = {
+            "horizontal": _normalize(area_masked, ["x", "y"]),
+            "zonal": _normalize(area_masked, ["x"]),
+        }
+    weights["3d"]["volume"] = _normalize(volume, ["x", "y", "lev"])
+    return weights
+
+
+def weighted_sum(da: xr.DataArray, weights: xr.DataArray, dims: list) -> xr.DataArray:
+    """Sum of `da` (with nans counted as zero) times `weights` over `dims`"""
+    # rows without any wet cell (all weights zero or nan) become nan
+    return (da.fillna(0.0) * weights).sum(dims).where(weights.sum(dims) > 0)
+
+
+def _sample_checksum(ds: xr.Dataset, variables: list) -> str:
+    """sha256 over the values of the first and last time step of all `variables`"""
+    sample = ds[sorted(variables)].isel(time=[0, -1]).compute()
+    checksum = hashlib.sha256()
+    for var in sorted(variables):
+        checksum.update(var.encode())
+        checksum.update(np.ascontiguousarray(sample[var].values).tobytes())
+    return checksum.hexdigest()
+
+
+def _diagnostics_cache_path(ds: xr.Dataset, variables: list, cache_dir: str) -> str:
+    # key on the version of the dataset, the variables, the shape and a checksum of a
+    # data sample (datasets without a real git hash, e.g. different members or
+    # rollouts, can otherwise share all of these)
+    key = json.dumps(
+        [
+            ds.attrs.get(GIT_HASH_ATTR),
+            sorted(variables),
+            sorted(ds.sizes.items()),
+            [str(t) for t in ds.time.values[[0, -1]]],
+            _sample_checksum(ds, variables),
+        ]
+    )
+    return os.path.join(
+        cache_dir, f"diagnostics_{hashlib.sha256(key.encode()).hexdigest()[:16]}.nc"
+    )
+
+
+def compute_diagnostics(
+    ds: xr.Dataset, variables: Optional[list] = None, cache_dir: Optional[str] = None
+) -> xr.Dataset:
+    """Compute diagnostics for all (time dependent) `variables` of `ds` in a single
+    (dask) compute:
+
+    - `{var}_snapshot`: surface field at the first time step
+    - `{var}_global_mean`: area weighted global mean (per level for 3D variables)
+    - `{var}_volume_mean`: volume weighted global mean (3D variables only)
+    - `{var}_zonal_mean_std`: standard deviation in time of the area weighted zonal mean
+
+    If `cache_dir` is given, the results are stored in (and reloaded from) a small
+    netcdf file keyed by the git hash attribute, variables, shape and a checksum of the
+    first and last time step of `ds` (only these are read for a cached result).
+    """
+    if variables is None:
+        variables = [v for v in ds.data_vars if "time" in ds[v].dims]
+    if cache_dir is not None:
+        cache_path = _diagnostics_cache_path(ds, variables, cache_dir)
+        if os.path.exists(cache_path):
+            return xr.load_dataset(cache_path)
+
+    weights = diagnostic_weights(ds)
+    diagnostics = {}
+    for var in variables:
+        da = ds[var].reset_coords(drop=True)
+        w = weights["3d" if "lev" in da.dims else "2d"]
+        diagnostics[f"{var}_snapshot"] = da.isel(time=0, lev=0, missing_dims="ignore")
+        diagnostics[f"{var}_global_mean"] = weighted_sum(
+            da, w["horizontal"], ["x", "y"]
+        ).transpose("time", ...)
+        if "lev" in da.dims:
+            diagnostics[f"{var}_volume_mean"] = weighted_sum(
+                da, w["volume"], ["x", "y", "lev"]
+            )
+        diagnostics[f"{var}_zonal_mean_std"] = weighted_sum(da, w["zonal"], ["x"]).std(
+            "time"
+        )
+    ds_diagnostics = xr.Dataset(diagnostics).compute()
+    ds_diagnostics = ds_diagnostics.assign_coords(
+        {co: ds[co] for co in ["time", "lev", "x", "y"] if co in ds_diagnostics.dims}
+    )
+    if GIT_HASH_ATTR in ds.attrs:
+        # netcdf3 does not allow "/" in attribute names
+        ds_diagnostics.attrs["source_git_hash"] = ds.attrs[GIT_HASH_ATTR]
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.tmp"
+        ds_diagnostics.to_netcdf(tmp_path)
+        os.replace(tmp_path, cache_path)
+    return ds_diagnostics
@@ -0,0 +1,96 @@
+"""Local on-disk registry of static grid fields (areas, dz, lev, lon/lat, wetmask)"""
+
+import json
+import os
+import shutil
+import uuid
+from typing import Callable, Optional
+import numpy as np
+import xarray as xr
+
+GRID_METADATA = "grid.json"
+# grids loaded in this process
+_LOADED_GRIDS = {}
+
+
+def grid_cache_dir(cache_dir: Optional[str] = None) -> str:
+    """Directory of the registry (`$OCEAN_EMULATORS_GRID_CACHE`, defaults to
+    `~/.cache/ocean_emulators/grids`)"""
+    if cache_dir is None:
+        cache_dir = os.environ.get(
+            "OCEAN_EMULATORS_GRID_CACHE",
+            os.path.join(os.path.expanduser("~"), ".cache", "ocean_emulators", "grids"),
+        )
+    return str(cache_dir)
+
+
+def _grid_path(grid_id: str, cache_dir: Optional[str]) -> str:
+    return os.path.join(grid_cache_dir(cache_dir), grid_id)
+
+
+def has_grid(grid_id: str, cache_dir: Optional[str] = None) -> bool:
+    return os.path.exists(os.path.join(_grid_path(grid_id, cache_dir), GRID_METADATA))
+
+
+def register_grid(
+    grid_id: str, ds_grid: xr.Dataset, cache_dir: Optional[str] = None
+) -> str:
+    """Store all variables (data variables and coordinates) of `ds_grid` as `.npy`
+    files under `grid_id` in the registry. Returns the path of the grid."""
+    path = _grid_path(grid_id, cache_dir)
+    # unique per call, so that concurrent workers never remove each other's files
+    tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(tmp_path)
+    fields = {}
+    for name, var in ds_grid.variables.items():
+        np.save(os.path.join(tmp_path, f"{name}.npy"), np.asarray(var.values))
+        fields[name] = {"dims": list(var.dims), "attrs": dict(var.attrs)}
+    metadata = {"grid_id": grid_id, "fields": fields, "attrs": dict(ds_grid.attrs)}
+    with open(os.path.join(tmp_path, GRID_METADATA), "w") as f:
+        json.dump(metadata, f, default=str)
+    # replace a complete grid at once
+    try:
+        if os.path.exists(path):
+            old_path = f"{tmp_path}.old"
+            os.replace(path, old_path)
+            shutil.rmtree(old_path)
+        os.replace(tmp_path, path)
+    except OSError:
+        # another process registered the grid at the same time
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not has_grid(grid_id, cache_dir):
+            raise
+    _LOADED_GRIDS.pop((grid_id, grid_cache_dir(cache_dir)), None)
+    return path
+
+
+def load_grid(grid_id: str, cache_dir: Optional[str] = None) -> xr.Dataset:
+    """Load a registered grid as a dataset of coordinates. The fields are
+    memory-mapped, so only the parts that are used are read from disk."""
+    key = (grid_id, grid_cache_dir(cache_dir))
+    if key not in _LOADED_GRIDS:
+        path = _grid_path(grid_id, cache_dir)
+        if not has_grid(grid_id, cache_dir):
+            raise ValueError(f"Grid {grid_id} is not registered in {key[1]}")
+        with open(os.path.join(path, GRID_METADATA)) as f:
+            metadata = json.load(f)
+        coords = {
+            name: xr.Variable(
+                field["dims"],
+                np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r"),
+                attrs=field["attrs"],
+            )
+            for name, field in metadata["fields"].items()
+        }
+        _LOADED_GRIDS[key] = xr.Dataset(coords=coords, attrs=metadata["attrs"])
+    return _LOADED_GRIDS[key]
+
+
+def get_grid(
+    grid_id: str, source: Callable[[], xr.Dataset], cache_dir: Optional[str] = None
+) -> xr.Dataset:
+    """Load `grid_id` from the registry, creating it with `source()` (e.g. a remote
+    download) only if it is not registered yet."""
+    if not has_grid(grid_id, cache_dir):
+        register_grid(grid_id, source(), cache_dir=cache_dir)
+    return load_grid(grid_id, cache_dir)
@@ -0,0 +1,128 @@
+"""Optional timing and memory instrumentation of pipeline stages.
+
+Instrumentation is off by default (decorated functions only check a flag). Within
+`instrument_run`, every call of an `instrumented` function or `stage` block records
+its wall time, peak (python traced) memory, bytes read by the process and the number
+of executed dask tasks, and a json report is written at the end of the run.
+"""
+
+import contextlib
+import functools
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from typing import Optional
+
+_state = {"enabled": False, "records": [], "dask_tasks": 0, "start": 0.0}
+_local = threading.local()
+_lock = threading.Lock()
+
+
+def _bytes_read() -> Optional[int]:
+    """Bytes read by this process (including the page cache, Linux only)"""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def _stack() -> list:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Record a single stage (no-op if instrumentation is not enabled)"""
+    if not _state["enabled"]:
+        yield
+        return
+    stack = _stack()
+    # keep the peak of the enclosing stage before resetting it for this one
+    current, peak = tracemalloc.get_traced_memory()
+    if len(stack) > 0:
+        stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+    tracemalloc.reset_peak()
+    record = {
+        "name": name,
+        "parent": stack[-1]["name"] if len(stack) > 0 else None,
+        "depth": len(stack),
+    }
+    frame = {"name": name, "peak": 0, "memory": current}
+    stack.append(frame)
+    bytes_read = _bytes_read()
+    dask_tasks = _state["dask_tasks"]
+    start = time.perf_counter()
+    record["start"] = start - _state["start"]
+    try:
+        yield
+    finally:
+        record["wall_time"] = time.perf_counter() - start
+        frame["peak"] = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+        stack.pop()
+        if len(stack) > 0:
+            stack[-1]["peak"] = max(stack[-1]["peak"], frame["peak"])
+        tracemalloc.reset_peak()
+        record["peak_memory"] = frame["peak"] - frame["memory"]
+        if bytes_read is not None:
+            record["bytes_read"] = _bytes_read() - bytes_read
+        record["dask_tasks"] = _state["dask_tasks"] - dask_tasks
+        with _lock:
+            _state["records"].append(record)
+
+
+def instrumented(func):
+    """Decorator recording every call of `func` as a stage named after the function"""
+    name = f"{func.__module__}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _state["enabled"]:
+            return func(*args, **kwargs)
+        with stage(name):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def _count_task(*args):
+    with _lock:
+        _state["dask_tasks"] += 1
+
+
+@contextlib.contextmanager
+def instrument_run(path: Optional[str] = None):
+    """Enable instrumentation and yield the report of the run, which is written to
+    `path` as json on exit. Executed dask tasks are counted for the local schedulers."""
+    from dask.callbacks import Callback
+
+    report = {"stages": []}
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    start = time.perf_counter()
+    _state.update(enabled=True, records=[], dask_tasks=0, start=start)
+    try:
+        with Callback(posttask=_count_task):
+            yield report
+    finally:
+        _state["enabled"] = False
+        if started_tracing:
+            tracemalloc.stop()
+        report["stages"] = sorted(_state["records"], key=lambda r: r["start"])
+        report["wall_time"] = time.perf_counter() - start
+        report["dask_tasks"] = _state["dask_tasks"]
+        # peak resident memory of the process (kB on Linux)
+        report["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        report["pid"] = os.getpid()
+        if path is not None:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=1)
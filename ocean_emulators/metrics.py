@@ -0,0 +1,134 @@
+"""Skill metrics of (postprocessed) emulator rollouts against the truth"""
+
+from typing import Optional
+import numpy as np
+import xarray as xr
+from ocean_emulators.diagnostics import diagnostic_weights, weighted_sum
+
+SUM_TERMS = ["err", "err2", "pa2", "ta2", "pata"]
+
+
+def _zonal_power(block: np.ndarray) -> np.ndarray:
+    """Power spectrum along the last axis (x) averaged over the second to last axis (y)"""
+    power = np.abs(np.fft.rfft(np.nan_to_num(block), axis=-1)) ** 2
+    return power.mean(axis=-2)
+
+
+def _power_spectrum(da: xr.DataArray) -> xr.DataArray:
+    return xr.apply_ufunc(
+        _zonal_power,
+        da,
+        input_core_dims=[["y", "x"]],
+        output_core_dims=[["wavenumber"]],
+        dask="parallelized",
+        output_dtypes=[np.float64],
+        dask_gufunc_kwargs={
+            "allow_rechunk": True,
+            "output_sizes": {"wavenumber": da.sizes["x"] // 2 + 1},
+        },
+    )
+
+
+def skill_sums(
+    ds_prediction: xr.Dataset,
+    ds_truth: xr.Dataset,
+    climatology: xr.Dataset,
+    variables: Optional[list] = None,
+) -> xr.Dataset:
+    """Area weighted sums of the error terms for every variable, level and time step.
+
+    These are the running sums the metrics are computed from (see
+    `skill_metrics_from_sums`). They are reduced over x/y only, so the dataset stays
+    small for long rollouts, and sums of different time chunks (or workers) can be
+    combined with `merge_skill_sums`. Anomalies for the anomaly correlation are
+    relative to the per-cell `climatology` (e.g. `ds_truth.mean("time")` over a
+    reference period), which has to be the same for all chunks of a rollout.
+    """
+    if variables is None:
+        variables = [v for v in ds_prediction.data_vars if v in ds_truth.data_vars]
+    weights = diagnostic_weights(ds_truth)
+    sums = {}
+    for var in variables:
+        prediction = ds_prediction[var].reset_coords(drop=True)
+        truth = ds_truth[var].reset_coords(drop=True)
+        clim = climatology[var].reset_coords(drop=True)
+        w = weights["3d" if "lev" in truth.dims else "2d"]["horizontal"]
+        error = prediction - truth
+        anomaly_prediction = prediction - clim
+        anomaly_truth = truth - clim
+        terms = {
+            "err": error,
+            "err2": error**2,
+            "pa2": anomaly_prediction**2,
+            "ta2": anomaly_truth**2,
+            "pata": anomaly_prediction * anomaly_truth,
+        }
+        for term, da in terms.items():
+            sums[f"{var}_{term}"] = weighted_sum(da, w, ["x", "y"])
+        sums[f"{var}_power_prediction"] = _power_spectrum(prediction)
+        sums[f"{var}_power_truth"] = _power_spectrum(truth)
+    sums = {name: da.transpose("time", ...) for name, da in sums.items()}
+    # weight of every level in volume weighted averages
+    level_weight = weights["3d"]["volume"].sum(["x", "y"])
+    return xr.Dataset(sums).assign_coords(level_weight=level_weight)
+
+
+def merge_skill_sums(sums: list) -> xr.Dataset:
+    """Combine the sums of consecutive chunks of a rollout (e.g. from separate workers)"""
+    return xr.concat(sums, dim="time", data_vars="minimal", coords="minimal")
+
+
+def _metrics(sums: xr.Dataset, var: str) -> dict:
+    rmse = np.sqrt(sums[f"{var}_err2"])
+    acc = sums[f"{var}_pata"] / np.sqrt(sums[f"{var}_pa2"] * sums[f"{var}_ta2"])
+    return {"rmse": rmse, "bias": sums[f"{var}_err"], "acc": acc}
+
+
+def skill_metrics_from_sums(sums: xr.Dataset) -> xr.Dataset:
+    """Compute metrics from `skill_sums`. For every variable this returns:
+
+    - `{var}_rmse`, `{var}_bias`, `{var}_acc`: area weighted metrics per time step
+      (and level)
+    - `{var}_rmse_total`, `{var}_bias_total`, `{var}_acc_total`: metrics over all time
+      steps (per level)
+    - `{var}_rmse_volume`, `{var}_bias_volume`, `{var}_acc_volume`: volume weighted
+      metrics per time step (3D variables only)
+    - `{var}_spectrum_prediction`, `{var}_spectrum_truth`: zonal power spectra
+      averaged over y and time
+    """
+    variables = [v[: -len("_err")] for v in sums.data_vars if v.endswith("_err")]
+    level_weight = sums.level_weight
+    metrics = {}
+    for var in variables:
+        terms = [f"{var}_{term}" for term in SUM_TERMS]
+        totals = sums[terms].mean("time")
+        averages = {"": sums, "_total": totals}
+        if "lev" in sums[f"{var}_err"].dims:
+            averages["_volume"] = (sums[terms] * level_weight).sum("lev")
+        for suffix, averaged in averages.items():
+            for metric, da in _metrics(averaged, var).items():
+                metrics[f"{var}_{metric}{suffix}"] = da
+        for source in ["prediction", "truth"]:
+            metrics[f"{var}_spectrum_{source}"] = sums[f"{var}_power_{source}"].mean(
+                "time"
+            )
+    return xr.Dataset(metrics).drop_vars("level_weight", errors="ignore")
+
+
+def skill_metrics(
+    ds_prediction: xr.Dataset,
+    ds_truth: xr.Dataset,
+    climatology: xr.Dataset,
+    variables: Optional[list] = None,
+) -> xr.Dataset:
+    """Score a postprocessed prediction (see `postprocessing.post_processor`) against
+    `ds_truth` (see `skill_metrics_from_sums` for the returned metrics), with anomalies
+    relative to `climatology` (see `skill_sums`).
+
+    All variables are reduced in a single (dask) compute, which streams over the time
+    chunks of the inputs in parallel, with memory bounded by a few chunks.
+    """
+    sums = skill_sums(
+        ds_prediction, ds_truth, climatology, variables=variables
+    ).compute()
+    return skill_metrics_from_sums(sums)
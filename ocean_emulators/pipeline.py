@@ -0,0 +1,351 @@
+"""Run the preprocessing chain for many source datasets (e.g. CMIP members) in parallel"""
+
+from concurrent.futures import Executor, ProcessPoolExecutor, as_completed
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import traceback
+from typing import Callable, Optional, Union
+import numpy as np
+import xarray as xr
+from ocean_emulators.grids import load_grid
+from ocean_emulators.plotting import qc_report
+from ocean_emulators.preprocessing import (
+    HorizontalRemapOperator,
+    infer_vertical_cell_extent,
+    input_data_test,
+    regrid_3d,
+    standardize_input,
+)
+
+
+def preprocess_cmip_member(
+    ds: xr.Dataset,
+    ds_target: Union[xr.Dataset, str],
+    target_depth_bounds: np.ndarray,
+    weights_dir: Optional[str] = None,
+    check: bool = False,
+    horizontal: Optional[HorizontalRemapOperator] = None,
+) -> xr.Dataset:
+    """Full preprocessing chain of a single CMIP member: vertical and horizontal
+    regridding in a single blockwise pass (see `regrid_3d`) and standardization with
+    the static fields of the target grid (see `standardize_input`).
+    `ds_target` can also be the id of a grid in the local grid registry. If a
+    precomputed `horizontal` operator is given, `ds_target` only provides the grid fields."""
+    if isinstance(ds_target, str):
+        ds_target = load_grid(ds_target)
+    ds = infer_vertical_cell_extent(ds)
+    ds_regridded = regrid_3d(
+        ds,
+        ds_target,
+        target_depth_bounds,
+        check=check,
+        weights_dir=weights_dir,
+        horizontal=horizontal,
+    )
+    return standardize_input(ds_regridded, ds_target)
+
+
+def load_manifest(manifest: Union[str, list]) -> list:
+    """Load a manifest (a json file or list) of source datasets.
+    Every entry needs a unique `name` and the `path` of the source dataset, and can
+    specify `open_kwargs` for `xr.open_dataset` and `process_kwargs` that override the
+    defaults of the driver for this member."""
+    if isinstance(manifest, (str, os.PathLike)):
+        with open(manifest) as f:
+            manifest = json.load(f)
+    names = [entry["name"] for entry in manifest]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Member names in the manifest are not unique: {names}")
+    return manifest
+
+
+def progress_manifest_path(store: str) -> str:
+    """Path of the progress manifest written next to an incremental zarr `store`"""
+    return f"{str(store).rstrip('/')}.progress.json"
+
+
+def _write_json(obj, path: str):
+    # write to a temporary file, so that an interrupted run never leaves a broken file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def block_checksum(ds: xr.Dataset) -> str:
+    """sha256 over the values of all data variables of `ds`"""
+    checksum = hashlib.sha256()
+    for var in sorted(ds.data_vars):
+        checksum.update(var.encode())
+        checksum.update(np.ascontiguousarray(ds[var].values).tobytes())
+    return checksum.hexdigest()
+
+
+def write_zarr_incremental(
+    ds: xr.Dataset,
+    store: str,
+    time_block: int = 1,
+    validate: bool = True,
+    deep: bool = True,
+    expected_sizes: Optional[dict] = None,
+    verify: bool = False,
+) -> dict:
+    """Write `ds` to the zarr `store` in blocks of `time_block` time steps and record
+    the progress in a json manifest next to the store (see `progress_manifest_path`).
+
+    For every block the manifest holds its time range, a checksum of the written data
+    and the validation status from `input_data_test` (with the streaming deep check
+    if `deep`, which compares the nans of the block with the first time step of `ds`).
+    Rerunning the function only computes blocks that are missing or failed validation
+    (or whose stored data does not match the checksum if `verify`). If `ds` has
+    additional time steps at the end, the store is extended without rewriting the
+    existing blocks.
+
+    Returns the progress manifest.
+    """
+    ds = ds.chunk({"time": time_block})
+    # chunk encoding inherited from the source might not match the new chunks
+    for var in ds.variables:
+        ds[var].encoding = {}
+    static_vars = [v for v in ds.variables if "time" not in ds[v].dims]
+    manifest_path = progress_manifest_path(store)
+
+    if os.path.exists(manifest_path) and os.path.exists(store):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["time_block"] != time_block:
+            raise ValueError(
+                f"{store} was written with time_block={manifest['time_block']}, got {time_block}"
+            )
+        stored_time = xr.open_dataset(store, engine="zarr", chunks={}).time
+        n_stored = stored_time.sizes["time"]
+        if n_stored > ds.sizes["time"] or not np.array_equal(
+            stored_time.values, ds.time.values[:n_stored]
+        ):
+            raise ValueError(
+                f"Time values of {store} are not the leading time values of `ds`"
+            )
+        if ds.sizes["time"] > n_stored:
+            ds.drop_vars(static_vars).isel(time=slice(n_stored, None)).to_zarr(
+                store, append_dim="time", compute=False
+            )
+    else:
+        manifest = {"time_block": time_block, "blocks": {}}
+        # write the metadata and all static (time independent) variables
+        ds.to_zarr(store, mode="w", compute=False)
+        ds[static_vars].to_zarr(store, mode="r+")
+        _write_json(manifest, manifest_path)
+
+    if validate and deep:
+        # the nans of every block are checked against the first time step of `ds`
+        # (the nan check of a single block alone could only compare it with itself)
+        reference = ds.isel(time=[0]).compute()
+
+    for block, start in enumerate(range(0, ds.sizes["time"], time_block)):
+        region = slice(start, min(start + time_block, ds.sizes["time"]))
+        time_range = [str(t) for t in ds.time.values[[region.start, region.stop - 1]]]
+        entry = manifest["blocks"].get(str(block))
+        if (
+            entry is not None
+            and entry["status"] == "ok"
+            and entry["time"] == time_range
+            and not (
+                verify
+                and block_checksum(
+                    xr.open_dataset(store, engine="zarr")
+                    .drop_vars(static_vars)
+                    .isel(time=region)
+                )
+                != entry["checksum"]
+            )
+        ):
+            continue
+
+        ds_block = ds.isel(time=region).compute()
+        entry = {"time": time_range, "status": "ok"}
+        if validate:
+            ds_check = ds_block
+            if deep and start > 0:
+                ds_check = xr.concat(
+                    [reference, ds_block],
+                    dim="time",
+                    data_vars="minimal",
+                    coords="minimal",
+                    compat="override",
+                )
+            try:
+                input_data_test(
+                    ds_check,
+                    deep=deep,
+                    deep_mode="streaming",
+                    expected_sizes=expected_sizes,
+                )
+            except ValueError as e:
+                entry["status"] = "invalid"
+                entry["error"] = str(e)
+        ds_block = ds_block.drop_vars(static_vars)
+        ds_block.to_zarr(store, region={"time": region})
+        entry["checksum"] = block_checksum(ds_block)
+        manifest["blocks"][str(block)] = entry
+        _write_json(manifest, manifest_path)
+    return manifest
+
+
+def _process_member(
+    entry: dict,
+    store: str,
+    process: Callable,
+    process_kwargs: dict,
+    retries: int,
+    validate: bool,
+    deep: bool,
+    time_block: Optional[int] = None,
+    qc_dir: Optional[str] = None,
+    expected_sizes: Optional[dict] = None,
+) -> dict:
+    """Run the full chain for a single member and write it to `store`, retrying on failure"""
+    status = {"name": entry["name"], "store": store, "attempts": 0}
+    open_kwargs = {"engine": "zarr", "chunks": {}, **entry.get("open_kwargs", {})}
+    kwargs = {**process_kwargs, **entry.get("process_kwargs", {})}
+    for attempt in range(retries + 1):
+        status["attempts"] = attempt + 1
+        try:
+            ds = process(xr.open_dataset(entry["path"], **open_kwargs), **kwargs)
+            if time_block is not None:
+                manifest = write_zarr_incremental(
+                    ds,
+                    store,
+                    time_block=time_block,
+                    validate=validate,
+                    deep=deep,
+                    expected_sizes=expected_sizes,
+                )
+                invalid = [
+                    block
+                    for block, block_entry in manifest["blocks"].items()
+                    if block_entry["status"] != "ok"
+                ]
+                if len(invalid) > 0:
+                    raise ValueError(f"Validation failed for time blocks {invalid}")
+                status["status"] = "ok"
+                status.pop("error", None)
+                break
+            if validate:
+                input_data_test(ds, deep=False, expected_sizes=expected_sizes)
+            # write to a temporary store, so that only complete outputs exist at `store`
+            tmp_store = f"{store}.tmp"
+            ds.to_zarr(tmp_store, mode="w")
+            if validate and deep:
+                input_data_test(
+                    xr.open_dataset(tmp_store, engine="zarr", chunks={}),
+                    deep=True,
+                    deep_mode="streaming",
+                    expected_sizes=expected_sizes,
+                )
+            if os.path.exists(store):
+                shutil.rmtree(store)
+            os.replace(tmp_store, store)
+            status["status"] = "ok"
+            status.pop("error", None)
+            break
+        except Exception:
+            status["status"] = "failed"
+            status["error"] = traceback.format_exc()
+    if qc_dir is not None and status["status"] == "ok":
+        # a failing report does not invalidate the output
+        try:
+            status["qc_report"] = qc_report(
+                xr.open_dataset(store, engine="zarr", chunks={}),
+                os.path.join(qc_dir, entry["name"]),
+                title=entry["name"],
+                n_workers=1,
+            )
+        except Exception:
+            status["qc_error"] = traceback.format_exc()
+    return status
+
+
+def run_manifest(
+    manifest: Union[str, list],
+    output_dir: str,
+    process: Callable = preprocess_cmip_member,
+    process_kwargs: Optional[dict] = None,
+    weights_dir: Optional[str] = None,
+    executor: Optional[Executor] = None,
+    n_workers: Optional[int] = None,
+    retries: int = 1,
+    validate: bool = True,
+    deep: bool = False,
+    skip_existing: bool = True,
+    time_block: Optional[int] = None,
+    qc_dir: Optional[str] = None,
+    expected_sizes: Optional[dict] = None,
+) -> dict:
+    """Run `process` for every member of `manifest` and write one zarr store per member
+    to `output_dir`.
+
+    Members are processed in parallel on `executor` (defaults to a process pool with
+    `n_workers`, use `client.get_executor()` to run on a dask distributed cluster).
+    Regridding weights are shared between workers through the files in `weights_dir`
+    (defaults to `<output_dir>/regrid_weights`), which is passed to `process`. Failed
+    members are retried `retries` times and then skipped. If `validate` is True, every
+    output is checked with `input_data_test` (and the streaming deep check if `deep`)
+    with `expected_sizes`.
+    If `time_block` is given, outputs are written incrementally with
+    `write_zarr_incremental`, and existing stores are resumed (or extended) instead
+    of skipped.
+    If `qc_dir` is given, a QC report (see `plotting.qc_report`) of every processed
+    member is written to `<qc_dir>/<name>`.
+
+    Returns a dict with the status of every member.
+    """
+    manifest = load_manifest(manifest)
+    os.makedirs(output_dir, exist_ok=True)
+    if weights_dir is None:
+        weights_dir = os.path.join(output_dir, "regrid_weights")
+    process_kwargs = {"weights_dir": weights_dir, **(process_kwargs or {})}
+
+    results = {}
+    own_executor = executor is None
+    if own_executor:
+        # forking a process that already runs dask/zarr threads can deadlock
+        executor = ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+    try:
+        futures = []
+        for entry in manifest:
+            store = os.path.join(output_dir, f"{entry['name']}.zarr")
+            if skip_existing and time_block is None and os.path.exists(store):
+                results[entry["name"]] = {
+                    "name": entry["name"],
+                    "store": store,
+                    "status": "skipped",
+                    "attempts": 0,
+                }
+                continue
+            futures.append(
+                executor.submit(
+                    _process_member,
+                    entry,
+                    store,
+                    process,
+                    process_kwargs,
+                    retries,
+                    validate,
+                    deep,
+                    time_block,
+                    qc_dir,
+                    expected_sizes,
+                )
+            )
+        for future in as_completed(futures):
+            status = future.result()
+            results[status["name"]] = status
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return {entry["name"]: results[entry["name"]] for entry in manifest}
@@ -1,60 +1,177 @@
-import matplotlib.pyplot as plt
-from xarrayutils.plotting import linear_piecewise_scale
+from concurrent.futures import Executor, ProcessPoolExecutor
+import html
+import multiprocessing
+import os
+from typing import Optional, Union
 import xarray as xr
+from ocean_emulators.diagnostics import compute_diagnostics
+from ocean_emulators.preprocessing import GIT_HASH_ATTR
 
+# diagnostic (see `diagnostics.compute_diagnostics`) shown in every panel and its title
+QC_PANELS = {
+    "snapshot": "Surface Snapshot",
+    "global_mean": "Area weighted global mean",
+    "zonal_mean_std": "Stdv in time of area weighted zonal mean",
+}
 
-def qc_plots(ds: xr.Dataset):
-    ## plot maps
-    fig, axarr = plt.subplots(ncols=2, nrows=3, figsize=[15, 13])
-    for var, ax in zip(ds.data_vars, axarr.flat):
-        da = ds[var].isel(time=0, lev=0, missing_dims="ignore").load()
-        kwargs = {"x": "x"}
-        da.plot(ax=ax, **kwargs)
-        ax.set_title("Surface Snapshot")
 
-    plt.show()
+def _piecewise_depth_axis(ax):
+    from xarrayutils.plotting import linear_piecewise_scale
+
+    linear_piecewise_scale(1000, 5, ax=ax)
+    # indicate the point between the different scalings
+    ax.axhline(1000, color="0.5", ls="--")
+    # Rearange the yticks
+    ax.set_yticks([0, 250, 500, 750, 1000, 3000, 5000])
+
 
-    ## plot simple (non-weighted averages) over time (and potentially depth)
-    fig, axarr = plt.subplots(ncols=2, nrows=3, figsize=[15, 18])
-    for var, ax in zip(ds.data_vars, axarr.flat):
-        da = ds[var].mean(["x", "y"]).load()
+def _plot_panel(ax, ds_diag: xr.Dataset, var: str, panel: str):
+    """Draw a single QC panel of `var` into `ax`"""
+    da = ds_diag[f"{var}_{panel}"]
+    if panel == "snapshot":
+        da.plot(ax=ax, x="x")
+    elif panel == "global_mean":
         kwargs = {"x": "time"}
         if "lev" in da.dims:
             kwargs["yincrease"] = False
-
         da.plot(ax=ax, **kwargs)
-
         if "lev" not in da.dims:
             da.rolling(time=12).mean().plot(
                 ax=ax, **kwargs, label="12 month rolling mean"
             )
             ax.legend()
         else:
-            linear_piecewise_scale(1000, 5, ax=ax)
-            # indicate the point between the different scalings
-            ax.axhline(1000, color="0.5", ls="--")
-            # Rearange the yticks
-            ax.set_yticks([0, 250, 500, 750, 1000, 3000, 5000])
-        ax.set_title("Unweighted global mean")
-
-    plt.show()
-
-    ### show stdv over time averaged over longitudes
-    fig, axarr = plt.subplots(ncols=2, nrows=3, figsize=[15, 18])
-    for var, ax in zip(ds.data_vars, axarr.flat):
-        da = ds[var].mean("x").std("time").load()
+            _piecewise_depth_axis(ax)
+    elif panel == "zonal_mean_std":
         kwargs = {"x": "y"}
         if "lev" in da.dims:
             kwargs["yincrease"] = False
             kwargs["robust"] = True
-
         da.plot(ax=ax, **kwargs)
         if "lev" in da.dims:
-            linear_piecewise_scale(1000, 5, ax=ax)
-            # indicate the point between the different scalings
-            ax.axhline(1000, color="0.5", ls="--")
-            # Rearange the yticks
-            ax.set_yticks([0, 250, 500, 750, 1000, 3000, 5000])
-        ax.set_title("Stdv in time of zonal unweighted mean")
-
-    plt.show()
+            _piecewise_depth_axis(ax)
+    else:
+        raise ValueError(f"Unknown QC panel {panel}. Expected one of {list(QC_PANELS)}")
+    ax.set_title(QC_PANELS[panel])
+
+
+def qc_plots(ds: xr.Dataset, cache_dir: Optional[str] = None):
+    """Plot surface snapshots, weighted global means and the time variability of zonal
+    means for all variables. All diagnostics are computed in a single pass (see
+    `diagnostics.compute_diagnostics`, which caches the results in `cache_dir`)."""
+    import matplotlib.pyplot as plt
+
+    variables = [v for v in ds.data_vars if "time" in ds[v].dims]
+    ds_diag = compute_diagnostics(ds, variables=variables, cache_dir=cache_dir)
+
+    for panel, figsize in zip(QC_PANELS, [[15, 13], [15, 18], [15, 18]]):
+        fig, axarr = plt.subplots(ncols=2, nrows=3, figsize=figsize)
+        for var, ax in zip(variables, axarr.flat):
+            _plot_panel(ax, ds_diag, var, panel)
+        plt.show()
+
+
+def _render_panel(
+    ds_diag: xr.Dataset,
+    var: str,
+    panel: str,
+    path: str,
+    style: Union[str, dict, None],
+    figsize: tuple,
+    dpi: int,
+) -> str:
+    """Render a single panel to a png file (runs in a worker process)"""
+    import matplotlib.style
+    from matplotlib.figure import Figure
+
+    # figures that are not managed by pyplot are rendered with Agg, independent of the
+    # (interactive) backend, so no display is needed on batch nodes
+    with matplotlib.style.context(style or {}):
+        fig = Figure(figsize=figsize)
+        _plot_panel(fig.subplots(), ds_diag, var, panel)
+        fig.savefig(path, dpi=dpi, bbox_inches="tight")
+    return path
+
+
+def _report_html(title: str, ds_diag: xr.Dataset, images: dict) -> str:
+    lines = [
+        "<!DOCTYPE html>",
+        "<html>",
+        f"<head><meta charset='utf-8'><title>{html.escape(title)}</title></head>",
+        "<body>",
+        f"<h1>{html.escape(title)}</h1>",
+    ]
+    if "source_git_hash" in ds_diag.attrs:
+        git_hash = html.escape(str(ds_diag.attrs["source_git_hash"]))
+        lines.append(f"<p>{GIT_HASH_ATTR}: {git_hash}</p>")
+    for panel, panel_title in QC_PANELS.items():
+        lines.append(f"<h2>{html.escape(panel_title)}</h2>")
+        for var, filename in images[panel].items():
+            lines.append(
+                f"<figure style='display:inline-block'><img src='{filename}'>"
+                f"<figcaption>{html.escape(var)}</figcaption></figure>"
+            )
+    lines += ["</body>", "</html>", ""]
+    return "\n".join(lines)
+
+
+def qc_report(
+    ds: xr.Dataset,
+    output_dir: str,
+    title: Optional[str] = None,
+    cache_dir: Optional[str] = None,
+    executor: Optional[Executor] = None,
+    n_workers: Optional[int] = None,
+    style: Union[str, dict, None] = None,
+    figsize: tuple = (7.5, 5),
+    dpi: int = 100,
+) -> str:
+    """Write the panels of `qc_plots` as png files and an `index.html` page to
+    `output_dir` without a display (e.g. on batch nodes). Returns the path of the page.
+
+    All diagnostics are computed in a single pass and cached in `cache_dir` (defaults
+    to `<output_dir>/diagnostics`), so rerunning with a different `style` (a matplotlib
+    style name or rc dict), `figsize` or `dpi` only renders the panels again. Panels are
+    rendered in parallel on `executor` (defaults to a process pool with `n_workers`,
+    `n_workers=1` renders in the current process).
+    """
+    variables = [v for v in ds.data_vars if "time" in ds[v].dims]
+    if cache_dir is None:
+        cache_dir = os.path.join(output_dir, "diagnostics")
+    ds_diag = compute_diagnostics(ds, variables=variables, cache_dir=cache_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    images = {
+        panel: {var: f"{var}_{panel}.png" for var in variables} for panel in QC_PANELS
+    }
+    tasks = [
+        (ds_diag[[f"{var}_{panel}"]], var, panel, os.path.join(output_dir, filename))
+        for panel, filenames in images.items()
+        for var, filename in filenames.items()
+    ]
+    if executor is None and n_workers == 1:
+        for task in tasks:
+            _render_panel(*task, style, figsize, dpi)
+    else:
+        own_executor = executor is None
+        if own_executor:
+            executor = ProcessPoolExecutor(
+                max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        try:
+            futures = [
+                executor.submit(_render_panel, *task, style, figsize, dpi)
+                for task in tasks
+            ]
+            for future in futures:
+                future.result()
+        finally:
+            if own_executor:
+                executor.shutdown()
+
+    if title is None:
+        title = f"QC report ({', '.join(variables)})"
+    path = os.path.join(output_dir, "index.html")
+    with open(path, "w") as f:
+        f.write(_report_html(title, ds_diag, images))
+    return path
@@ -1,42 +1,72 @@
+from typing import Optional, Union
 import xarray as xr
 import warnings
-from ocean_emulators.preprocessing import input_data_test
-from ocean_emulators.utils import assert_mask_match
+from ocean_emulators.channels import ChannelLayout, DEFAULT_PREDICTION_LAYOUT
+from ocean_emulators.preprocessing import (
+    check_nan_sketch,
+    input_data_test,
+    select_nan_sketch,
+)
+from ocean_emulators.schema import DatasetSchema, as_schema
+from ocean_emulators.instrumentation import instrumented, stage
+from ocean_emulators.utils import WetMask, assert_mask_match
 
 
-def post_processor(ds: xr.Dataset, ds_truth: xr.Dataset) -> xr.Dataset:
-    """Converts the prediction output to an xarray dataset with the same dimensions/variables as input"""
+@instrumented
+def post_processor(
+    ds: xr.Dataset,
+    ds_truth: xr.Dataset,
+    layout: Optional[ChannelLayout] = None,
+    truth_sketch=None,
+) -> xr.Dataset:
+    """Converts the prediction output to an xarray dataset with the same dimensions/variables as input.
+    The channel `layout` is read from the attributes of `ds` if not given, and defaults to
+    `DEFAULT_PREDICTION_LAYOUT`.
+    If given, the nan sketch of the input dataset (`truth_sketch`, see
+    `preprocessing.nan_sketch`) is used to check that the nans of `ds_truth` match
+    its wetmask without reading any data."""
+    da = ds["__xarray_dataarray_variable__"]
+    if layout is None:
+        layout = ChannelLayout.from_attrs({**ds.attrs, **da.attrs})
+    if layout is None:
+        layout = DEFAULT_PREDICTION_LAYOUT
+
+    # correct swapped dimensions and warn
+    truth_sizes = ds_truth.sizes
+    if (
+        ds.sizes["x"] != ds.sizes["y"]
+        and ds.sizes["x"] == truth_sizes["y"]
+        and ds.sizes["y"] == truth_sizes["x"]
+    ):
+        ds = ds.rename({"x": "x_i", "y": "y_i"}).rename({"x_i": "y", "y_i": "x"})
+        da = ds["__xarray_dataarray_variable__"]
+        warnings.warn(
+            "Swapped x and y dimensions detected. Fixing this now, but should be corrected upstream"
+        )
+
     # Always run the input_data_test in non-deep mode here
+    expected_sizes = {"x": ds.sizes["x"], "y": ds.sizes["y"]}
+    levels = [n_lev for n_lev in layout.groups if n_lev is not None]
+    if len(levels) == 1:
+        expected_sizes["lev"] = levels[0]
     try:
-        input_data_test(ds_truth, deep=False)
+        input_data_test(ds_truth, deep=False, expected_sizes=expected_sizes)
     except ValueError as e:
         raise ValueError(
             f"Checking the input dataset failed with {e}. Please fix those issues before creating a postprocessed dataset."
         )
-
-    # correct swapped dimensions and warn
-    if len(ds.x) == 180 and len(ds.y) == 360:
-        ds = ds.rename({"x": "x_i", "y": "y_i"}).rename({"x_i": "y", "y_i": "x"})
-        warnings.warn(
-            "Swapped x and y dimensions detected. Fixing this now, but should be corrected upstream"
+    if truth_sketch is not None:
+        index = check_nan_sketch(
+            select_nan_sketch(truth_sketch, ds_truth), wetmask=ds_truth.wetmask
         )
+        if not all(len(v) == 0 for v in index.values()):
+            raise ValueError(
+                f"Nans of the input dataset do not match the wetmask at the following indexes {index}"
+            )
 
-    da = ds["__xarray_dataarray_variable__"]
-    n_lev = 19
-    variables = ["uo", "vo", "thetao", "so"]
-    slices = [slice(i, i + n_lev) for i in range(0, len(variables) * n_lev, n_lev)]
-    var_slices = {k: sl for k, sl in zip(variables, slices)}
-    variables = {
-        k: da.isel(var=sl).rename({"var": "lev"}) for k, sl in var_slices.items()
-    }
-    variables["zos"] = da.isel(var=-1).squeeze()
-
-    ds_out = xr.Dataset(variables)
-    for var in ds_out.data_vars:
-        if "lev" in ds_out[var].dims:
-            ds_out[var] = ds_out[var].where(ds_truth.wetmask)
-        else:
-            ds_out[var] = ds_out[var].where(ds_truth.wetmask.isel(lev=0))
+    # reshape the channel axis into (variable, lev) and mask all variables with the same
+    # number of levels with a single blockwise operation
+    ds_out = layout.unpack(da, mask=WetMask(ds_truth.wetmask))
 
     ## attach all coordinates from input
     ds_out = ds_out.assign_coords({co: ds_truth[co] for co in ds_truth.coords})
@@ -44,24 +74,48 @@ def post_processor(ds: xr.Dataset, ds_truth: xr.Dataset) -> xr.Dataset:
     return ds_out
 
 
-def prediction_data_test(ds_prediction: xr.Dataset, ds_input):
-    """Testfunction to check post-processed prediction output for format"""
+@instrumented
+def post_process_to_zarr(
+    ds: xr.Dataset, ds_truth: xr.Dataset, store, time_chunk: int = 1, **kwargs
+) -> xr.Dataset:
+    """Postprocess the prediction output (see `post_processor`) and write it straight
+    to a zarr store with `time_chunk` time steps per chunk.
+    Additional keyword arguments are passed to `xr.Dataset.to_zarr`."""
+    ds_out = post_processor(ds, ds_truth).chunk({"time": time_chunk})
+    # chunk encoding inherited from the truth dataset might not match the new chunks
+    for var in ds_out.variables:
+        ds_out[var].encoding = {}
+    kwargs.setdefault("mode", "w")
+    ds_out.to_zarr(store, **kwargs)
+    return ds_out
+
+
+@instrumented
+def prediction_data_test(
+    ds_prediction: Union[xr.Dataset, DatasetSchema, str], ds_input, deep: bool = False
+):
+    """Testfunction to check post-processed prediction output for format.
+    Both datasets can also be given as `DatasetSchema` or zarr store paths. The format
+    checks only use metadata. If `deep` is True, the data is read to check that the
+    wetmask is applied (timed as the "deep checks" stage of `instrument_run`)."""
     # TODO: Run the test for the preprocessing data here and warn only if it fails
     # That data should have been checked before training and here we only strictly enforce that things reflect the state of the input data.
+    prediction_schema = as_schema(ds_prediction)
+    input_schema = as_schema(ds_input)
 
-    expected_sizes = {"x": 360, "y": 180, "lev": 19}
-    given_sizes = ds_prediction.sizes
+    expected_sizes = {di: s for di, s in input_schema.sizes.items() if di != "time"}
+    given_sizes = prediction_schema.sizes
     compare_dims = list(
         set(list(expected_sizes.keys()) + list(given_sizes.keys())) - set(["time"])
     )
-    if any(expected_sizes[dim] != given_sizes[dim] for dim in compare_dims):
+    if any(expected_sizes.get(dim) != given_sizes.get(dim) for dim in compare_dims):
         raise ValueError(
             f"Input dataset does not have the right sizes. Expected{expected_sizes}, got {given_sizes}"
         )
 
     # ensure all dimensions have coordinate values
     dims_without_coords = [
-        di for di in ds_prediction.dims if di not in ds_prediction.coords
+        di for di in prediction_schema.dims if di not in prediction_schema.coords
     ]
     if len(dims_without_coords) > 0:
         raise ValueError(
@@ -69,15 +123,21 @@ def prediction_data_test(ds_prediction: xr.Dataset, ds_input):
         )
 
     # ensure the attributes are the same on both datasets
-    if not ds_prediction.attrs == ds_input.attrs:
+    if not prediction_schema.attrs == input_schema.attrs:
         raise ValueError(
             "Prediction and Input datasets do not have matching attributes"
         )
-    # Check that the wetmask is applied to the data
-    assert_mask_match(
-        ds_prediction.isel(time=0).reset_coords(drop=True), ds_input.wetmask
-    )
 
     # TODO: ensure that both arrays have the same coordinates
 
-    # TODO: Check that the wetmask is applied to the data
+    if deep:
+        if not isinstance(ds_prediction, xr.Dataset):
+            ds_prediction = xr.open_dataset(ds_prediction, engine="zarr", chunks={})
+        if not isinstance(ds_input, xr.Dataset):
+            ds_input = xr.open_dataset(ds_input, engine="zarr", chunks={})
+        # Check that the wetmask is applied to the data
+        with stage("deep checks"):
+            assert_mask_match(
+                ds_prediction.isel(time=0).reset_coords(drop=True),
+                WetMask(ds_input.wetmask),
+            )
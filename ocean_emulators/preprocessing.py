@@ -1,19 +1,28 @@
 """Preprocess arbitrary datasets to standardized naming, grids"""
 
-from xgcm import Grid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import json
+import os
+from typing import TYPE_CHECKING, Optional, Union
 import xarray as xr
 import numpy as np
-import cf_xarray
+from ocean_emulators.grids import get_grid, load_grid
+from ocean_emulators.schema import DatasetSchema, as_schema
+from ocean_emulators.instrumentation import instrumented, stage
 
-try:
-    import xesmf as xe  # type: ignore
-except ImportError:
-    xe = None
+# heavy dependencies are imported in the functions that need them
+if TYPE_CHECKING:
+    from xgcm import Grid
 
 
-def manual_v0_fixes(ds_input: xr.Dataset) -> xr.Dataset:
-    """Manual fixes for the already existing data (for now only v0.0). This should not be used in the future"""
-    # fixes that should be checked and fixes on the input data
+V0_GRID_ID = "CM2x_v0.0"
+
+
+def _v0_grid(ds_input: xr.Dataset) -> xr.Dataset:
+    """Static grid fields of the v0.0 data (reads the cell area from the cloud)"""
     area = xr.open_dataset(
         "gs://leap-persistent/sd5313/grids_CM2x.zarr", engine="zarr", chunks={}
     )["area_C"].rename({"xu_ocean": "x", "yu_ocean": "y"})
@@ -69,8 +78,48 @@ def manual_v0_fixes(ds_input: xr.Dataset) -> xr.Dataset:
     wetmask = ~np.isnan(ds_input.thetao.isel(time=0).reset_coords(drop=True)).load()
     lon = xr.ones_like(ds_input.y) * ds_input.x
     lat = ds_input.y * xr.ones_like(ds_input.x)
+    fields = dict(areacello=area, dz=dz, lev=z, wetmask=wetmask, lon=lon, lat=lat)
+    # to check that later inputs are on the same grid
+    fields.update({co: ds_input[co] for co in ["x", "y"] if co in ds_input.coords})
+    return xr.Dataset(
+        coords={
+            name: da.reset_coords(drop=True).variable for name, da in fields.items()
+        }
+    )
+
+
+def _check_v0_grid(grid: xr.Dataset, ds_input: xr.Dataset, grid_id: str):
+    """Raise if a registered grid was created from data on a different grid"""
+    for di, size in grid.sizes.items():
+        if di in ds_input.dims and ds_input.sizes[di] != size:
+            raise ValueError(
+                f"Registered grid {grid_id} has size {size} along {di}, but the input "
+                f"dataset has {ds_input.sizes[di]}. Register the grid again."
+            )
+    for co in ["x", "y"]:
+        if (
+            co in grid.variables
+            and co in ds_input.coords
+            and not np.array_equal(grid[co].values, ds_input[co].values)
+        ):
+            raise ValueError(
+                f"Coordinate {co} of the registered grid {grid_id} does not match the "
+                "input dataset. Register the grid again."
+            )
+
+
+@instrumented
+def manual_v0_fixes(
+    ds_input: xr.Dataset, grid_id: str = V0_GRID_ID, cache_dir: Optional[str] = None
+) -> xr.Dataset:
+    """Manual fixes for the already existing data (for now only v0.0). This should not be used in the future.
+    The static grid fields are created on the first call and then loaded from the local
+    grid registry (see `grids.get_grid`) as `grid_id`."""
+    # fixes that should be checked and fixes on the input data
+    grid = get_grid(grid_id, lambda: _v0_grid(ds_input), cache_dir=cache_dir)
+    _check_v0_grid(grid, ds_input, grid_id)
     ds_input = ds_input.assign_coords(
-        areacello=area, dz=dz, lev=z, wetmask=wetmask, lon=lon, lat=lat
+        {name: grid[name].variable for name in grid.variables}
     )
     # give a dummy commit hash
     ds_input.attrs["m2lines/ocean-emulators_git_hash"] = "dummy"
@@ -78,31 +127,79 @@ def manual_v0_fixes(ds_input: xr.Dataset) -> xr.Dataset:
 
 
 # i need to test 2d and 3d separately
+@instrumented
 def split_2d_3d(ds: xr.Dataset):
     ds_2d = xr.Dataset({v: ds[v] for v in ds.data_vars if "lev" not in ds[v].dims})
     ds_3d = xr.Dataset({v: ds[v] for v in ds.data_vars if "lev" in ds[v].dims})
     return ds_2d, ds_3d
 
 
-def find_index_for_true(da_bool: xr.DataArray):
-    """Find slices along all dimensions within a boolean array that have any True value"""
-    # all_dims = da_bool.dims
+def _first_true_index(block: np.ndarray, ndim: int, n: int) -> np.ndarray:
+    """Flat indices (along the last `ndim` axes) of the first `n` True values, padded with -1"""
+    n_cells = int(np.prod(block.shape[block.ndim - ndim :]))
+    flat = block.reshape(-1, n_cells)
+    out = np.full((flat.shape[0], n), -1, dtype=np.int64)
+    for row in np.flatnonzero(flat.any(axis=1)):
+        index = np.flatnonzero(flat[row])[:n]
+        out[row, : len(index)] = index
+    return out.reshape(block.shape[: block.ndim - ndim] + (n,))
+
+
+@instrumented
+def find_index_for_true(da_bool: xr.DataArray, n_offending: int = 0):
+    """Find slices along all dimensions within a boolean array that have any True value.
+    The (variable, time) matrix of any True values is computed in a single pass. If
+    `n_offending` > 0, the coordinates of the first `n_offending` True values are
+    returned as `cells` (computed in the same pass)."""
     all_dims = [
         di for di in ["variable", "time"] if di in da_bool.dims
     ]  # all variables that should be checked for indexers
     # not necessary to check e.g. x,y, lev here
+    other_dims = [di for di in da_bool.dims if di not in all_dims]
+    if n_offending > 0:
+        first = xr.apply_ufunc(
+            _first_true_index,
+            da_bool,
+            kwargs={"ndim": len(other_dims), "n": n_offending},
+            input_core_dims=[other_dims],
+            output_core_dims=[["cell"]],
+            dask="parallelized",
+            output_dtypes=[np.int64],
+            dask_gufunc_kwargs={
+                "allow_rechunk": True,
+                "output_sizes": {"cell": n_offending},
+            },
+        )
+        first = first.transpose(*all_dims, "cell").values
+        found = first[..., 0] >= 0
+    else:
+        found = da_bool.any(other_dims).transpose(*all_dims).values
+
     true_found_index = {}
-    for dim in all_dims:
-        other_dims = [di for di in da_bool.dims if di != dim]
-        test = da_bool.any(other_dims).load()
-        index = da_bool[dim].isel({dim: test})
-        true_found_index[dim] = index.data
+    for axis, dim in enumerate(all_dims):
+        test = found.any(axis=tuple(a for a in range(len(all_dims)) if a != axis))
+        true_found_index[dim] = da_bool[dim].data[test]
+
+    if n_offending > 0:
+        shape = [da_bool.sizes[di] for di in other_dims]
+        cells = []
+        for position in np.argwhere(found):
+            for flat_index in first[tuple(position)]:
+                if flat_index < 0 or len(cells) == n_offending:
+                    break
+                cell = {di: da_bool[di].values[i] for di, i in zip(all_dims, position)}
+                for di, i in zip(other_dims, np.unravel_index(flat_index, shape)):
+                    cell[di] = da_bool[di].values[i] if di in da_bool.coords else i
+                cells.append(cell)
+        true_found_index["cells"] = cells
     return true_found_index
 
 
-def test_nan_consistency(ds: xr.Dataset, name="None"):
+@instrumented
+def test_nan_consistency(ds: xr.Dataset, name="None", n_offending: int = 0):
     """Test the consistency of nan values in the dataset across variables and time
-    (compared to a reference at time=0)."""
+    (compared to a reference at time=0). The error lists the coordinates of the first
+    `n_offending` mismatching cells."""
     ds = ds.to_array()
     ref = ds.isel(time=0)
     # # make sure the ref data has nans in the same places for all variables
@@ -119,7 +216,7 @@ def test_nan_consistency(ds: xr.Dataset, name="None"):
     b = np.isnan(ref) != np.isnan(ds)
 
     # find the index values for true values in b
-    index = find_index_for_true(b)
+    index = find_index_for_true(b, n_offending=n_offending)
 
     # if they are all length 0 all is good, otherwise raise.
     if not all(len(v) == 0 for v in index.values()):
@@ -128,36 +225,307 @@ def test_nan_consistency(ds: xr.Dataset, name="None"):
         )
 
 
-def input_data_test_deep(ds_input: xr.Dataset):
-    """Expensive tests that compute on the entire dataset"""
+def _packed_nan_mask(block: np.ndarray) -> np.ndarray:
+    """Bit-pack the nan pattern of `block` for every element along the first axis"""
+    return np.packbits(np.isnan(block).reshape(block.shape[0], -1), axis=1)
+
+
+def _time_chunk_size(da: xr.DataArray) -> int:
+    """Use the existing time chunking of dask arrays, otherwise step through single time steps"""
+    if da.chunks is None:
+        return 1
+    return da.chunksizes["time"][0]
+
+
+@instrumented
+def test_nan_consistency_streaming(ds: xr.Dataset, name="None", time_chunk=None):
+    """Streaming version of `test_nan_consistency`.
+    Every variable is read only once in blocks of `time_chunk` time steps (defaults
+    to the dask chunking) and compared against a bit-packed nan pattern of the first
+    variable at time=0. Memory usage is bounded by a single block."""
+    variables = [v for v in ds.data_vars if "time" in ds[v].dims]
+    if len(variables) == 0:
+        return
+    ref_da = ds[variables[0]]
+    spatial_dims = [di for di in ref_da.dims if di != "time"]
+    ref = _packed_nan_mask(
+        ref_da.isel(time=[0]).transpose("time", *spatial_dims).values
+    )
+
+    offending_variables = []
+    offending_times = set()
+    for var in variables:
+        da = ds[var].transpose("time", *spatial_dims)
+        step = time_chunk or _time_chunk_size(da)
+        for start in range(0, da.sizes["time"], step):
+            block = da.isel(time=slice(start, start + step)).values
+            mismatch = (_packed_nan_mask(block) != ref).any(axis=1)
+            if mismatch.any():
+                if var not in offending_variables:
+                    offending_variables.append(var)
+                offending_times.update(np.flatnonzero(mismatch) + start)
+
+    if len(offending_variables) > 0:
+        index = {
+            "variable": np.array(offending_variables),
+            "time": ds["time"].data[sorted(offending_times)],
+        }
+        raise ValueError(
+            f"{name}:Found nonmatching nans compared to first time step in the following indexes {index}"
+        )
+
+
+GIT_HASH_ATTR = "m2lines/ocean-emulators_git_hash"
+
+
+def _nan_bitmap_hash(nans: np.ndarray) -> np.ndarray:
+    """64 bit hash of the bit-packed nan pattern of every row of a 2D boolean array"""
+    bits = np.packbits(nans, axis=1)
+    return np.array(
+        [
+            int.from_bytes(
+                hashlib.blake2b(row.tobytes(), digest_size=8).digest(), "little"
+            )
+            for row in bits
+        ],
+        dtype=np.uint64,
+    )
+
+
+def _nan_sketch_kernel(block: np.ndarray, ndim: int):
+    n_cells = int(np.prod(block.shape[block.ndim - ndim :]))
+    nans = np.isnan(block).reshape(-1, n_cells)
+    shape = block.shape[: block.ndim - ndim]
+    return (
+        np.count_nonzero(nans, axis=1).reshape(shape),
+        _nan_bitmap_hash(nans).reshape(shape),
+    )
+
+
+def _sketch_dims(da: xr.DataArray) -> list:
+    # fixed order of the spatial dimensions, so that hashes are comparable across variables
+    return sorted(di for di in da.dims if di != "time")
+
+
+@instrumented
+def nan_sketch(ds: xr.Dataset) -> xr.Dataset:
+    """Small (variable, time) summary of the nan pattern of all time dependent variables.
+
+    `nan_count` holds the number of nans and `nan_hash` a hash of the nan bitmap of
+    every variable and time step. All variables are reduced in a single (dask) compute,
+    reading the data only once. Time values are stored as strings.
+    """
+    variables = [v for v in ds.data_vars if "time" in ds[v].dims]
+    counts = []
+    hashes = []
+    for var in variables:
+        dims = _sketch_dims(ds[var])
+        count, nan_hash = xr.apply_ufunc(
+            _nan_sketch_kernel,
+            ds[var].reset_coords(drop=True),
+            kwargs={"ndim": len(dims)},
+            input_core_dims=[dims],
+            output_core_dims=[[], []],
+            dask="parallelized",
+            output_dtypes=[np.int64, np.uint64],
+            dask_gufunc_kwargs={"allow_rechunk": True},
+        )
+        counts.append(count)
+        hashes.append(nan_hash)
+    sketch = xr.Dataset(
+        {
+            "nan_count": xr.concat(counts, dim="variable"),
+            "nan_hash": xr.concat(hashes, dim="variable"),
+        }
+    ).compute()
+    sketch = sketch.assign_coords(
+        variable=variables,
+        time=[str(t) for t in ds.time.values],
+        has_lev=("variable", ["lev" in ds[var].dims for var in variables]),
+    )
+    sketch = sketch.transpose("variable", "time")
+    if GIT_HASH_ATTR in ds.attrs:
+        sketch.attrs[GIT_HASH_ATTR] = ds.attrs[GIT_HASH_ATTR]
+    return sketch
+
+
+@instrumented
+def write_nan_sketch(sketch: xr.Dataset, path: str):
+    """Store a nan sketch as a small json sidecar file"""
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "variable": sketch.variable.values.tolist(),
+                "time": sketch.time.values.tolist(),
+                "has_lev": sketch.has_lev.values.tolist(),
+                "nan_count": sketch.nan_count.values.tolist(),
+                "nan_hash": sketch.nan_hash.values.tolist(),
+                "attrs": sketch.attrs,
+            },
+            f,
+        )
+
+
+@instrumented
+def read_nan_sketch(path: str) -> xr.Dataset:
+    with open(path) as f:
+        content = json.load(f)
+    return xr.Dataset(
+        {
+            "nan_count": (
+                ["variable", "time"],
+                np.array(content["nan_count"], dtype=np.int64),
+            ),
+            "nan_hash": (
+                ["variable", "time"],
+                np.array(content["nan_hash"], dtype=np.uint64),
+            ),
+        },
+        coords={
+            "variable": content["variable"],
+            "time": content["time"],
+            "has_lev": ("variable", content["has_lev"]),
+        },
+        attrs=content["attrs"],
+    )
+
+
+@instrumented
+def select_nan_sketch(sketch, ds: xr.Dataset, variables=None) -> xr.Dataset:
+    """Load `sketch` (if given as a path) and select the time steps and `variables`
+    (default: all time dependent variables) of `ds`."""
+    if not isinstance(sketch, xr.Dataset):
+        sketch = read_nan_sketch(sketch)
+    if GIT_HASH_ATTR in sketch.attrs and GIT_HASH_ATTR in ds.attrs:
+        if sketch.attrs[GIT_HASH_ATTR] != ds.attrs[GIT_HASH_ATTR]:
+            raise ValueError(
+                f"The nan sketch was computed for {GIT_HASH_ATTR}={sketch.attrs[GIT_HASH_ATTR]}, but the dataset has {ds.attrs[GIT_HASH_ATTR]}"
+            )
+    if variables is None:
+        variables = [v for v in ds.data_vars if "time" in ds[v].dims]
+    return sketch.sel(variable=variables, time=[str(t) for t in ds.time.values])
+
+
+@instrumented
+def check_nan_sketch(sketch: xr.Dataset, wetmask: Optional[xr.DataArray] = None):
+    """Compare the nan hashes of a sketch against a reference without reading any data.
+    The reference is the nan pattern of `wetmask` (its surface for 2D variables) if
+    given, otherwise the first 2D/3D variable at the first time step.
+    Returns the offending variables and time values (like `find_index_for_true`)."""
+    mismatch = xr.zeros_like(sketch.nan_hash, dtype=bool).drop_vars("has_lev")
+    for has_lev in [False, True]:
+        group = sketch.has_lev.values == has_lev
+        if not group.any():
+            continue
+        hashes = sketch.nan_hash.values[group]
+        if wetmask is None:
+            ref = hashes[0, 0]
+        else:
+            mask = wetmask if has_lev else wetmask.isel(lev=0)
+            nans = ~mask.transpose(*sorted(mask.dims)).values.astype(bool)
+            ref = _nan_bitmap_hash(nans.reshape(1, -1))[0]
+        mismatch.values[group] = hashes != ref
+    return find_index_for_true(mismatch)
+
+
+@instrumented
+def test_nan_consistency_sketch(ds: xr.Dataset, name="None", sketch=None):
+    """Version of `test_nan_consistency` based on a nan sketch (see `nan_sketch`).
+    If `sketch` (a dataset or path to a sidecar file from `write_nan_sketch`) is not
+    given, it is computed in a single pass. Only if hashes mismatch, the full check is
+    run on the offending time steps."""
+    variables = [v for v in ds.data_vars if "time" in ds[v].dims]
+    if len(variables) == 0:
+        return
+    if sketch is None:
+        sketch = nan_sketch(ds[variables])
+    index = check_nan_sketch(select_nan_sketch(sketch, ds, variables))
+    if all(len(v) == 0 for v in index.values()):
+        return
+
+    # targeted full check on the offending time steps only
+    time_index = np.flatnonzero(
+        np.isin([str(t) for t in ds.time.values], index["time"])
+    )
+    test_nan_consistency(
+        ds[variables].isel(time=[0, *time_index]), name, n_offending=10
+    )
+    raise ValueError(
+        f"{name}:Nan sketch does not match the data at the following indexes {index}. The sketch might be outdated."
+    )
+
+
+@instrumented
+def input_data_test_deep(ds_input: xr.Dataset, deep_mode: str = "full", sketch=None):
+    """Expensive tests that compute on the entire dataset.
+    `deep_mode` can be "full" (vectorized check on the whole dataset), "streaming"
+    (read every variable once in time chunks with bounded memory) or "sketch" (compare
+    nan hashes, see `test_nan_consistency_sketch`). A precomputed `sketch` (dataset or
+    path) avoids reading the data in "sketch" mode."""
+    nan_tests = {
+        "full": test_nan_consistency,
+        "streaming": test_nan_consistency_streaming,
+        "sketch": functools.partial(test_nan_consistency_sketch, sketch=sketch),
+    }
+    if deep_mode not in nan_tests:
+        raise ValueError(
+            f"Unknown deep_mode {deep_mode}. Choose from {list(nan_tests.keys())}"
+        )
+    nan_test = nan_tests[deep_mode]
+
     ds_nan_test_2d, ds_nan_test_3d = split_2d_3d(ds_input)
     print("2D consistency check")
-    test_nan_consistency(ds_nan_test_2d, "2D nan consistency check")
+    nan_test(ds_nan_test_2d, "2D nan consistency check")
 
     print("3D consistency check")
-    test_nan_consistency(ds_nan_test_3d, "3D nan consistency check")
+    nan_test(ds_nan_test_3d, "3D nan consistency check")
 
 
-def input_data_test(ds_input: xr.Dataset, deep=False):
+# data variables of the standardized input datasets (each with `_mean`/`_std` companions)
+INPUT_VARIABLES = [
+    "thetao",
+    "so",
+    "uo",
+    "vo",
+    "zos",
+    "hfds",
+    "tauvo",
+    "tauuo",
+    "sithick",
+    "siconc",
+]
+
+
+@instrumented
+def input_data_test(
+    ds_input: Union[xr.Dataset, DatasetSchema, str],
+    deep=False,
+    deep_mode: str = "full",
+    expected_sizes: Optional[dict] = None,
+    sketch=None,
+    expected_chunks: Optional[dict] = None,
+):
     """Test function to assert the format of the input dataset.
-    If `deep` is True, this will run expensive compuation across the entire dataset."""
-
-    expected_data_vars = [
-        "thetao",
-        "so",
-        "uo",
-        "vo",
-        "zos",
-        "hfds",
-        "tauvo",
-        "tauuo",
-        "sithick",
-        "siconc",
-    ]
+    `ds_input` can be a dataset, a `DatasetSchema` or the path of a zarr store. The
+    format checks only use metadata (names, dimensions, sizes, coordinates, attributes,
+    dtypes and, if `expected_chunks` is given, the chunk sizes of all time dependent
+    variables) and never read array data, so a zarr store with consolidated metadata
+    is validated without opening the dataset.
+    If `deep` is True, this will run expensive compuation across the entire dataset
+    (see `input_data_test_deep` for the available `deep_mode` options and `sketch`).
+    `expected_sizes` defaults to the 1 degree grid with 19 levels."""
+    schema = as_schema(ds_input)
+
+    expected_data_vars = INPUT_VARIABLES
     # add the derived mean/std variables
     expected_data_vars_full = []
     for v in expected_data_vars:
         expected_data_vars_full.extend([f"{v}_mean", f"{v}_std"])
+    unexpected_data_vars = set(schema.data_vars) - set(
+        expected_data_vars + expected_data_vars_full
+    )
+    if len(unexpected_data_vars) > 0:
+        raise ValueError(f"Found unexpected data variables {unexpected_data_vars}")
 
     expected_coords = [
         "areacello",
@@ -170,21 +538,23 @@ def input_data_test(ds_input: xr.Dataset, deep=False):
         "lat",
         "wetmask",
     ]
-    if not set(ds_input.coords.keys()) == set(expected_coords):
+    if not schema.coords == set(expected_coords):
         raise ValueError(
-            f"Expected coords {set(expected_coords)} but found {list(set(ds_input.coords.keys()))}"
+            f"Expected coords {set(expected_coords)} but found {list(schema.coords)}"
         )
 
-    expected_sizes = {"x": 360, "y": 180, "lev": 19}
+    if expected_sizes is None:
+        expected_sizes = {"x": 360, "y": 180, "lev": 19}
+    sizes = schema.sizes
     for di, s in expected_sizes.items():
-        if not ds_input.sizes[di] == s:
+        if not sizes[di] == s:
             raise ValueError(
-                f"Expected size ({s}) for dimension {di}, but got {ds_input.sizes[di]}"
+                f"Expected size ({s}) for dimension {di}, but got {sizes[di]}"
             )
 
-    check_attrs = ["m2lines/ocean-emulators_git_hash"]
+    check_attrs = [GIT_HASH_ATTR]
     for attr in check_attrs:
-        if attr not in ds_input.attrs.keys():
+        if attr not in schema.attrs.keys():
             raise ValueError(f"Could not find {attr} in dataset attributes")
 
     # asser shape of coordinates
@@ -196,13 +566,85 @@ def input_data_test(ds_input: xr.Dataset, deep=False):
         "dz": ["lev"],
     }
     for co, expected_dims in dims_expected_on_coords.items():
-        if not set(expected_dims) == set(ds_input[co].dims):
+        if not set(expected_dims) == set(schema[co]["dims"]):
+            raise ValueError(
+                f"Expected dimensions {set(expected_dims)} on {co}, but got {set(schema[co]['dims'])}"
+            )
+
+    for var in schema.data_vars:
+        if not np.issubdtype(schema[var]["dtype"], np.floating):
             raise ValueError(
-                f"Expected dimensions {set(expected_dims)} on {co}, but got {set(ds_input[co].dims)}"
+                f"Expected a floating point dtype for {var}, but got {schema[var]['dtype']}"
             )
 
+    if expected_chunks is not None:
+        for var in schema.data_vars:
+            variable = schema[var]
+            if "time" not in variable["dims"]:
+                continue
+            chunks = dict(
+                zip(variable["dims"], variable["chunks"] or variable["shape"])
+            )
+            for di, c in expected_chunks.items():
+                if di in chunks and chunks[di] != c:
+                    raise ValueError(
+                        f"Expected chunk size {c} along {di} for {var}, but got {chunks[di]}"
+                    )
+
     if deep:
-        input_data_test_deep(ds_input)
+        if not isinstance(ds_input, xr.Dataset):
+            ds_input = xr.open_dataset(ds_input, engine="zarr", chunks={})
+        with stage("deep checks"):
+            input_data_test_deep(ds_input, deep_mode=deep_mode, sketch=sketch)
+
+
+@instrumented
+def package_git_hash() -> str:
+    """Commit hash of the ocean_emulators source (the package version if the source is
+    not a git checkout)"""
+    import subprocess
+
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        from ocean_emulators import __version__
+
+        return __version__
+
+
+@instrumented
+def standardize_input(
+    ds: xr.Dataset, ds_grid: Union[xr.Dataset, str], git_hash: Optional[str] = None
+) -> xr.Dataset:
+    """Bring a regridded dataset into the format checked by `input_data_test`.
+    Keeps the `INPUT_VARIABLES`, adds the `wetmask` (from the nans of the first 3D
+    variable on the first time step), the `areacello`, `lon` and `lat` (and `x`/`y`)
+    coordinates of the target grid `ds_grid` (a dataset or the id of a registered grid)
+    and the git hash attribute (defaults to `package_git_hash`)."""
+    if isinstance(ds_grid, str):
+        ds_grid = load_grid(ds_grid)
+    variables = [var for var in INPUT_VARIABLES if var in ds.data_vars]
+    variables_3d = [var for var in variables if "lev" in ds[var].dims]
+    if len(variables_3d) == 0:
+        raise ValueError(
+            f"Found no 3D variable to infer the wetmask from (expected one of {INPUT_VARIABLES})"
+        )
+    ds = ds[variables]
+    ds = ds.drop_vars([co for co in ds.coords if co not in ["time", "lev", "dz"]])
+    wetmask = ~np.isnan(ds[variables_3d[0]].isel(time=0).reset_coords(drop=True))
+    grid_coords = {
+        name: ds_grid[name].reset_coords(drop=True).variable
+        for name in ["areacello", "lon", "lat", "x", "y"]
+        if name in ds_grid.variables
+    }
+    ds = ds.assign_coords(wetmask=wetmask.load().variable, **grid_coords)
+    return ds.assign_attrs({GIT_HASH_ATTR: git_hash or package_git_hash()})
 
 
 # def rename(ds: xr.Dataset) -> xr.Dataset:
@@ -231,6 +673,7 @@ def input_data_test(ds_input: xr.Dataset, deep=False):
 
 
 #################### CMIP specific Code ###########################
+@instrumented
 def infer_vertical_cell_extent(ds: xr.Dataset, dz_name: str = "dz") -> xr.Dataset:
     """
     recomputes z* vertical cell extent according to
@@ -241,17 +684,21 @@ def infer_vertical_cell_extent(ds: xr.Dataset, dz_name: str = "dz") -> xr.Datase
 
     if not all(v in ds.variables for v in required_vars):
         raise ValueError(
-            f"Could not find {set(required_vars)-set(ds.variables)} in datasset coords. Found {list(ds.coords)}"
+            f"Could not find {set(required_vars) - set(ds.variables)} in datasset coords. Found {list(ds.coords)}"
         )
 
     ds = ds.assign_coords({dz_name: ds.thkcello * (ds.deptho + ds.zos) / ds.deptho})
     return ds
 
 
+@instrumented
 def cmip_vertical_outer_grid(ds: xr.Dataset) -> xr.Dataset:
     # TODO: Check if an outer grid position is already available (e.g. from combining tracer and vertical velocities in xmip.grids.something_staggered_grid
 
     # TODO: Ask alistair if it is ok to just use the nominal depth levels + extensive quantities?
+    import cf_xarray
+    from xgcm import Grid
+
     lev_outer = cf_xarray.bounds_to_vertices(ds["lev_bounds"], "bnds").rename(
         {"lev_vertices": "lev_outer"}
     )
@@ -270,16 +717,120 @@ def cmip_vertical_outer_grid(ds: xr.Dataset) -> xr.Dataset:
 ##################### General Code #################
 
 
-def vertical_regrid(ds_raw: xr.Dataset, target_depth_bounds: np.ndarray) -> xr.Dataset:
-    # reconstruct vertical bounds
-    # TODO (this should be done outside to make this function more general)
-    grid, ds = cmip_vertical_outer_grid(ds_raw)
-    # split out the 2d variables
-    ds_2d = xr.Dataset(
-        {var: ds[var] for var in ds.data_vars if "lev" not in ds[var].dims}
+@instrumented
+def conservative_overlap_weights(
+    source_bounds: np.ndarray, target_bounds: np.ndarray
+) -> tuple:
+    """Weights to conservatively remap an extensive quantity between 1D cell bounds.
+    Returns the fraction of each source cell (columns) that falls into each target cell
+    (rows), and a boolean matrix of the cells that touch. Mirrors the conservative
+    transform in xgcm (a target cell is nan if no touching source cell has data)."""
+    source_bounds = np.asarray(source_bounds, dtype=np.float64)
+    target_bounds = np.asarray(target_bounds, dtype=np.float64)
+    src_min = np.minimum(source_bounds[:-1], source_bounds[1:])[None, :]
+    src_max = np.maximum(source_bounds[:-1], source_bounds[1:])[None, :]
+    tgt_min = target_bounds[:-1, None]
+    tgt_max = target_bounds[1:, None]
+
+    touches = (tgt_min <= src_max) & (tgt_max >= src_min)
+    overlap = np.clip(
+        np.minimum(src_max, tgt_max) - np.maximum(src_min, tgt_min), 0, None
     )
-    ds = ds.drop_vars(list(ds_2d.data_vars))
+    width = src_max - src_min
+    # cells without thickness are assigned fully to every target cell they touch
+    fraction = np.divide(overlap, width, out=np.ones_like(overlap), where=width > 0)
+    weights = np.where(touches, fraction, 0.0)
+    return weights, touches
+
+
+class VerticalRemapOperator:
+    """Precomputed conservative remapping operator between two sets of 1D (nominal) cell bounds.
+
+    The overlap structure (already normalized by the target cell thickness) is stored as
+    a sparse matrix, so that remapping a z* dataset with time-dependent cell thickness
+    reduces to a sparse matmul of the nominal extensive quantity and a per-column rescale
+    with the stretch factor `(deptho + zos) / deptho`.
+    """
+
+    def __init__(self, source_bounds: np.ndarray, target_bounds: np.ndarray):
+        import scipy.sparse
 
+        weights, touches = conservative_overlap_weights(source_bounds, target_bounds)
+        target_dz = np.diff(np.asarray(target_bounds, dtype=np.float64))
+        self.n_source = weights.shape[1]
+        self.n_target = weights.shape[0]
+        self.weights = scipy.sparse.csr_matrix(weights / target_dz[:, None])
+        self.touches = scipy.sparse.csr_matrix(touches.astype(np.float64))
+
+    def __call__(self, data: np.ndarray, thickness, stretch=None) -> np.ndarray:
+        """Remap `data` (source levels along the last axis) given the nominal cell `thickness`.
+        `stretch` is an optional factor per column (broadcastable to `data.shape[:-1]`)."""
+        extensive = data * thickness
+        shape = extensive.shape
+        flat = extensive.reshape(-1, self.n_source)
+        valid = ~np.isnan(flat)
+        regridded = (self.weights @ np.where(valid, flat, 0).T).T
+        has_data = (self.touches @ valid.T.astype(np.float64)).T > 0
+        regridded = np.where(has_data, regridded, np.nan).reshape(
+            shape[:-1] + (self.n_target,)
+        )
+        if stretch is not None:
+            regridded = regridded * np.asarray(stretch)[..., None]
+        return regridded
+
+
+def _conservative_vertical_kernel(thickness, stretch, *data, operator):
+    """Regrid all variables (with `lev` as the last axis) in a single vectorized pass"""
+    stacked = np.stack(np.broadcast_arrays(*data))
+    regridded = tuple(operator(stacked, thickness, stretch))
+    # apply_ufunc expects a single array for a single output
+    return regridded[0] if len(regridded) == 1 else regridded
+
+
+def _vertical_regrid_batched(
+    ds: xr.Dataset,
+    target_depth_bounds: np.ndarray,
+    thickness: xr.DataArray,
+    stretch=1.0,
+) -> xr.Dataset:
+    """Regrid all 3D variables together. The overlap weights are computed once from the
+    1D nominal `lev_outer` positions, and the thickness weighting is done inside the kernel."""
+    if ds.lev_outer.ndim != 1:
+        raise ValueError(
+            f"Batched vertical regridding requires 1D `lev_outer`, got {ds.lev_outer.dims}"
+        )
+    operator = VerticalRemapOperator(ds.lev_outer.values, target_depth_bounds)
+    variables = list(ds.data_vars)
+    dtype = np.result_type(*[ds[var].dtype for var in variables], thickness.dtype)
+
+    regridded = xr.apply_ufunc(
+        _conservative_vertical_kernel,
+        thickness,
+        stretch,
+        *[ds[var] for var in variables],
+        kwargs={"operator": operator},
+        input_core_dims=[["lev"], []] + [["lev"]] * len(variables),
+        output_core_dims=[["lev_target"]] * len(variables),
+        dask="parallelized",
+        output_dtypes=[dtype] * len(variables),
+        dask_gufunc_kwargs={"output_sizes": {"lev_target": operator.n_target}},
+        # `keep_attrs=True` would copy the attrs of the first input (the thickness)
+        keep_attrs=False,
+    )
+    if len(variables) == 1:
+        regridded = (regridded,)
+    ds_regridded = xr.Dataset(
+        {var: da.assign_attrs(ds[var].attrs) for var, da in zip(variables, regridded)}
+    )
+    ds_regridded = ds_regridded.rename({"lev_target": "lev"})
+    # same as the `target_data` coordinate assigned by xgcm
+    lev = (target_depth_bounds[1:] + target_depth_bounds[:-1]) / 2
+    return ds_regridded.assign_coords(lev=lev)
+
+
+def _vertical_regrid_xgcm(
+    ds: xr.Dataset, grid: "Grid", target_depth_bounds: np.ndarray
+) -> xr.Dataset:
     dz = ds["dz"]
     ds_extensive = ds * dz
 
@@ -296,15 +847,52 @@ def vertical_regrid(ds_raw: xr.Dataset, target_depth_bounds: np.ndarray) -> xr.D
 
     # by default this is named after the 'target_data', but for the purpose of simplicity, lets rename this here
     ds_extensive_regridded = ds_extensive_regridded.rename({"lev_outer": "lev"})
+    dz_regridded = xr.DataArray(
+        np.diff(target_depth_bounds),
+        dims=["lev"],
+        coords={"lev": ds_extensive_regridded.lev},
+    )
+    return ds_extensive_regridded / dz_regridded
+
+
+@instrumented
+def vertical_regrid(
+    ds_raw: xr.Dataset, target_depth_bounds: np.ndarray, engine: str = "batched"
+) -> xr.Dataset:
+    """Conservatively regrid all 3D variables onto `target_depth_bounds`.
+    `engine` can be "batched" (all variables in one vectorized pass), "zstar" (like
+    "batched", but uses the static `thkcello` and rescales with `(deptho + zos) / deptho`
+    instead of a time-dependent `dz`) or "xgcm" (`grid.transform` for every variable)."""
+    # reconstruct vertical bounds
+    # TODO (this should be done outside to make this function more general)
+    grid, ds = cmip_vertical_outer_grid(ds_raw)
+    # split out the 2d variables
+    ds_2d = xr.Dataset(
+        {var: ds[var] for var in ds.data_vars if "lev" not in ds[var].dims}
+    )
+    ds = ds.drop_vars(list(ds_2d.data_vars))
+
+    if engine == "batched":
+        ds_regridded = _vertical_regrid_batched(ds, target_depth_bounds, ds["dz"])
+    elif engine == "zstar":
+        stretch = (ds_raw.deptho + ds_raw.zos) / ds_raw.deptho
+        ds_regridded = _vertical_regrid_batched(
+            ds, target_depth_bounds, ds["thkcello"], stretch=stretch
+        )
+    elif engine == "xgcm":
+        ds_regridded = _vertical_regrid_xgcm(ds, grid, target_depth_bounds)
+    else:
+        raise ValueError(
+            f"Unknown engine {engine}. Choose from ['batched', 'zstar', 'xgcm']"
+        )
 
     # Calculate the cell thickness of the target grid.
     dz_regridded = xr.DataArray(
         np.diff(target_depth_bounds),
         dims=["lev"],
-        coords={"lev": ds_extensive_regridded.thetao.lev},
+        coords={"lev": ds_regridded.lev},
     )
 
-    ds_regridded = ds_extensive_regridded / dz_regridded
     ds_regridded = ds_regridded.assign_coords(dz=dz_regridded)
     for co_name, co in ds.coords.items():
         if "lev" not in co.dims:
@@ -320,8 +908,10 @@ def vertical_regrid(ds_raw: xr.Dataset, target_depth_bounds: np.ndarray) -> xr.D
 # - What about the coordinates after? Are the non-depth ones the same (not weirdly scaled?).
 
 
+@instrumented
 def cmip_bounds_to_xesmf(ds: xr.Dataset, order=None):
     # the order is specific to the way I reorganized vertex order in xmip (if not passed we get the stripes in the regridded output!
+    import cf_xarray
 
     if not all(var in ds.variables for var in ["lon_b", "lat_b"]):
         ds = ds.assign_coords(
@@ -335,57 +925,606 @@ def cmip_bounds_to_xesmf(ds: xr.Dataset, order=None):
     return ds
 
 
-def test_vertex_order(ds):
-    # pick a point in the southern hemisphere to avoid curving nonsense
-    p = {"x": slice(20, 22), "y": slice(20, 22)}
-    ds_p = ds.isel(**p).squeeze()
-    # get rid of all the unneccesary variables
-    for var in ds_p.variables:
-        if (
-            ("lev" in ds_p[var].dims)
-            or ("time" in ds_p[var].dims)
-            or (var in ["sub_experiment_label", "variant_label"])
-        ):
-            ds_p = ds_p.drop_vars(var)
-    ds_p = cmip_bounds_to_xesmf(
-        ds_p, order=None
-    )  # woudld be nice if this could automatically get the settings provided to `cmip_bounds_to_xesmf`
-    ds_p = ds_p.load().transpose(..., "x", "y", "vertex")
-    if (
-        not (ds_p.lon_b.diff("x_vertices") > 0).all()
-        and (ds_p.lat_b.diff("y_vertices") > 0).all()
+# bit flags of `bounds_error_mask`
+BOUNDS_ERROR_FLAGS = {
+    "nonfinite": 1,
+    "vertex_order": 2,
+    "orientation": 4,
+    "degenerate": 8,
+    "overlap": 16,
+}
+
+
+def _to_cartesian(lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+    lon, lat = np.deg2rad(lon), np.deg2rad(lat)
+    return np.stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1
+    )
+
+
+def _edge_side(edge_start, edge_end, points):
+    """Side of the great circle through an edge that `points` are on (+1/-1, 0 on it)"""
+    return np.sign(np.einsum("...i,...i->...", np.cross(edge_start, edge_end), points))
+
+
+@instrumented
+def bounds_error_mask(ds: xr.Dataset, rtol: float = 1e-8) -> xr.DataArray:
+    """Check the cell bounds of the whole grid in a single vectorized pass and return
+    a per-cell mask of bit flags (see `BOUNDS_ERROR_FLAGS`, 0 for valid cells):
+
+    - `nonfinite`: a vertex is nan or infinite
+    - `vertex_order`: the vertices do not go around the cell (e.g. a "bow tie" from a
+      wrong `order` in `cmip_bounds_to_xesmf`)
+    - `orientation`: the cell is clockwise (longitude not increasing along x or
+      latitude not increasing along y)
+    - `degenerate`: the cell area is zero (relative to the median area by `rtol`)
+    - `overlap`: the cell overlaps a neighbouring cell
+
+    Only the cell bounds (`lon_b`/`lat_b`, see `cmip_bounds_to_xesmf`) are loaded.
+    """
+    ds = cmip_bounds_to_xesmf(ds)
+    dims = ds.lon_b.dims
+    x_dim = next((di for di in dims if di.startswith("x")), dims[-1])
+    y_dim = next(di for di in dims if di != x_dim)
+    vertices = _to_cartesian(
+        ds.lon_b.transpose(y_dim, x_dim).values,
+        ds.lat_b.transpose(y_dim, x_dim).values,
+    )
+    # corners of every cell, counterclockwise for increasing lon (x) and lat (y)
+    corners = np.stack(
+        [vertices[:-1, :-1], vertices[:-1, 1:], vertices[1:, 1:], vertices[1:, :-1]]
+    )
+    center = corners.sum(axis=0)
+    with np.errstate(invalid="ignore"):
+        nonfinite = ~np.isfinite(corners).all(axis=(0, -1))
+        # signed area (projected onto the tangent plane at the cell center)
+        area = np.einsum(
+            "...i,...i->...",
+            np.cross(corners[2] - corners[0], corners[3] - corners[1]),
+            center,
+        )
+        tolerance = rtol * np.nanmedian(np.abs(area))
+        # direction of the turn at every corner, all turns of a proper cell have
+        # the same sign (turns at collapsed vertices, e.g. at the poles, are ignored)
+        turns = np.einsum(
+            "k...i,...i->k...",
+            np.cross(
+                corners - np.roll(corners, 1, axis=0),
+                np.roll(corners, -1, axis=0) - corners,
+            ),
+            center,
+        )
+        vertex_order = (turns > tolerance).any(axis=0) & (turns < -tolerance).any(
+            axis=0
+        )
+        degenerate = ~nonfinite & ~(np.abs(area) > tolerance)
+        orientation = area < -tolerance
+
+        # neighbouring cells have to be on opposite sides of their shared edge
+        overlap = np.zeros(area.shape, dtype=bool)
+        for axis, (edge_start, edge_end) in [(1, (1, 2)), (0, (3, 2))]:
+            n = area.shape[axis] - 1
+            own = _edge_side(corners[edge_start], corners[edge_end], center).take(
+                range(n), axis=axis
+            )
+            neighbour = _edge_side(
+                corners[edge_start].take(range(n), axis=axis),
+                corners[edge_end].take(range(n), axis=axis),
+                center.take(range(1, n + 1), axis=axis),
+            )
+            same_side = own * neighbour > 0
+            index = [slice(None), slice(None)]
+            index[axis] = slice(0, n)
+            overlap[tuple(index)] |= same_side
+            index[axis] = slice(1, n + 1)
+            overlap[tuple(index)] |= same_side
+
+    mask = np.zeros(area.shape, dtype=np.uint8)
+    for name, error in [
+        ("nonfinite", nonfinite),
+        ("vertex_order", vertex_order),
+        ("orientation", orientation),
+        ("degenerate", degenerate),
+        ("overlap", overlap),
+    ]:
+        mask[error] |= BOUNDS_ERROR_FLAGS[name]
+    return xr.DataArray(
+        mask,
+        dims=["y", "x"],
+        name="bounds_error",
+        attrs={
+            "flag_masks": list(BOUNDS_ERROR_FLAGS.values()),
+            "flag_meanings": " ".join(BOUNDS_ERROR_FLAGS),
+        },
+    )
+
+
+@instrumented
+def test_vertex_order(ds: xr.Dataset, n_offending: int = 5):
+    """Raise if any cell of the grid fails `bounds_error_mask`, listing the number
+    of cells and up to `n_offending` example cells for every error"""
+    mask = bounds_error_mask(ds).values
+    errors = []
+    for name, flag in BOUNDS_ERROR_FLAGS.items():
+        y, x = np.nonzero(mask & flag)
+        if len(x) > 0:
+            cells = [{"x": int(i), "y": int(j)} for i, j in zip(x, y)][:n_offending]
+            errors.append(f"{name}: {len(x)} cells (e.g. {cells})")
+    if len(errors) > 0:
+        raise ValueError(f"Invalid cell bounds ({'; '.join(errors)})")
+
+
+# in-memory LRU caches of xesmf regridders and sparse operators (one per backend, so
+# they do not evict each other), keyed by `regrid_weights_key`
+_REGRIDDER_CACHE = OrderedDict()
+_HORIZONTAL_OPERATOR_CACHE = OrderedDict()
+REGRIDDER_CACHE_SIZE = 8
+
+
+def _cached(cache: OrderedDict, key: str, build):
+    """Get `key` from the LRU `cache`, or add the result of `build()` and evict the
+    least recently used entries beyond `REGRIDDER_CACHE_SIZE`"""
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    value = build()
+    cache[key] = value
+    while len(cache) > REGRIDDER_CACHE_SIZE:
+        cache.popitem(last=False)
+    return value
+
+
+def _weights_file(weights_dir: Optional[str], method: str, key: str) -> Optional[str]:
+    """Path of the weights file in `weights_dir`, if it exists"""
+    if weights_dir is None:
+        return None
+    path = os.path.join(weights_dir, f"{method}_{key}.nc")
+    return path if os.path.exists(path) else None
+
+
+@instrumented
+def regrid_weights_key(
+    ds_source: xr.Dataset, ds_target: xr.Dataset, method: str
+) -> str:
+    """Hash of the source and target cell bounds (`lon_b`/`lat_b`) and the regridding method"""
+    key = hashlib.sha256(method.encode())
+    for ds in [ds_source, ds_target]:
+        ds = cmip_bounds_to_xesmf(ds)
+        for var in ["lon_b", "lat_b"]:
+            bounds = np.ascontiguousarray(ds[var].values, dtype=np.float64)
+            key.update(str(ds[var].dims).encode())
+            key.update(str(bounds.shape).encode())
+            key.update(bounds.tobytes())
+    return key.hexdigest()
+
+
+@instrumented
+def get_regridder(
+    ds_source: xr.Dataset,
+    ds_target: xr.Dataset,
+    method: str = "conservative",
+    weights_dir: Optional[str] = None,
+):
+    """Get an xesmf regridder, reusing previously computed weights.
+    Regridders are kept in an in-memory LRU cache and (if `weights_dir` is given) the weights
+    are stored as netcdf files, which can be shared between processes and later runs."""
+    try:
+        import xesmf as xe  # type: ignore
+    except ImportError:
+        raise ImportError(
+            "The spatial regridding requires xesmf. Install using `conda install xesmf`."
+        )
+    ds_source = cmip_bounds_to_xesmf(ds_source)
+    ds_target = cmip_bounds_to_xesmf(ds_target)
+    key = regrid_weights_key(ds_source, ds_target, method)
+
+    def _build():
+        regridder_kwargs = dict(
+            ignore_degenerate=True, unmapped_to_nan=True, periodic=True
+        )
+        weights_file = _weights_file(weights_dir, method, key)
+        if weights_file is not None:
+            return xe.Regridder(
+                ds_source, ds_target, method, weights=weights_file, **regridder_kwargs
+            )
+        regridder = xe.Regridder(ds_source, ds_target, method, **regridder_kwargs)
+        if weights_dir is not None:
+            os.makedirs(weights_dir, exist_ok=True)
+            weights_file = os.path.join(weights_dir, f"{method}_{key}.nc")
+            # write to a temporary file first, so that concurrent workers never read partial files
+            tmp_file = f"{weights_file}.{os.getpid()}.tmp"
+            regridder.to_netcdf(tmp_file)
+            os.replace(tmp_file, weights_file)
+        return regridder
+
+    return _cached(_REGRIDDER_CACHE, key, _build)
+
+
+def _horizontal_grid(ds: xr.Dataset) -> tuple:
+    """Horizontal dimensions and shape of a grid (in the order used by xesmf)"""
+    if ds["lon"].ndim == 2:
+        return ds["lon"].dims, ds["lon"].shape
+    return (ds["lat"].dims[0], ds["lon"].dims[0]), (ds["lat"].size, ds["lon"].size)
+
+
+def _horizontal_coords(ds: xr.Dataset, dims: tuple) -> dict:
+    return {
+        name: ds[name]
+        for name in ["lon", "lat"]
+        if name in ds.variables and set(ds[name].dims).issubset(dims)
+    }
+
+
+class HorizontalRemapOperator:
+    """Precomputed horizontal regridding operator (sparse weights, e.g. of an xesmf
+    regridder) between the horizontal dimensions `dims_in` and `dims_out`.
+
+    Fields are flattened over the horizontal dimensions (the last axes), and all other
+    axes (e.g. time and lev) are stacked into the columns of a single CSR matmul, which
+    can be split over `n_threads`. Nans are handled as in xesmf: target cells without
+    any source cells are nan (`unmapped_to_nan`), and target cells touching a nan source
+    cell are nan, unless `skipna`, which renormalizes by the weights of the valid
+    source cells (e.g. for masks that change with depth) and only sets cells with a
+    valid fraction below `1 - na_thres` to nan.
+    """
+
+    def __init__(
+        self,
+        weights,
+        dims_in: tuple,
+        shape_in: tuple,
+        dims_out: tuple,
+        shape_out: tuple,
+        coords_out: Optional[dict] = None,
     ):
-        raise ValueError("Test vertices not strictly monotinically increasing")
+        import scipy.sparse
 
+        self.weights = scipy.sparse.csr_matrix(weights, dtype=np.float64)
+        self.touches = (self.weights != 0).astype(np.float64)
+        self.unmapped = self.weights.getnnz(axis=1) == 0
+        self.dims_in = tuple(dims_in)
+        self.shape_in = tuple(shape_in)
+        self.dims_out = tuple(dims_out)
+        self.shape_out = tuple(shape_out)
+        self.coords_out = coords_out or {}
+        # row blocks of the matrices for every number of threads
+        self._row_blocks = {}
 
-def spatially_regrid(
+    @classmethod
+    def from_regridder(
+        cls, regridder, ds_target: Optional[xr.Dataset] = None
+    ) -> "HorizontalRemapOperator":
+        """Operator with the weights of an xesmf regridder (and the lon/lat coordinates
+        of `ds_target`)"""
+        coords_out = {}
+        if ds_target is not None:
+            coords_out = _horizontal_coords(ds_target, regridder.out_horiz_dims)
+        return cls(
+            regridder.weights.data.to_scipy_sparse(),
+            regridder.in_horiz_dims,
+            regridder.shape_in,
+            regridder.out_horiz_dims,
+            regridder.shape_out,
+            coords_out=coords_out,
+        )
+
+    @classmethod
+    def from_weights_file(
+        cls, path: str, ds_source: xr.Dataset, ds_target: xr.Dataset
+    ) -> "HorizontalRemapOperator":
+        """Operator with the weights of an xesmf weight file (`S`, `row` and `col` in
+        the ESMF format), without xesmf. The grid dimensions are taken from the `lon`
+        and `lat` coordinates of `ds_source` and `ds_target`."""
+        import scipy.sparse
+
+        dims_in, shape_in = _horizontal_grid(ds_source)
+        dims_out, shape_out = _horizontal_grid(ds_target)
+        with xr.open_dataset(path) as ds_weights:
+            values = ds_weights["S"].values
+            # ESMF indices start at 1
+            rows = ds_weights["row"].values.astype(np.int64) - 1
+            cols = ds_weights["col"].values.astype(np.int64) - 1
+        shape = (int(np.prod(shape_out)), int(np.prod(shape_in)))
+        if len(values) > 0 and (rows.max() >= shape[0] or cols.max() >= shape[1]):
+            raise ValueError(
+                f"Weights in {path} do not match the source grid {dict(zip(dims_in, shape_in))} "
+                f"and target grid {dict(zip(dims_out, shape_out))}"
+            )
+        weights = scipy.sparse.coo_matrix((values, (rows, cols)), shape=shape)
+        return cls(
+            weights,
+            dims_in,
+            shape_in,
+            dims_out,
+            shape_out,
+            coords_out=_horizontal_coords(ds_target, dims_out),
+        )
+
+    def _matmul(self, name: str, columns: np.ndarray, n_threads: int) -> np.ndarray:
+        matrix = getattr(self, name)
+        if n_threads <= 1:
+            return matrix @ columns
+        if (name, n_threads) not in self._row_blocks:
+            bounds = np.linspace(0, matrix.shape[0], n_threads + 1).astype(int)
+            self._row_blocks[(name, n_threads)] = [
+                (slice(a, b), matrix[a:b]) for a, b in zip(bounds[:-1], bounds[1:])
+            ]
+        result = np.empty((matrix.shape[0], columns.shape[1]))
+
+        def _rows(block):
+            rows, rows_matrix = block
+            result[rows] = rows_matrix @ columns
+
+        # the sparse matmul releases the GIL
+        with ThreadPoolExecutor(n_threads) as executor:
+            list(executor.map(_rows, self._row_blocks[(name, n_threads)]))
+        return result
+
+    def __call__(
+        self,
+        data: np.ndarray,
+        skipna: bool = False,
+        na_thres: float = 1.0,
+        n_threads: int = 1,
+    ) -> np.ndarray:
+        """Regrid `data` with the source horizontal dimensions as the last axes"""
+        shape = data.shape[: data.ndim - len(self.shape_in)]
+        dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.float64
+        columns = data.reshape(-1, self.weights.shape[1]).T
+        valid = ~np.isnan(columns)
+        regridded = self._matmul("weights", np.where(valid, columns, 0), n_threads)
+        if skipna:
+            valid_weight = self._matmul("weights", valid.astype(np.float64), n_threads)
+            tolerance = 1e-6
+            nans = valid_weight < np.clip(1 - na_thres, tolerance, 1 - tolerance)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                regridded = regridded / valid_weight
+        elif valid.all():
+            nans = np.zeros(regridded.shape, dtype=bool)
+        else:
+            invalid = (~valid).astype(np.float64)
+            nans = self._matmul("touches", invalid, n_threads) > 0
+        regridded[nans | self.unmapped[:, None]] = np.nan
+        return regridded.T.reshape(shape + self.shape_out).astype(dtype, copy=False)
+
+
+@instrumented
+def get_horizontal_operator(
     ds_source: xr.Dataset,
     ds_target: xr.Dataset,
     method: str = "conservative",
+    weights_dir: Optional[str] = None,
+) -> HorizontalRemapOperator:
+    """Sparse regridding operator between the grids of `ds_source` and `ds_target`.
+    Weights are loaded from `weights_dir` if they were computed before (see
+    `get_regridder`), which does not require xesmf, and computed with xesmf otherwise."""
+    key = regrid_weights_key(ds_source, ds_target, method)
+
+    def _build():
+        weights_file = _weights_file(weights_dir, method, key)
+        if weights_file is not None:
+            return HorizontalRemapOperator.from_weights_file(
+                weights_file, ds_source, ds_target
+            )
+        regridder = get_regridder(ds_source, ds_target, method, weights_dir=weights_dir)
+        return HorizontalRemapOperator.from_regridder(regridder, ds_target)
+
+    return _cached(_HORIZONTAL_OPERATOR_CACHE, key, _build)
+
+
+def _merge_unregridded(
+    ds_regridded: xr.Dataset, ds: xr.Dataset, dims: list
+) -> xr.Dataset:
+    """Add the coordinates and variables of `ds` without any of `dims`"""
+    for name, da in ds.variables.items():
+        if not set(dims) & set(da.dims) and name not in ds_regridded:
+            if name in ds.coords:
+                ds_regridded = ds_regridded.assign_coords({name: da})
+            else:
+                ds_regridded[name] = da
+    ds_regridded.attrs = ds.attrs
+    return ds_regridded
+
+
+def _sparse_regrid(
+    ds: xr.Dataset, operator: HorizontalRemapOperator, **kwargs
+) -> xr.Dataset:
+    dims_in = list(operator.dims_in)
+    # temporary names, the target dimensions can have the same names as the source
+    dims_out = [f"{di}_target" for di in operator.dims_out]
+    ds_regridded = xr.Dataset()
+    for var in ds.data_vars:
+        if not set(dims_in).issubset(ds[var].dims):
+            continue
+        dtype = ds[var].dtype
+        ds_regridded[var] = xr.apply_ufunc(
+            operator,
+            ds[var].reset_coords(drop=True),
+            kwargs=kwargs,
+            input_core_dims=[dims_in],
+            output_core_dims=[dims_out],
+            dask="parallelized",
+            output_dtypes=[dtype if np.issubdtype(dtype, np.floating) else np.float64],
+            dask_gufunc_kwargs={
+                "output_sizes": dict(zip(dims_out, operator.shape_out))
+            },
+            keep_attrs=True,
+        )
+    ds_regridded = ds_regridded.rename(dict(zip(dims_out, operator.dims_out)))
+    ds_regridded = ds_regridded.assign_coords(operator.coords_out)
+    return _merge_unregridded(ds_regridded, ds, dims_in)
+
+
+@instrumented
+def spatially_regrid(
+    ds_source: xr.Dataset,
+    ds_target: Union[xr.Dataset, str],
+    method: str = "conservative",
     check=False,
+    weights_dir: Optional[str] = None,
+    backend: str = "xesmf",
+    skipna: bool = False,
+    na_thres: float = 1.0,
+    n_threads: int = 1,
 ) -> xr.Dataset:
+    """Horizontally regrid `ds_source` onto the grid of `ds_target` (a dataset or the id
+    of a grid in the local grid registry, see `grids.register_grid`).
+    Regridding weights are cached in memory and (optionally) as files in `weights_dir`
+    (see `get_regridder`). With `check`, the cell bounds of both grids are validated
+    (see `bounds_error_mask`) before any weights are computed.
+    `backend` can be "xesmf" or "sparse", which applies the weights with scipy (see
+    `HorizontalRemapOperator`) on `n_threads` and only needs xesmf if the weights are
+    not in `weights_dir` yet. `skipna` and `na_thres` are passed to the regridder."""
+    if isinstance(ds_target, str):
+        ds_target = load_grid(ds_target)
     if check:
-        for test_ds, name in [
-            (ds_source, "source dataset"),
-            (ds_target, "target dataset"),
-        ]:
-            try:
-                test_vertex_order(test_ds)
-            except ValueError:
-                raise ValueError(
-                    f"something is wrong with the vertex order of the {name}"
-                )
-    if xe is None:
-        raise ImportError(
-            "The spatial regridding requires xesmf. Install using `conda install xesmf`."
+        _check_bounds(ds_source, ds_target)
+    if backend == "xesmf":
+        regridder = get_regridder(ds_source, ds_target, method, weights_dir=weights_dir)
+        return regridder(ds_source, skipna=skipna, na_thres=na_thres)
+    elif backend == "sparse":
+        operator = get_horizontal_operator(
+            ds_source, ds_target, method, weights_dir=weights_dir
         )
+        return _sparse_regrid(
+            ds_source, operator, skipna=skipna, na_thres=na_thres, n_threads=n_threads
+        )
+    else:
+        raise ValueError(f"Unknown backend {backend}. Choose from ['xesmf', 'sparse']")
+
+
+def _check_bounds(ds_source: xr.Dataset, ds_target: xr.Dataset):
+    for test_ds, name in [
+        (ds_source, "source dataset"),
+        (ds_target, "target dataset"),
+    ]:
+        try:
+            test_vertex_order(test_ds)
+        except ValueError as e:
+            raise ValueError(
+                f"something is wrong with the vertex order of the {name}: {e}"
+            )
+
 
-    regridder = xe.Regridder(
-        cmip_bounds_to_xesmf(ds_source),
-        cmip_bounds_to_xesmf(ds_target),
-        method,
-        ignore_degenerate=True,
-        unmapped_to_nan=True,
-        periodic=True,
+def _regrid_3d_kernel(
+    thickness, stretch, *data, n_3d: int, vertical, horizontal, n_horizontal: int
+):
+    """Vertically and horizontally regrid all variables of a single block. The first
+    `n_3d` variables have `lev` before the horizontal dimensions (the last axes)."""
+    results = []
+    if n_3d > 0:
+        # move lev to the last axis for the vertical operator
+        stacked = np.moveaxis(
+            np.stack(np.broadcast_arrays(*data[:n_3d])), -n_horizontal - 1, -1
+        )
+        regridded = vertical(
+            stacked, np.moveaxis(thickness, -n_horizontal - 1, -1), stretch
+        )
+        results.extend(horizontal(np.moveaxis(regridded, -1, -n_horizontal - 1)))
+    results.extend(horizontal(da) for da in data[n_3d:])
+    # apply_ufunc expects a single array for a single output
+    return results[0] if len(results) == 1 else tuple(results)
+
+
+@instrumented
+def regrid_3d(
+    ds_raw: xr.Dataset,
+    ds_target: Union[xr.Dataset, str],
+    target_depth_bounds: np.ndarray,
+    method: str = "conservative",
+    engine: str = "batched",
+    check: bool = False,
+    weights_dir: Optional[str] = None,
+    time_chunk: Optional[int] = None,
+    horizontal: Optional["HorizontalRemapOperator"] = None,
+) -> xr.Dataset:
+    """Vertical (see `vertical_regrid`) and horizontal (see `spatially_regrid`)
+    regridding in a single blockwise pass.
+
+    Both operators are precomputed (the horizontal weights with `get_horizontal_operator`
+    unless a `horizontal` operator is given) and applied to all variables of a block
+    of `time_chunk` time steps (defaults to the dask chunks) at once, so no intermediate
+    dataset is created. The result is lazy and is written block by block with e.g.
+    `to_zarr`. `engine` can be "batched" (uses `dz`, see
+    `infer_vertical_cell_extent`) or "zstar" (uses `thkcello` and rescales with
+    `(deptho + zos) / deptho`).
+    """
+    import cf_xarray
+
+    if isinstance(ds_target, str):
+        ds_target = load_grid(ds_target)
+    if horizontal is None:
+        if check:
+            _check_bounds(ds_raw, ds_target)
+        horizontal = get_horizontal_operator(
+            ds_raw, ds_target, method, weights_dir=weights_dir
+        )
+    if time_chunk is not None:
+        ds_raw = ds_raw.chunk({"time": time_chunk})
+
+    lev_outer = cf_xarray.bounds_to_vertices(ds_raw["lev_bounds"], "bnds")
+    vertical = VerticalRemapOperator(lev_outer.values, target_depth_bounds)
+    if engine == "batched":
+        thickness, stretch = ds_raw["dz"], xr.DataArray(1.0)
+    elif engine == "zstar":
+        thickness = ds_raw["thkcello"]
+        stretch = (ds_raw.deptho + ds_raw.zos) / ds_raw.deptho
+    else:
+        raise ValueError(f"Unknown engine {engine}. Choose from ['batched', 'zstar']")
+
+    dims_in = list(horizontal.dims_in)
+    # temporary names, the target dimensions can have the same names as the source
+    dims_out = [f"{di}_target" for di in horizontal.dims_out]
+    variables = [
+        var for var in ds_raw.data_vars if set(dims_in).issubset(ds_raw[var].dims)
+    ]
+    variables_3d = [var for var in variables if "lev" in ds_raw[var].dims]
+    variables = variables_3d + [var for var in variables if var not in variables_3d]
+    dtype = np.result_type(*[ds_raw[var].dtype for var in variables], thickness.dtype)
+
+    regridded = xr.apply_ufunc(
+        _regrid_3d_kernel,
+        thickness.reset_coords(drop=True),
+        stretch.reset_coords(drop=True),
+        *[ds_raw[var].reset_coords(drop=True) for var in variables],
+        kwargs={
+            "n_3d": len(variables_3d),
+            "vertical": vertical,
+            "horizontal": horizontal,
+            "n_horizontal": len(dims_in),
+        },
+        input_core_dims=[
+            ["lev"] + dims_in,
+            [di for di in dims_in if di in stretch.dims],
+        ]
+        + [["lev"] + dims_in] * len(variables_3d)
+        + [dims_in] * (len(variables) - len(variables_3d)),
+        output_core_dims=[["lev_target"] + dims_out] * len(variables_3d)
+        + [dims_out] * (len(variables) - len(variables_3d)),
+        dask="parallelized",
+        output_dtypes=[dtype] * len(variables),
+        dask_gufunc_kwargs={
+            "output_sizes": {
+                "lev_target": vertical.n_target,
+                **dict(zip(dims_out, horizontal.shape_out)),
+            }
+        },
+        # `keep_attrs=True` would copy the attrs of the first input (the thickness)
+        keep_attrs=False,
+    )
+    if len(variables) == 1:
+        regridded = (regridded,)
+    ds_regridded = xr.Dataset(
+        {
+            var: da.assign_attrs(ds_raw[var].attrs)
+            for var, da in zip(variables, regridded)
+        }
+    )
+    ds_regridded = ds_regridded.rename(
+        {"lev_target": "lev", **dict(zip(dims_out, horizontal.dims_out))}
+    )
+    lev = (target_depth_bounds[1:] + target_depth_bounds[:-1]) / 2
+    ds_regridded = ds_regridded.assign_coords(
+        lev=lev, dz=("lev", np.diff(target_depth_bounds)), **horizontal.coords_out
     )
-    return regridder(ds_source)
+    return _merge_unregridded(ds_regridded, ds_raw, ["lev"] + dims_in)
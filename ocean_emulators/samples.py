@@ -0,0 +1,177 @@
+"""Convert standardized input datasets into contiguous training samples"""
+
+import json
+import os
+from typing import Optional
+import numpy as np
+import xarray as xr
+from ocean_emulators.channels import ChannelLayout
+from ocean_emulators.preprocessing import INPUT_VARIABLES, input_data_test
+
+SAMPLE_DIMS = ["time", "var", "y", "x"]
+SAMPLES_NPY = "samples.npy"
+SAMPLES_ZARR = "samples.zarr"
+SAMPLES_METADATA = "samples.json"
+
+
+def channel_mask(ds: xr.Dataset, layout: ChannelLayout) -> np.ndarray:
+    """Boolean (var, y, x) wetmask for every channel of `layout`"""
+    wetmask = ds.wetmask.reset_coords(drop=True)
+    ds_mask = xr.Dataset(
+        {
+            name: wetmask if n_lev is not None else wetmask.isel(lev=0, drop=True)
+            for name, n_lev in layout.variables
+        }
+    )
+    return layout.pack(ds_mask).transpose(*SAMPLE_DIMS[1:]).values.astype(bool)
+
+
+def normalize(ds: xr.Dataset, variables: list) -> xr.Dataset:
+    """Normalize `variables` with their stored `{var}_mean`/`{var}_std` fields"""
+    return xr.Dataset(
+        {var: (ds[var] - ds[f"{var}_mean"]) / ds[f"{var}_std"] for var in variables}
+    )
+
+
+def _fill_dry_cells(block: np.ndarray, mask: np.ndarray, fill_value: float):
+    block = np.ascontiguousarray(block, dtype=np.float32)
+    np.copyto(block, np.float32(fill_value), where=~mask)
+    return block
+
+
+def pack_samples(
+    ds: xr.Dataset,
+    path: str,
+    layout: Optional[ChannelLayout] = None,
+    format: str = "npy",
+    fill_value: float = 0.0,
+    time_chunk: int = 1,
+) -> ChannelLayout:
+    """Normalize a standardized input dataset and write it as contiguous float32
+    (time, var, y, x) samples into the directory `path`.
+
+    `format="npy"` writes a single memory-mappable `.npy` file, `format="zarr"` writes
+    zarr with one sample per chunk. The wetmask is applied once (dry cells are set to
+    `fill_value`) and the channel `layout` (default: all input variables) and time
+    values are stored in a json sidecar file.
+    """
+    input_data_test(ds, deep=False)
+    if format not in ["npy", "zarr"]:
+        raise ValueError(f"Unknown format {format}. Choose from ['npy', 'zarr']")
+    if layout is None:
+        layout = ChannelLayout.from_dataset(ds, INPUT_VARIABLES)
+    variables = [name for name, _ in layout.variables]
+
+    samples = layout.pack(normalize(ds, variables).reset_coords(drop=True))
+    samples = samples.transpose(*SAMPLE_DIMS)
+    if samples.chunks is not None:
+        samples = samples.chunk({"time": time_chunk, "var": -1, "y": -1, "x": -1})
+    mask = channel_mask(ds, layout)
+    samples = xr.apply_ufunc(
+        _fill_dry_cells,
+        samples,
+        kwargs={"mask": mask, "fill_value": fill_value},
+        dask="parallelized",
+        output_dtypes=[np.float32],
+        keep_attrs=True,
+    )
+
+    os.makedirs(path, exist_ok=True)
+    if format == "npy":
+        out = np.lib.format.open_memmap(
+            os.path.join(path, SAMPLES_NPY),
+            mode="w+",
+            dtype=np.float32,
+            shape=samples.shape,
+        )
+        if samples.chunks is not None:
+            import dask.array as dsa
+
+            dsa.store(samples.data, out, lock=False)
+        else:
+            for start in range(0, samples.sizes["time"], time_chunk):
+                region = slice(start, start + time_chunk)
+                out[region] = samples.isel(time=region).values
+        out.flush()
+        # fixed-stride layout, so that the file can also be read without numpy
+        storage = {"offset": int(out.offset), "sample_nbytes": int(out[0].nbytes)}
+        del out
+    else:
+        storage = {}
+        samples = samples.chunk({"time": 1, "var": -1, "y": -1, "x": -1})
+        samples.to_dataset(name="samples").to_zarr(
+            os.path.join(path, SAMPLES_ZARR), mode="w"
+        )
+
+    metadata = {
+        "format": format,
+        "dims": SAMPLE_DIMS,
+        "shape": list(samples.shape),
+        "dtype": "float32",
+        "fill_value": fill_value,
+        "layout": layout.variables,
+        "time": [str(t) for t in ds.time.values],
+        "attrs": {k: str(v) for k, v in ds.attrs.items()},
+        **storage,
+    }
+    with open(os.path.join(path, SAMPLES_METADATA), "w") as f:
+        json.dump(metadata, f)
+    return layout
+
+
+class SampleStore:
+    """Random access reader for samples written with `pack_samples(..., format="npy")`.
+
+    The samples are memory-mapped (opened lazily in every process, so a store can be
+    passed to data loader worker processes) and all accessors return views into the
+    memory map without copying.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, SAMPLES_METADATA)) as f:
+            self.metadata = json.load(f)
+        if self.metadata["format"] != "npy":
+            raise ValueError(
+                f"SampleStore requires samples in `npy` format, got {self.metadata['format']}"
+            )
+        self.layout = ChannelLayout(self.metadata["layout"])
+        self.time = np.array(self.metadata["time"])
+        self._time_index = {t: i for i, t in enumerate(self.metadata["time"])}
+        self._array = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_array"] = None
+        return state
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    @property
+    def array(self) -> np.ndarray:
+        """Memory-mapped (time, var, y, x) array (reopened after a process fork)"""
+        if self._array is None or self._pid != os.getpid():
+            self._array = np.load(os.path.join(self.path, SAMPLES_NPY), mmap_mode="r")
+            self._pid = os.getpid()
+        return self._array
+
+    def time_index(self, times) -> np.ndarray:
+        """Integer indices for time values (as stored in the metadata)"""
+        return np.array([self._time_index[str(t)] for t in np.atleast_1d(times)])
+
+    def sample(self, index: int) -> np.ndarray:
+        return self.array[index]
+
+    def samples(self, indices) -> list:
+        """List of (var, y, x) views for a batch of time indices"""
+        array = self.array
+        return [array[i] for i in indices]
+
+    def pairs(self, indices, lag: int = 1) -> list:
+        """List of (2, var, y, x) views of the samples at (t, t + lag) for every index t"""
+        array = self.array
+        if max(indices) + lag >= len(self):
+            raise IndexError(f"Pairs with lag {lag} exceed the {len(self)} samples")
+        return [array[i : i + lag + 1 : lag] for i in indices]
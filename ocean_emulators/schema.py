@@ -0,0 +1,94 @@
+"""Dataset metadata (names, dimensions, sizes, dtypes, chunks, attributes) without array data"""
+
+from typing import Union
+import numpy as np
+import xarray as xr
+
+# attributes used by xarray to encode variables in zarr stores
+_ENCODING_ATTRS = ["_ARRAY_DIMENSIONS", "_FillValue", "coordinates"]
+
+
+class DatasetSchema:
+    """Metadata of a dataset, built from an `xr.Dataset` or directly from the
+    (consolidated) metadata of a zarr store without reading any array data.
+
+    `variables` maps every variable name to a dict with `dims`, `shape`, `dtype`,
+    `chunks` (chunk size along every dimension, None if not chunked) and `attrs`.
+    """
+
+    def __init__(self, variables: dict, coords: set, attrs: dict):
+        self.variables = variables
+        self.coords = set(coords)
+        self.attrs = attrs
+
+    def __getitem__(self, name: str) -> dict:
+        return self.variables[name]
+
+    @property
+    def data_vars(self) -> list:
+        return [name for name in self.variables if name not in self.coords]
+
+    @property
+    def dims(self) -> list:
+        dims = []
+        for variable in self.variables.values():
+            dims.extend(di for di in variable["dims"] if di not in dims)
+        return dims
+
+    @property
+    def sizes(self) -> dict:
+        sizes = {}
+        for variable in self.variables.values():
+            sizes.update(zip(variable["dims"], variable["shape"]))
+        return sizes
+
+    @classmethod
+    def from_dataset(cls, ds: xr.Dataset) -> "DatasetSchema":
+        variables = {}
+        for name, var in ds.variables.items():
+            chunks = None if var.chunks is None else tuple(c[0] for c in var.chunks)
+            variables[name] = {
+                "dims": tuple(var.dims),
+                "shape": tuple(var.shape),
+                "dtype": np.dtype(var.dtype),
+                "chunks": chunks,
+                "attrs": dict(var.attrs),
+            }
+        return cls(variables, set(ds.coords), dict(ds.attrs))
+
+    @classmethod
+    def from_zarr(cls, store) -> "DatasetSchema":
+        """Read the schema of a zarr store written by xarray. Only metadata is read
+        (a single request for stores with consolidated metadata)."""
+        import zarr
+
+        group = zarr.open_group(store, mode="r")
+        variables = {}
+        coords = set()
+        for name, array in group.arrays():
+            attrs = array.attrs.asdict()
+            dims = getattr(array.metadata, "dimension_names", None)
+            if dims is None:
+                dims = attrs.get("_ARRAY_DIMENSIONS", [])
+            coords.update(attrs.get("coordinates", "").split())
+            variables[name] = {
+                "dims": tuple(dims),
+                "shape": tuple(array.shape),
+                "dtype": np.dtype(array.dtype),
+                "chunks": tuple(array.chunks),
+                "attrs": {k: v for k, v in attrs.items() if k not in _ENCODING_ATTRS},
+            }
+        attrs = group.attrs.asdict()
+        coords.update(attrs.pop("coordinates", "").split())
+        # dimension coordinates
+        coords.update(name for name in variables if (name,) == variables[name]["dims"])
+        return cls(variables, coords, attrs)
+
+
+def as_schema(ds: Union[xr.Dataset, DatasetSchema, str]) -> DatasetSchema:
+    """Schema of a dataset, a zarr store (path) or an existing schema"""
+    if isinstance(ds, DatasetSchema):
+        return ds
+    if isinstance(ds, xr.Dataset):
+        return DatasetSchema.from_dataset(ds)
+    return DatasetSchema.from_zarr(ds)
@@ -0,0 +1,122 @@
+"""Single pass (Welford/parallel merge) mean and standard deviation of input variables"""
+
+from typing import Optional
+import numpy as np
+import xarray as xr
+from ocean_emulators.preprocessing import INPUT_VARIABLES, _time_chunk_size
+
+
+def _block_moments(block: np.ndarray):
+    """Count, mean and sum of squared deviations of the non-nan values of every row"""
+    count = np.count_nonzero(~np.isnan(block), axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.nansum(block, axis=1) / count
+    m2 = np.nansum((block - mean[:, None]) ** 2, axis=1)
+    return count, mean, m2
+
+
+def _merge_moments(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    """Merge two sets of moments (Chan et al.)"""
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = mean_a + delta * count_b / count
+        m2 = m2_a + m2_b + delta**2 * count_a * count_b / count
+    # moments without any values do not contribute
+    mean = np.where(count_a == 0, mean_b, np.where(count_b == 0, mean_a, mean))
+    m2 = np.where(count_a == 0, m2_b, np.where(count_b == 0, m2_a, m2))
+    return count, mean, m2
+
+
+def _rows(da: xr.DataArray, per_level: bool) -> np.ndarray:
+    if per_level and "lev" in da.dims:
+        return da.transpose("lev", ...).values.reshape(da.sizes["lev"], -1)
+    return da.values.reshape(1, -1)
+
+
+def compute_moments(
+    ds: xr.Dataset,
+    variables: Optional[list] = None,
+    per_level: bool = False,
+    time_chunk: Optional[int] = None,
+) -> xr.Dataset:
+    """Count, mean and sum of squared deviations (`{var}_count`, `{var}_mean`,
+    `{var}_m2`) of `variables` (default: all input variables) in a single pass.
+
+    All variables are read together in blocks of `time_chunk` time steps (defaults to
+    the dask chunking) and the block moments are merged into running moments, so
+    memory is bounded by a single block. With `per_level`, moments of 3D variables are
+    computed for every level. Moments of different parts of a dataset (e.g. separate
+    files or workers) can be combined with `merge_moments`.
+    """
+    if variables is None:
+        variables = INPUT_VARIABLES
+    step = time_chunk or _time_chunk_size(ds[variables[0]])
+    moments = {}
+    for start in range(0, ds.sizes["time"], step):
+        block = ds[variables].isel(time=slice(start, start + step)).compute()
+        for var in variables:
+            block_moments = _block_moments(_rows(block[var], per_level))
+            if var not in moments:
+                moments[var] = block_moments
+            else:
+                moments[var] = _merge_moments(*moments[var], *block_moments)
+    return _moments_dataset(ds, moments, per_level)
+
+
+def _moments_dataset(ds: xr.Dataset, moments: dict, per_level: bool) -> xr.Dataset:
+    ds_moments = xr.Dataset()
+    for var, values in moments.items():
+        for name, value in zip(["count", "mean", "m2"], values):
+            if per_level and "lev" in ds[var].dims:
+                ds_moments[f"{var}_{name}"] = xr.DataArray(
+                    value, dims=["lev"], coords={"lev": ds.lev.values}
+                )
+            else:
+                ds_moments[f"{var}_{name}"] = xr.DataArray(value[0])
+    return ds_moments
+
+
+def merge_moments(moments: list) -> xr.Dataset:
+    """Merge the results of several `compute_moments` calls"""
+    variables = [
+        v[: -len("_count")] for v in moments[0].data_vars if v.endswith("_count")
+    ]
+    merged = moments[0].copy()
+    for other in moments[1:]:
+        for var in variables:
+            names = [f"{var}_{name}" for name in ["count", "mean", "m2"]]
+            values = _merge_moments(
+                *[merged[n].values for n in names], *[other[n].values for n in names]
+            )
+            for name, value in zip(names, values):
+                merged[name] = merged[name].copy(data=value)
+    return merged
+
+
+def moments_to_statistics(moments: xr.Dataset, ddof: int = 0) -> xr.Dataset:
+    """`{var}_mean` and `{var}_std` fields in the format expected by `input_data_test`"""
+    variables = [v[: -len("_count")] for v in moments.data_vars if v.endswith("_count")]
+    stats = xr.Dataset()
+    for var in variables:
+        stats[f"{var}_mean"] = moments[f"{var}_mean"]
+        stats[f"{var}_std"] = np.sqrt(
+            moments[f"{var}_m2"] / (moments[f"{var}_count"] - ddof)
+        )
+    return stats
+
+
+def attach_statistics(
+    ds: xr.Dataset,
+    variables: Optional[list] = None,
+    per_level: bool = False,
+    time_chunk: Optional[int] = None,
+    moments: Optional[xr.Dataset] = None,
+) -> xr.Dataset:
+    """Add `{var}_mean`/`{var}_std` data variables to `ds`, computed in a single pass
+    (see `compute_moments`) unless precomputed (e.g. merged) `moments` are given."""
+    if moments is None:
+        moments = compute_moments(
+            ds, variables=variables, per_level=per_level, time_chunk=time_chunk
+        )
+    return ds.assign(moments_to_statistics(moments).data_vars)
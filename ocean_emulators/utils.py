@@ -1,4 +1,117 @@
+from typing import Union
+import numpy as np
 import xarray as xr
+from ocean_emulators.instrumentation import instrumented
+
+
+class WetMask:
+    """Compact representation of a wetmask (True or 1 indicates wet cells).
+
+    The mask is stored bit-packed together with the flat indices of the wet cells for
+    the full (3D) mask and its surface (2D) slice. The kernels in `apply` and `match`
+    work directly on numpy/dask blocks and never broadcast the full mask against the data.
+    """
+
+    def __init__(self, mask: xr.DataArray):
+        self.dims = tuple(mask.dims)
+        self.sizes = dict(mask.sizes)
+        self._bits = np.packbits(np.asarray(mask.values, dtype=bool).ravel())
+        self._wet_index = {}
+        # precompute the 3D and 2D indices
+        self.wet_index(self.dims)
+        if "lev" in self.dims:
+            self.wet_index(tuple(di for di in self.dims if di != "lev"))
+
+    @property
+    def shape(self) -> tuple:
+        return tuple(self.sizes[di] for di in self.dims)
+
+    def unpack(self) -> np.ndarray:
+        """Boolean array of the full mask"""
+        n_cells = int(np.prod(self.shape))
+        return np.unpackbits(self._bits, count=n_cells).astype(bool).reshape(self.shape)
+
+    def wet_index(self, dims: tuple) -> np.ndarray:
+        """Flat indices of wet cells for data with (trailing) dimensions `dims`.
+        Mask dimensions missing in `dims` are reduced to their first element."""
+        dims = tuple(dims)
+        if dims not in self._wet_index:
+            if not set(dims).issubset(self.dims):
+                raise ValueError(f"Dimensions {dims} are not a subset of {self.dims}")
+            mask = self.unpack()
+            mask = mask[tuple(slice(None) if di in dims else 0 for di in self.dims)]
+            remaining = [di for di in self.dims if di in dims]
+            mask = mask.transpose([remaining.index(di) for di in dims])
+            index = np.flatnonzero(mask.ravel())
+            self._wet_index[dims] = index.astype(
+                np.int32 if mask.size < np.iinfo(np.int32).max else np.int64
+            )
+        return self._wet_index[dims]
+
+    def core_dims(self, data: xr.DataArray) -> tuple:
+        """Mask dimensions present on `data`, checked for matching sizes"""
+        dims = tuple(di for di in self.dims if di in data.dims)
+        for di in dims:
+            if data.sizes[di] != self.sizes[di]:
+                raise ValueError(
+                    f"Size of dimension {di} does not match between data ({data.sizes[di]}) and mask ({self.sizes[di]})"
+                )
+        return dims
+
+    def apply(self, data: xr.DataArray) -> xr.DataArray:
+        """Set all dry cells of `data` to nan"""
+        dims = self.core_dims(data)
+        if len(dims) == 0:
+            return data
+        dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.float64
+        masked = xr.apply_ufunc(
+            _apply_wet_index,
+            data,
+            kwargs={"wet_index": self.wet_index(dims), "ndim": len(dims)},
+            input_core_dims=[list(dims)],
+            output_core_dims=[list(dims)],
+            dask="parallelized",
+            output_dtypes=[dtype],
+            dask_gufunc_kwargs={"allow_rechunk": True},
+        )
+        return data.copy(data=masked.transpose(*data.dims).data)
+
+    def match(self, data: xr.DataArray) -> bool:
+        """Check that the non-nan values of `data` are exactly the wet cells"""
+        dims = self.core_dims(data)
+        if len(dims) == 0:
+            return True
+        matches = xr.apply_ufunc(
+            _match_wet_index,
+            data,
+            kwargs={"wet_index": self.wet_index(dims), "ndim": len(dims)},
+            input_core_dims=[list(dims)],
+            dask="parallelized",
+            output_dtypes=[bool],
+            dask_gufunc_kwargs={"allow_rechunk": True},
+        )
+        return bool(matches.all())
+
+
+def _flatten_core(block: np.ndarray, ndim: int) -> np.ndarray:
+    n_cells = int(np.prod(block.shape[block.ndim - ndim :]))
+    return block.reshape(-1, n_cells)
+
+
+def _apply_wet_index(block: np.ndarray, wet_index: np.ndarray, ndim: int):
+    flat = _flatten_core(block, ndim)
+    dtype = block.dtype if np.issubdtype(block.dtype, np.floating) else np.float64
+    out = np.full(flat.shape, np.nan, dtype=dtype)
+    out[:, wet_index] = flat[:, wet_index]
+    return out.reshape(block.shape)
+
+
+def _match_wet_index(block: np.ndarray, wet_index: np.ndarray, ndim: int):
+    valid = ~np.isnan(_flatten_core(block, ndim))
+    matches = (np.count_nonzero(valid, axis=1) == len(wet_index)) & valid[
+        :, wet_index
+    ].all(axis=1)
+    return matches.reshape(block.shape[: block.ndim - ndim])
 
 
 def _pick_first_element_of_missing_dims(mask: xr.DataArray, data: xr.DataArray):
@@ -9,23 +122,32 @@ def _pick_first_element_of_missing_dims(mask: xr.DataArray, data: xr.DataArray):
         return mask.isel({di: 0 for di in missing_dims})
 
 
-def apply_mask(ds: xr.Dataset, mask: xr.DataArray):
+@instrumented
+def apply_mask(ds: xr.Dataset, mask: Union[xr.DataArray, WetMask]):
     """applies mask to same and lower dimensional data"""
     ds_out = xr.Dataset(attrs=ds.attrs)
     for var in ds.data_vars:
         data = ds[var]
-        mask_pruned = _pick_first_element_of_missing_dims(mask, data)
-        ds_out[var] = data.where(mask_pruned)
+        if isinstance(mask, WetMask):
+            ds_out[var] = mask.apply(data)
+        else:
+            mask_pruned = _pick_first_element_of_missing_dims(mask, data)
+            ds_out[var] = data.where(mask_pruned)
     return ds_out
 
 
-def assert_mask_match(ds: xr.Dataset, mask: xr.DataArray):
+@instrumented
+def assert_mask_match(ds: xr.Dataset, mask: Union[xr.DataArray, WetMask]):
     """Assert that nans at a sample time step are consistent with a mask (mask True or 1 indicates not nan)"""
     for var in ds.data_vars:
         data_test = ds[var]
-        # make sure that 2d variables are only tested agains 2d wetmask
-        mask_test = _pick_first_element_of_missing_dims(mask, data_test)
-        if not (data_test.notnull() == mask_test).all():
+        if isinstance(mask, WetMask):
+            matches = mask.match(data_test)
+        else:
+            # make sure that 2d variables are only tested agains 2d wetmask
+            mask_test = _pick_first_element_of_missing_dims(mask, data_test)
+            matches = (data_test.notnull() == mask_test).all()
+        if not matches:
             raise ValueError(
                 f"Wetmask does not match between `ds` and `wetmask` for variable {var}!"
             )
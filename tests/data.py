@@ -148,3 +148,40 @@ def raw_prediction():
 @pytest.fixture
 def prediction(input_data):
     return input_data[["so", "thetao", "uo", "vo", "zos"]].drop_vars("wetmask")
+
+
+@pytest.fixture
+def cmip_vertical_data():
+    # small CMIP-like dataset with z* vertical coordinate information
+    lev_bounds = np.array([0, 10, 25, 50, 100, 200, 400.0])
+    lev = (lev_bounds[1:] + lev_bounds[:-1]) / 2
+    nx, ny, nt = 5, 4, 3
+    coords = {
+        "x": np.arange(nx),
+        "y": np.arange(ny),
+        "lev": lev,
+        "time": np.arange(nt),
+        "lev_bounds": xr.DataArray(
+            np.stack([lev_bounds[:-1], lev_bounds[1:]], axis=1), dims=["lev", "bnds"]
+        ),
+    }
+    # columns of different depth
+    n_wet = np.random.randint(1, len(lev) + 1, size=[nx, ny])
+    wetmask = np.arange(len(lev))[None, None, :] < n_wet[:, :, None]
+    thkcello = xr.DataArray(
+        np.broadcast_to(np.diff(lev_bounds), wetmask.shape).copy(),
+        dims=["x", "y", "lev"],
+    ).where(wetmask)
+    deptho = thkcello.sum("lev")
+    zos = xr.DataArray(np.random.random([nx, ny, nt]) - 0.5, dims=["x", "y", "time"])
+
+    def _field():
+        return xr.DataArray(
+            np.random.random([nx, ny, len(lev), nt]), dims=["x", "y", "lev", "time"]
+        ).where(wetmask[..., None])
+
+    return xr.Dataset(
+        {"thetao": _field(), "so": _field(), "zos": zos.where(wetmask[..., 0, None])},
+        coords={**coords, "thkcello": thkcello, "deptho": deptho},
+        attrs={"source_id": "dummy"},
+    )
@@ -0,0 +1,32 @@
+import pytest
+from benchmarks.diagnostics import QCDiagnostics
+from benchmarks.postprocessing import PostProcessor
+from benchmarks.regridding import HorizontalRegrid, Regrid3D, VerticalRegrid
+from benchmarks.validation import BoundsValidation, FormatChecks, Mask, NanConsistency
+
+
+@pytest.mark.parametrize(
+    "benchmark",
+    [
+        NanConsistency,
+        FormatChecks,
+        BoundsValidation,
+        Mask,
+        PostProcessor,
+        VerticalRegrid,
+        HorizontalRegrid,
+        Regrid3D,
+        QCDiagnostics,
+    ],
+)
+def test_benchmarks_run(benchmark):
+    # run every benchmark once with the smallest parameters
+    params = benchmark.params
+    if not isinstance(params[0], list):
+        params = [params]
+    args = [p[0] for p in params]
+    bench = benchmark()
+    bench.setup(*args)
+    for name in dir(bench):
+        if name.startswith("time_"):
+            getattr(bench, name)(*args)
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import xarray as xr
+from tests.data import input_data, prediction  # noqa # Might want to put these in conftest.py (see https://stackoverflow.com/questions/73191533/using-conftest-py-vs-importing-fixtures-from-dedicate-modules)
+from ocean_emulators.channels import ChannelLayout, DEFAULT_PREDICTION_LAYOUT
+from ocean_emulators.postprocessing import post_processor
+
+
+def test_default_layout():
+    assert DEFAULT_PREDICTION_LAYOUT.n_channels == 77
+    assert DEFAULT_PREDICTION_LAYOUT.channels()[19] == ("vo", 0)
+    assert DEFAULT_PREDICTION_LAYOUT.channels()[-1] == ("zos", None)
+
+
+def test_layout_attrs_roundtrip():
+    layout = ChannelLayout([("zos", None), ("thetao", 5), ("hfds", None), ("so", 5)])
+    assert ChannelLayout.from_attrs(layout.to_attrs()) == layout
+    assert ChannelLayout.from_attrs({}) is None
+
+
+@pytest.mark.parametrize("chunks", [None, {"time": 1}])
+def test_pack_unpack_roundtrip(chunks):
+    layout = ChannelLayout([("zos", None), ("thetao", 5), ("hfds", None), ("so", 5)])
+    ds = xr.Dataset(
+        {
+            "thetao": (["time", "lev", "y", "x"], np.random.random([2, 5, 3, 4])),
+            "so": (["time", "y", "x", "lev"], np.random.random([2, 3, 4, 5])),
+            "zos": (["time", "y", "x"], np.random.random([2, 3, 4])),
+            "hfds": (["time", "y", "x"], np.random.random([2, 3, 4])),
+        }
+    )
+    if chunks is not None:
+        ds = ds.chunk(chunks)
+    packed = layout.pack(ds)
+    assert packed.dims == ("time", "y", "x", "var")
+    np.testing.assert_array_equal(
+        packed.isel(var=layout.channel_index("so")).values,
+        ds.so.transpose("time", "y", "x", "lev").values,
+    )
+    np.testing.assert_array_equal(packed.isel(var=0).values, ds.zos.values)
+
+    unpacked = layout.unpack(packed)
+    xr.testing.assert_identical(unpacked, ds.transpose("time", "y", "x", "lev"))
+
+
+def test_post_processor_layout_from_attrs(input_data, prediction):
+    layout = ChannelLayout.from_dataset(prediction, ["thetao", "zos", "so", "uo", "vo"])
+    ds_raw = (
+        layout.pack(prediction.reset_coords(drop=True))
+        .transpose("time", "y", "x", "var")
+        .to_dataset(name="__xarray_dataarray_variable__")
+    )
+    ds = post_processor(ds_raw, input_data)
+    for var in prediction.data_vars:
+        xr.testing.assert_equal(
+            ds[var].reset_coords(drop=True),
+            prediction[var].reset_coords(drop=True).transpose(*ds[var].dims),
+        )
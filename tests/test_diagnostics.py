@@ -0,0 +1,52 @@
+import os
+import numpy as np
+import xarray as xr
+from tests.data import input_data  # noqa # Might want to put these in conftest.py (see https://stackoverflow.com/questions/73191533/using-conftest-py-vs-importing-fixtures-from-dedicate-modules)
+from ocean_emulators.diagnostics import compute_diagnostics
+
+
+def test_compute_diagnostics(input_data, tmp_path):
+    ds = input_data[["thetao", "zos"]]
+    ds_diag = compute_diagnostics(ds, cache_dir=tmp_path)
+    assert set(ds_diag.data_vars) == {
+        "thetao_snapshot",
+        "thetao_global_mean",
+        "thetao_volume_mean",
+        "thetao_zonal_mean_std",
+        "zos_snapshot",
+        "zos_global_mean",
+        "zos_zonal_mean_std",
+    }
+    assert ds_diag.thetao_global_mean.dims == ("time", "lev")
+
+    # compare against a straightforward computation
+    ds = ds.load()
+    wet = ds.wetmask.astype(bool)
+    area = ds.areacello.where(wet)
+    expected = (ds.thetao * area).sum(["x", "y"]) / area.sum(["x", "y"])
+    np.testing.assert_allclose(
+        ds_diag.thetao_global_mean, expected.transpose("time", "lev")
+    )
+    volume = area * ds.dz
+    expected = (ds.thetao * volume).sum(["x", "y", "lev"]) / volume.sum()
+    np.testing.assert_allclose(ds_diag.thetao_volume_mean, expected)
+    area_2d = area.isel(lev=0)
+    expected = ((ds.zos * area_2d).sum("x") / area_2d.sum("x")).std("time")
+    np.testing.assert_allclose(ds_diag.zos_zonal_mean_std, expected)
+
+    # the second call reads from the cache
+    assert len(os.listdir(tmp_path)) == 1
+    xr.testing.assert_identical(compute_diagnostics(ds, cache_dir=tmp_path), ds_diag)
+
+
+def test_compute_diagnostics_cache_key(input_data, tmp_path):
+    # e.g. two members with the same (dummy) git hash, shape and time range
+    ds = input_data[["thetao", "zos"]]
+    ds_other = ds * 2
+    ds_other.attrs = ds.attrs
+    ds_diag = compute_diagnostics(ds, cache_dir=tmp_path)
+    ds_diag_other = compute_diagnostics(ds_other, cache_dir=tmp_path)
+    assert len(os.listdir(tmp_path)) == 2
+    np.testing.assert_allclose(
+        ds_diag_other.thetao_global_mean, 2 * ds_diag.thetao_global_mean
+    )
@@ -0,0 +1,46 @@
+import os
+import numpy as np
+import pytest
+import xarray as xr
+from tests.data import input_data  # noqa # Might want to put these in conftest.py (see https://stackoverflow.com/questions/73191533/using-conftest-py-vs-importing-fixtures-from-dedicate-modules)
+from ocean_emulators.grids import has_grid, load_grid, register_grid
+from ocean_emulators.preprocessing import manual_v0_fixes
+
+GRID_FIELDS = ["areacello", "dz", "lev", "wetmask", "lon", "lat"]
+
+
+def test_register_grid(input_data, tmp_path):
+    ds_grid = xr.Dataset(
+        coords={co: input_data[co].reset_coords(drop=True) for co in GRID_FIELDS}
+    )
+    assert not has_grid("test", cache_dir=tmp_path)
+    register_grid("test", ds_grid, cache_dir=tmp_path)
+    grid = load_grid("test", cache_dir=tmp_path)
+    assert isinstance(grid.wetmask.variable._data, np.memmap)
+    xr.testing.assert_identical(grid, ds_grid)
+    assert load_grid("test", cache_dir=tmp_path) is grid
+
+    # manual_v0_fixes does not access the remote grid once it is registered
+    ds_raw = input_data.reset_coords(drop=True).drop_vars("lev")
+    ds = manual_v0_fixes(ds_raw, grid_id="test", cache_dir=tmp_path)
+    for co in GRID_FIELDS:
+        np.testing.assert_array_equal(ds[co], input_data[co])
+
+    # the registered grid does not match other data
+    register_grid(
+        "test",
+        ds_grid.assign_coords(x=input_data.x, y=input_data.y),
+        cache_dir=tmp_path,
+    )
+    manual_v0_fixes(ds_raw, grid_id="test", cache_dir=tmp_path)
+    with pytest.raises(ValueError, match="size"):
+        manual_v0_fixes(ds_raw.isel(x=slice(0, 2)), grid_id="test", cache_dir=tmp_path)
+    with pytest.raises(ValueError, match="Coordinate x"):
+        manual_v0_fixes(
+            ds_raw.assign_coords(x=ds_raw.x + 1), grid_id="test", cache_dir=tmp_path
+        )
+
+    # registering again replaces the grid and leaves no temporary files
+    register_grid("test", ds_grid.isel(x=slice(0, 2)), cache_dir=tmp_path)
+    assert load_grid("test", cache_dir=tmp_path).sizes["x"] == 2
+    assert os.listdir(tmp_path) == ["test"]
@@ -0,0 +1,22 @@
+import json
+import subprocess
+import sys
+from benchmarks.imports import IMPORT_TIME_BUDGET, LAZY_IMPORTS
+
+CODE = """
+import json, sys, time
+start = time.perf_counter()
+import ocean_emulators.postprocessing
+import ocean_emulators.plotting
+print(json.dumps({"time": time.perf_counter() - start, "modules": list(sys.modules)}))
+"""
+
+
+def test_import_time():
+    # run in a fresh interpreter, since the modules are already imported by other tests
+    output = subprocess.run(
+        [sys.executable, "-c", CODE], capture_output=True, check=True, text=True
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    assert [m for m in LAZY_IMPORTS if m in result["modules"]] == []
+    assert result["time"] < IMPORT_TIME_BUDGET
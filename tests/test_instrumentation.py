@@ -0,0 +1,35 @@
+import json
+from tests.data import input_data  # noqa # Might want to put these in conftest.py (see https://stackoverflow.com/questions/73191533/using-conftest-py-vs-importing-fixtures-from-dedicate-modules)
+from ocean_emulators.instrumentation import instrument_run, stage
+from ocean_emulators.preprocessing import input_data_test
+
+
+def test_instrument_run(input_data, tmp_path):
+    path = tmp_path / "report.json"
+    with instrument_run(path) as report:
+        input_data_test(input_data, deep=True, deep_mode="streaming")
+        with stage("load"):
+            input_data.thetao.isel(time=0).load()
+    assert json.loads(path.read_text()) == json.loads(json.dumps(report))
+
+    stages = {s["name"].split(".")[-1]: s for s in report["stages"]}
+    assert (
+        report["stages"][0]["name"] == "ocean_emulators.preprocessing.input_data_test"
+    )
+    assert stages["test_nan_consistency_streaming"]["parent"] == (
+        "ocean_emulators.preprocessing.input_data_test_deep"
+    )
+    assert stages["test_nan_consistency_streaming"]["depth"] == 3
+    assert stages["deep checks"]["parent"] == (
+        "ocean_emulators.preprocessing.input_data_test"
+    )
+    assert stages["load"]["dask_tasks"] > 0
+    assert stages["load"]["peak_memory"] >= input_data.thetao.isel(time=0).nbytes
+    for record in report["stages"]:
+        assert record["wall_time"] >= 0
+
+    # instrumentation is off outside of a run
+    with instrument_run() as report:
+        pass
+    input_data_test(input_data)
+    assert report["stages"] == []
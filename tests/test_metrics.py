@@ -0,0 +1,76 @@
+import numpy as np
+import xarray as xr
+from tests.data import input_data  # noqa # Might want to put these in conftest.py (see https://stackoverflow.com/questions/73191533/using-conftest-py-vs-importing-fixtures-from-dedicate-modules)
+from ocean_emulators.metrics import (
+    merge_skill_sums,
+    skill_metrics,
+    skill_metrics_from_sums,
+    skill_sums,
+)
+
+
+def test_skill_metrics(input_data):
+    ds_truth = input_data[["thetao", "zos"]]
+    # the fake cell areas of the test data are negative in the southern hemisphere
+    ds_truth = ds_truth.assign_coords(areacello=abs(ds_truth.areacello) + 1)
+    climatology = ds_truth.mean("time")
+    ds_prediction = ds_truth + 0.5
+    metrics = skill_metrics(ds_prediction, ds_truth, climatology=climatology)
+    assert metrics.thetao_rmse.dims == ("time", "lev")
+    assert metrics.zos_rmse_total.dims == ()
+    assert metrics.thetao_spectrum_truth.sizes["wavenumber"] == 181
+    for var in ["thetao", "zos"]:
+        for suffix in ["", "_total"]:
+            np.testing.assert_allclose(metrics[f"{var}_rmse{suffix}"], 0.5)
+            np.testing.assert_allclose(metrics[f"{var}_bias{suffix}"], 0.5)
+    np.testing.assert_allclose(metrics.thetao_rmse_volume, 0.5)
+
+    metrics = skill_metrics(ds_truth, ds_truth, climatology=climatology)
+    np.testing.assert_allclose(metrics.thetao_acc, 1.0)
+    np.testing.assert_allclose(metrics.thetao_acc_volume, 1.0)
+    xr.testing.assert_allclose(
+        metrics.thetao_spectrum_prediction, metrics.thetao_spectrum_truth
+    )
+
+    # sums of separate time chunks can be merged
+    ds_prediction = ds_truth * 1.1
+    sums = merge_skill_sums(
+        [
+            skill_sums(
+                ds_prediction.isel(time=t),
+                ds_truth.isel(time=t),
+                climatology=climatology,
+            )
+            for t in [slice(0, 2), slice(2, None)]
+        ]
+    )
+    xr.testing.assert_allclose(
+        skill_metrics_from_sums(sums),
+        skill_metrics(ds_prediction, ds_truth, climatology=climatology),
+    )
+
+
+def test_skill_metrics_acc(input_data):
+    ds_truth = input_data[["thetao"]].load()
+    ds_truth = ds_truth.assign_coords(areacello=abs(ds_truth.areacello) + 1)
+    climatology = ds_truth.mean("time")
+    rng = np.random.default_rng(0)
+    ds_prediction = ds_truth + rng.normal(size=ds_truth.thetao.shape)
+    metrics = skill_metrics(ds_prediction, ds_truth, climatology)
+
+    # area weighted correlation of the anomalies over the wet cells of every level
+    wet = ds_truth.wetmask.transpose("lev", "y", "x").values.astype(bool)
+    area = ds_truth.areacello.transpose("y", "x").values
+    clim = climatology.thetao.transpose("lev", "y", "x").values
+    truth = ds_truth.thetao.transpose("time", "lev", "y", "x").values - clim
+    prediction = ds_prediction.thetao.transpose("time", "lev", "y", "x").values - clim
+    expected = np.empty(truth.shape[:2])
+    for t in range(truth.shape[0]):
+        for k in range(truth.shape[1]):
+            w = area[wet[k]]
+            pa, ta = prediction[t, k][wet[k]], truth[t, k][wet[k]]
+            expected[t, k] = np.sum(w * pa * ta) / np.sqrt(
+                np.sum(w * pa**2) * np.sum(w * ta**2)
+            )
+    assert np.isfinite(expected).all() and (expected < 0.99).all()
+    np.testing.assert_allclose(metrics.thetao_acc.transpose("time", "lev"), expected)
@@ -0,0 +1,138 @@
+import json
+import os
+import numpy as np
+import pytest
+import xarray as xr
+from ocean_emulators.pipeline import (
+    preprocess_cmip_member,
+    progress_manifest_path,
+    run_manifest,
+    write_zarr_incremental,
+)
+from ocean_emulators.preprocessing import HorizontalRemapOperator, input_data_test
+from tests.data import input_data, cmip_vertical_data  # noqa # Might want to put these in conftest.py (see https://stackoverflow.com/questions/73191533/using-conftest-py-vs-importing-fixtures-from-dedicate-modules)
+
+zarr = pytest.importorskip("zarr")
+
+
+def _scale(ds, factor=1.0, weights_dir=None):
+    return ds * factor
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    entries = []
+    for i in range(3):
+        path = os.path.join(tmp_path, f"source_{i}.zarr")
+        xr.Dataset({"thetao": (["time", "x"], np.full([2, 4], float(i)))}).to_zarr(path)
+        entries.append({"name": f"member_{i}", "path": path})
+    entries.append({"name": "missing", "path": os.path.join(tmp_path, "nope.zarr")})
+    manifest_path = os.path.join(tmp_path, "manifest.json")
+    with open(manifest_path, "w") as f:
+        json.dump(entries, f)
+    return manifest_path
+
+
+def test_run_manifest(manifest, tmp_path):
+    output_dir = os.path.join(tmp_path, "output")
+    results = run_manifest(
+        manifest,
+        output_dir,
+        process=_scale,
+        process_kwargs={"factor": 2.0},
+        n_workers=2,
+        validate=False,
+    )
+    assert list(results) == ["member_0", "member_1", "member_2", "missing"]
+    assert results["missing"]["status"] == "failed"
+    assert results["missing"]["attempts"] == 2
+    assert not os.path.exists(os.path.join(output_dir, "missing.zarr"))
+    for i in range(3):
+        assert results[f"member_{i}"]["status"] == "ok"
+        ds = xr.open_dataset(results[f"member_{i}"]["store"], engine="zarr")
+        np.testing.assert_array_equal(ds.thetao, 2.0 * i)
+
+    # only failed members are rerun
+    results = run_manifest(
+        manifest, output_dir, process=_scale, n_workers=2, validate=False
+    )
+    assert results["member_0"]["status"] == "skipped"
+    assert results["missing"]["status"] == "failed"
+
+
+def test_run_manifest_cmip(cmip_vertical_data, tmp_path):
+    path = os.path.join(tmp_path, "source.zarr")
+    cmip_vertical_data.to_zarr(path)
+    # average pairs of cells along x (instead of xesmf weights)
+    weights = np.zeros([2, 4, 5, 4])
+    for i in range(2):
+        for j in range(4):
+            weights[i, j, 2 * i : 2 * i + 2, j] = 0.5
+    horizontal = HorizontalRemapOperator(
+        weights.reshape(8, 20), ("x", "y"), (5, 4), ("x", "y"), (2, 4)
+    )
+    x, y = xr.DataArray([0.5, 2.5], dims="x"), xr.DataArray(np.arange(4.0), dims="y")
+    ds_target = xr.Dataset(
+        coords={
+            "x": x,
+            "y": y,
+            "lon": x * xr.ones_like(y),
+            "lat": y * xr.ones_like(x),
+            "areacello": xr.full_like(x * y, 2.0),
+        }
+    )
+    process_kwargs = {
+        "ds_target": ds_target,
+        "target_depth_bounds": np.array([0, 5, 30, 60, 150, 300, 500.0]),
+        "horizontal": horizontal,
+    }
+    expected_sizes = {"x": 2, "y": 4, "lev": 6}
+    output_dir = os.path.join(tmp_path, "output")
+    results = run_manifest(
+        [{"name": "member", "path": path}],
+        output_dir,
+        process_kwargs=process_kwargs,
+        n_workers=1,
+        deep=True,
+        expected_sizes=expected_sizes,
+    )
+    assert results["member"]["status"] == "ok", results["member"].get("error")
+    ds_out = xr.open_dataset(results["member"]["store"], engine="zarr")
+    input_data_test(ds_out, deep=True, expected_sizes=expected_sizes)
+    np.testing.assert_array_equal(ds_out.areacello, 2.0)
+    np.testing.assert_array_equal(ds_out.wetmask, ds_out.thetao.isel(time=0).notnull())
+
+    expected = preprocess_cmip_member(cmip_vertical_data, **process_kwargs)
+    xr.testing.assert_identical(ds_out.load(), expected.load())
+
+
+def test_write_zarr_incremental(input_data, tmp_path):
+    store = os.path.join(tmp_path, "output.zarr")
+    ds = input_data.chunk({"time": 1})
+    manifest = write_zarr_incremental(ds.isel(time=slice(0, 2)), store, time_block=1)
+    assert [b["status"] for b in manifest["blocks"].values()] == ["ok", "ok"]
+
+    # corrupt the manifest entry of the first block, which is then recomputed,
+    # and extend the store with the last time step
+    manifest["blocks"]["0"]["status"] = "invalid"
+    with open(progress_manifest_path(store), "w") as f:
+        json.dump(manifest, f)
+    checksum = manifest["blocks"]["1"]["checksum"]
+    manifest = write_zarr_incremental(ds, store, time_block=1, verify=True)
+    assert list(manifest["blocks"]) == ["0", "1", "2"]
+    assert manifest["blocks"]["1"]["checksum"] == checksum
+
+    ds_out = xr.open_dataset(store, engine="zarr")
+    xr.testing.assert_identical(ds_out.load(), input_data.load())
+
+
+def test_write_zarr_incremental_drifting_mask(input_data, tmp_path):
+    store = os.path.join(tmp_path, "output.zarr")
+    ds = input_data.load()
+    # fill the dry cells of all variables at the last time step
+    for var in ds.data_vars:
+        if "time" in ds[var].dims:
+            ds[var][{"time": 2}] = ds[var].isel(time=2).fillna(0.0)
+    manifest = write_zarr_incremental(ds, store, time_block=1)
+    status = [b["status"] for b in manifest["blocks"].values()]
+    assert status == ["ok", "ok", "invalid"]
@@ -0,0 +1,25 @@
+import os
+from tests.data import input_data  # noqa # Might want to put these in conftest.py (see https://stackoverflow.com/questions/73191533/using-conftest-py-vs-importing-fixtures-from-dedicate-modules)
+from ocean_emulators.plotting import QC_PANELS, qc_report
+
+
+def test_qc_report(input_data, tmp_path):
+    ds = input_data[["thetao", "zos"]]
+    output_dir = os.path.join(tmp_path, "report")
+    path = qc_report(ds, output_dir, title="member_0", n_workers=2)
+    assert path == os.path.join(output_dir, "index.html")
+    with open(path) as f:
+        page = f.read()
+    assert "member_0" in page
+    for panel in QC_PANELS:
+        for var in ["thetao", "zos"]:
+            assert os.path.getsize(os.path.join(output_dir, f"{var}_{panel}.png")) > 0
+            assert f"{var}_{panel}.png" in page
+
+    # restyling reuses the cached diagnostics
+    cache_dir = os.path.join(output_dir, "diagnostics")
+    (cache_file,) = os.listdir(cache_dir)
+    mtime = os.path.getmtime(os.path.join(cache_dir, cache_file))
+    qc_report(ds, output_dir, n_workers=1, style="ggplot", dpi=50)
+    assert os.listdir(cache_dir) == [cache_file]
+    assert os.path.getmtime(os.path.join(cache_dir, cache_file)) == mtime
@@ -1,6 +1,12 @@
+import pytest
 import xarray as xr
 from tests.data import input_data, raw_prediction, prediction  # noqa # Might want to put these in conftest.py (see https://stackoverflow.com/questions/73191533/using-conftest-py-vs-importing-fixtures-from-dedicate-modules)
-from ocean_emulators.postprocessing import post_processor, prediction_data_test
+from ocean_emulators.preprocessing import nan_sketch
+from ocean_emulators.postprocessing import (
+    post_processor,
+    post_process_to_zarr,
+    prediction_data_test,
+)
 
 
 def test_post_processor(input_data, raw_prediction):
@@ -14,9 +20,26 @@ def test_post_processor(input_data, raw_prediction):
         xr.testing.assert_equal(ds[co], ds_input[co])
 
 
+def test_post_processor_truth_sketch(input_data, raw_prediction):
+    sketch = nan_sketch(input_data)
+    post_processor(raw_prediction, input_data, truth_sketch=sketch)
+    ds_truth = input_data.assign_coords(wetmask=~input_data.wetmask)
+    with pytest.raises(ValueError, match="do not match the wetmask"):
+        post_processor(raw_prediction, ds_truth, truth_sketch=sketch)
+
+
 class TestPredictionDataTest:
     def test_prediction_data_test(self, prediction, input_data):
         # should always pass on the test data
-        prediction_data_test(prediction, input_data)
+        prediction_data_test(prediction, input_data, deep=True)
         pass
         # TODO: Check each test in there with a failcase
+
+
+def test_post_process_to_zarr(input_data, raw_prediction, tmp_path):
+    pytest.importorskip("zarr")
+    store = tmp_path / "prediction.zarr"
+    post_process_to_zarr(raw_prediction, input_data, store, time_chunk=2)
+    ds = xr.open_zarr(store)
+    assert ds.chunks["time"] == (2, 1)
+    xr.testing.assert_equal(ds.load(), post_processor(raw_prediction, input_data))
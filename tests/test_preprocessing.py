@@ -1,4 +1,32 @@
-from tests.data import input_data  # noqa # Might want to put these in conftest.py (see https://stackoverflow.com/questions/73191533/using-conftest-py-vs-importing-fixtures-from-dedicate-modules)
+import os
+import sys
+import types
+from collections import OrderedDict
+import numpy as np
+import pytest
+import xarray as xr
+from tests.data import input_data, cmip_vertical_data  # noqa # Might want to put these in conftest.py (see https://stackoverflow.com/questions/73191533/using-conftest-py-vs-importing-fixtures-from-dedicate-modules)
+from ocean_emulators.preprocessing import (
+    BOUNDS_ERROR_FLAGS,
+    HorizontalRemapOperator,
+    bounds_error_mask,
+    infer_vertical_cell_extent,
+    check_nan_sketch,
+    find_index_for_true,
+    get_horizontal_operator,
+    get_regridder,
+    input_data_test,
+    nan_sketch,
+    read_nan_sketch,
+    regrid_3d,
+    spatially_regrid,
+    regrid_weights_key,
+    test_nan_consistency_sketch as nan_consistency_sketch,
+    test_nan_consistency_streaming as nan_consistency_streaming,
+    test_vertex_order as vertex_order,
+    write_nan_sketch,
+    vertical_regrid,
+)
 ################################## TODO:rework these tests once the preprocessing is more mature
 # def _get_software_version():
 #     pass
@@ -67,3 +95,330 @@ def test_infer_vertical_cell_extent_missing(input_data):
     ds = input_data
     ds = ds.drop("zos")
     # TODO: Test that we get a message that *only* asks for zos (not the ones that are already on the dataset)
+
+
+@pytest.mark.parametrize("deep_mode", ["full", "streaming", "sketch"])
+def test_input_data_test_deep(input_data, deep_mode):
+    input_data_test(input_data, deep=True, deep_mode=deep_mode)
+
+
+def test_input_data_test_metadata_only(input_data, tmp_path):
+    pytest.importorskip("zarr")
+    store = str(tmp_path / "input.zarr")
+    input_data.chunk({"time": 1}).to_zarr(store)
+    # corrupt all chunks of a data variable, only the deep checks read them
+    chunk_dir = tmp_path / "input.zarr" / "thetao" / "c"
+    for path in chunk_dir.rglob("*"):
+        if path.is_file():
+            path.write_bytes(b"corrupted")
+    input_data_test(store, expected_chunks={"time": 1, "x": 360})
+    with pytest.raises(ValueError, match="chunk size 2 along time"):
+        input_data_test(store, expected_chunks={"time": 2})
+    with pytest.raises(Exception):
+        input_data_test(store, deep=True)
+
+    with pytest.raises(ValueError, match="unexpected data variables"):
+        input_data_test(input_data.assign(other=input_data.zos))
+    with pytest.raises(ValueError, match="floating point dtype"):
+        input_data_test(input_data.assign(zos=input_data.zos.fillna(0).astype(int)))
+
+
+@pytest.mark.parametrize("time_chunk", [None, 1, 2])
+def test_nan_consistency_streaming_raises(input_data, time_chunk):
+    ds = input_data[["thetao", "so"]].load()
+    # flip the nan state of a single cell at the last time step
+    wet = bool(ds.wetmask[{"x": 0, "y": 0, "lev": 0}])
+    ds["so"][{"time": 2, "x": 0, "y": 0, "lev": 0}] = np.nan if wet else 1.0
+    with pytest.raises(ValueError, match=r"'so'.*\[2\]"):
+        nan_consistency_streaming(ds, time_chunk=time_chunk)
+
+
+@pytest.mark.parametrize("n_offending", [0, 3])
+def test_find_index_for_true(n_offending):
+    da = xr.DataArray(
+        np.zeros([2, 4, 3, 5], dtype=bool),
+        dims=["variable", "time", "y", "x"],
+        coords={"variable": ["a", "b"], "time": np.arange(4) * 10, "x": np.arange(5)},
+    ).chunk({"time": 1})
+    da[{"variable": 1, "time": 2, "y": 1, "x": 4}] = True
+    da[{"variable": 1, "time": 3, "y": 0, "x": 0}] = True
+    da[{"variable": 1, "time": 3, "y": 2, "x": 1}] = True
+    da[{"variable": 1, "time": 3, "y": 2, "x": 2}] = True
+    index = find_index_for_true(da, n_offending=n_offending)
+    np.testing.assert_array_equal(index["variable"], ["b"])
+    np.testing.assert_array_equal(index["time"], [20, 30])
+    if n_offending == 0:
+        assert "cells" not in index
+    else:
+        assert [(c["time"], c["y"], c["x"]) for c in index["cells"]] == [
+            (20, 1, 4),
+            (30, 0, 0),
+            (30, 2, 1),
+        ]
+
+
+def test_nan_sketch(input_data, tmp_path):
+    ds = input_data[["thetao", "so", "zos"]].load()
+    sketch = nan_sketch(ds)
+    path = tmp_path / "sketch.json"
+    write_nan_sketch(sketch, path)
+    xr.testing.assert_identical(read_nan_sketch(path), sketch)
+    n_dry = int((~ds.wetmask).sum())
+    assert (sketch.nan_count.sel(variable="thetao") == n_dry).all()
+    index = check_nan_sketch(sketch, wetmask=ds.wetmask)
+    assert all(len(v) == 0 for v in index.values())
+
+    wet = bool(ds.wetmask[{"x": 0, "y": 0, "lev": 0}])
+    ds["so"][{"time": 2, "x": 0, "y": 0, "lev": 0}] = np.nan if wet else 1.0
+    index = check_nan_sketch(nan_sketch(ds))
+    np.testing.assert_array_equal(index["variable"], ["so"])
+    np.testing.assert_array_equal(index["time"], ["2"])
+    # the stale sketch passes, the targeted full check finds the offending time step
+    nan_consistency_sketch(ds, sketch=path)
+    with pytest.raises(ValueError, match=r"'so'.*\[2\]"):
+        nan_consistency_sketch(ds)
+
+
+def _bounds_dataset(lon_b, lat_b):
+    lon = (lon_b[1:] + lon_b[:-1]) / 2
+    lat = (lat_b[1:] + lat_b[:-1]) / 2
+    return xr.Dataset(
+        coords={
+            "lon": xr.DataArray(lon * np.ones_like(lat)[:, None], dims=["y", "x"]),
+            "lat": xr.DataArray(np.ones_like(lon) * lat[:, None], dims=["y", "x"]),
+            "lon_b": xr.DataArray(
+                lon_b * np.ones_like(lat_b)[:, None], dims=["y_b", "x_b"]
+            ),
+            "lat_b": xr.DataArray(
+                np.ones_like(lon_b) * lat_b[:, None], dims=["y_b", "x_b"]
+            ),
+        }
+    )
+
+
+def test_regrid_weights_key():
+    ds_source = _bounds_dataset(np.arange(0, 361, 2.0), np.arange(-90, 91, 2.0))
+    ds_target = _bounds_dataset(np.arange(0, 361, 1.0), np.arange(-90, 91, 1.0))
+    key = regrid_weights_key(ds_source, ds_target, "conservative")
+    assert key == regrid_weights_key(
+        ds_source.copy(deep=True), ds_target, "conservative"
+    )
+    assert key != regrid_weights_key(ds_source, ds_target, "bilinear")
+    assert key != regrid_weights_key(ds_target, ds_source, "conservative")
+
+
+class _FakeRegridder:
+    """Stand-in for `xesmf.Regridder` that records how it was created"""
+
+    created = []
+
+    def __init__(self, ds_in, ds_out, method, weights=None, **kwargs):
+        self.method = method
+        self.weights_file = weights
+        _FakeRegridder.created.append(self)
+
+    def to_netcdf(self, path):
+        xr.Dataset(
+            {"S": ("n_s", [1.0]), "row": ("n_s", [1]), "col": ("n_s", [1])}
+        ).to_netcdf(path)
+
+
+@pytest.fixture
+def fake_xesmf(monkeypatch):
+    import ocean_emulators.preprocessing as preprocessing
+
+    _FakeRegridder.created = []
+    monkeypatch.setitem(
+        sys.modules, "xesmf", types.SimpleNamespace(Regridder=_FakeRegridder)
+    )
+    monkeypatch.setattr(preprocessing, "_REGRIDDER_CACHE", OrderedDict())
+    monkeypatch.setattr(preprocessing, "_HORIZONTAL_OPERATOR_CACHE", OrderedDict())
+    monkeypatch.setattr(preprocessing, "REGRIDDER_CACHE_SIZE", 1)
+    return preprocessing
+
+
+def test_get_regridder_cache(fake_xesmf, tmp_path):
+    ds_source = _bounds_dataset(np.arange(0, 361, 2.0), np.arange(-90, 91, 2.0))
+    ds_target = _bounds_dataset(np.arange(0, 361, 1.0), np.arange(-90, 91, 1.0))
+    weights_dir = str(tmp_path)
+    regridder = get_regridder(ds_source, ds_target, weights_dir=weights_dir)
+    assert regridder.weights_file is None
+    key = regrid_weights_key(ds_source, ds_target, "conservative")
+    # the weights are written atomically, without leftover temporary files
+    assert os.listdir(tmp_path) == [f"conservative_{key}.nc"]
+
+    # the in-memory cache returns the same regridder
+    assert get_regridder(ds_source, ds_target, weights_dir=weights_dir) is regridder
+    assert len(_FakeRegridder.created) == 1
+
+    # evicted from the (size 1) cache, the weights are reloaded from the file
+    get_regridder(ds_source, ds_target, "bilinear")
+    regridder = get_regridder(ds_source, ds_target, weights_dir=weights_dir)
+    assert len(_FakeRegridder.created) == 3
+    assert regridder.weights_file == os.path.join(weights_dir, f"conservative_{key}.nc")
+    assert list(fake_xesmf._REGRIDDER_CACHE) == [key]
+
+    # sparse operators are cached separately and do not evict the regridders
+    operator = get_horizontal_operator(ds_source, ds_target, weights_dir=weights_dir)
+    assert get_horizontal_operator(ds_source, ds_target) is operator
+    assert get_regridder(ds_source, ds_target) is regridder
+    assert len(_FakeRegridder.created) == 3
+
+
+def test_bounds_error_mask():
+    ds = _bounds_dataset(np.arange(0, 361, 2.0), np.arange(-90, 91, 2.0))
+    mask = bounds_error_mask(ds)
+    assert mask.dims == ("y", "x")
+    assert mask.shape == (90, 180)
+    assert (mask == 0).all()
+    vertex_order(ds)
+
+    # latitude decreasing along y
+    flipped = _bounds_dataset(np.arange(0, 361, 2.0), np.arange(90, -91, -2.0))
+    assert (bounds_error_mask(flipped) == BOUNDS_ERROR_FLAGS["orientation"]).all()
+
+    # a vertex moved across its neighbours, and a missing vertex
+    ds = ds.copy(deep=True)
+    ds.lon_b[10, 20] = ds.lon_b[10, 22].values
+    ds.lat_b[50, 50] = np.nan
+    mask = bounds_error_mask(ds)
+    assert (mask[9:11, 19:21] & BOUNDS_ERROR_FLAGS["overlap"]).any()
+    assert (mask[49:51, 49:51] == BOUNDS_ERROR_FLAGS["nonfinite"]).all()
+    assert (mask[:5] == 0).all()
+    with pytest.raises(ValueError, match=r"nonfinite: 4 cells"):
+        vertex_order(ds)
+
+
+def _regular_grid(nx, ny):
+    lon_b, lat_b = np.linspace(0, 360, nx + 1), np.linspace(-90, 90, ny + 1)
+    return _bounds_dataset(lon_b, lat_b).assign_coords(
+        lon=("x", (lon_b[1:] + lon_b[:-1]) / 2),
+        lat=("y", (lat_b[1:] + lat_b[:-1]) / 2),
+    )
+
+
+@pytest.mark.parametrize("n_threads", [1, 2])
+def test_spatially_regrid_sparse(tmp_path, n_threads):
+    ds_source = _regular_grid(8, 4)
+    ds_target = _regular_grid(4, 2)
+    # xesmf weight file averaging 2x2 blocks, the last target column has no weights
+    rows, cols = [], []
+    for j in range(2):
+        for i in range(3):
+            for dj in range(2):
+                for di in range(2):
+                    rows.append(j * 4 + i + 1)
+                    cols.append((2 * j + dj) * 8 + 2 * i + di + 1)
+    ds_weights = xr.Dataset(
+        {
+            "S": ("n_s", np.full(len(rows), 0.25)),
+            "row": ("n_s", np.array(rows, dtype=np.int32)),
+            "col": ("n_s", np.array(cols, dtype=np.int32)),
+        }
+    )
+    key = regrid_weights_key(ds_source, ds_target, "conservative")
+    ds_weights.to_netcdf(tmp_path / f"conservative_{key}.nc")
+
+    data = np.random.random([3, 2, 4, 8])
+    data[0, 0, 0, 0] = np.nan
+    ds_source = ds_source.assign(
+        thetao=(["time", "lev", "y", "x"], data), zos=(["time", "y", "x"], data[:, 0])
+    )
+    kwargs = dict(backend="sparse", weights_dir=str(tmp_path), n_threads=n_threads)
+    ds_regridded = spatially_regrid(ds_source, ds_target, **kwargs)
+    assert ds_regridded.thetao.dims == ("time", "lev", "y", "x")
+    np.testing.assert_array_equal(ds_regridded.lon, ds_target.lon)
+    expected = data.reshape(3, 2, 2, 2, 4, 2).mean(axis=(3, 5))
+    np.testing.assert_allclose(ds_regridded.thetao[..., :3], expected[..., :3])
+    np.testing.assert_allclose(ds_regridded.zos[..., :3], expected[:, 0, ..., :3])
+    assert ds_regridded.thetao[..., 3].isnull().all()
+    assert np.isnan(ds_regridded.thetao[0, 0, 0, 0])
+
+    # the nan source cell is skipped, and the same is applied to dask chunks
+    ds_regridded = spatially_regrid(
+        ds_source.chunk({"time": 1}), ds_target, skipna=True, **kwargs
+    )
+    assert ds_regridded.thetao.chunks is not None
+    expected[0, 0, 0, 0] = np.nanmean(data[0, 0, :2, :2])
+    np.testing.assert_allclose(ds_regridded.thetao[..., :3], expected[..., :3])
+
+    with pytest.raises(ValueError, match="do not match"):
+        HorizontalRemapOperator.from_weights_file(
+            tmp_path / f"conservative_{key}.nc", ds_target, ds_target
+        )
+
+
+# a single 3D variable (e.g. one variable per file) returns a single output
+@pytest.mark.parametrize("drop", [[], ["so"]])
+@pytest.mark.parametrize("engine", ["batched", "zstar"])
+@pytest.mark.parametrize("chunks", [None, {"time": 1}])
+def test_vertical_regrid_against_xgcm(cmip_vertical_data, chunks, engine, drop):
+    ds = infer_vertical_cell_extent(cmip_vertical_data.drop_vars(drop))
+    if chunks is not None:
+        ds = ds.chunk(chunks)
+    target_depth_bounds = np.array([0, 5, 30, 60, 150, 300, 500.0])
+    expected = vertical_regrid(ds, target_depth_bounds, engine="xgcm")
+    regridded = vertical_regrid(ds, target_depth_bounds, engine=engine)
+    xr.testing.assert_allclose(regridded, expected.transpose(*regridded.dims))
+    for var in regridded.data_vars:
+        assert regridded[var].dims == expected[var].dims
+
+
+@pytest.mark.parametrize("engine", ["batched", "zstar"])
+def test_vertical_regrid_attrs(cmip_vertical_data, engine):
+    ds = infer_vertical_cell_extent(cmip_vertical_data)
+    ds["dz"].attrs = {"units": "m", "long_name": "dz"}
+    ds["thkcello"].attrs = {"units": "m", "standard_name": "cell_thickness"}
+    ds["thetao"].attrs = {"units": "degC", "standard_name": "sea_water_temperature"}
+    ds["so"].attrs = {"units": "0.001", "standard_name": "sea_water_salinity"}
+    target_depth_bounds = np.array([0, 5, 30, 60, 150, 300, 500.0])
+    regridded = vertical_regrid(ds, target_depth_bounds, engine=engine)
+    for var in ["thetao", "so"]:
+        assert regridded[var].attrs == ds[var].attrs
+
+
+@pytest.mark.parametrize("variables", [["thetao", "so", "zos"], ["thetao"]])
+@pytest.mark.parametrize("engine", ["batched", "zstar"])
+@pytest.mark.parametrize("chunks", [None, {"time": 1}])
+def test_regrid_3d(cmip_vertical_data, chunks, engine, variables):
+    ds = infer_vertical_cell_extent(cmip_vertical_data)
+    # keep zos (needed for the z* cell thickness) as a coordinate
+    ds = ds.set_coords([var for var in ds.data_vars if var not in variables])
+    ds["dz"].attrs = {"units": "m", "long_name": "dz"}
+    ds["thkcello"].attrs = {"units": "m", "standard_name": "cell_thickness"}
+    for var in variables:
+        ds[var].attrs = {"long_name": var}
+    if chunks is not None:
+        ds = ds.chunk(chunks)
+    # average 2x2 blocks onto a 3x2 grid, the last column has no source cells
+    weights = np.zeros([3, 2, 5, 4])
+    for i in range(2):
+        for j in range(2):
+            weights[i, j, 2 * i : 2 * i + 2, 2 * j : 2 * j + 2] = 0.25
+    horizontal = HorizontalRemapOperator(
+        weights.reshape(6, 20), ("x", "y"), (5, 4), ("x", "y"), (3, 2)
+    )
+    target_depth_bounds = np.array([0, 5, 30, 60, 150, 300, 500.0])
+    regridded = regrid_3d(
+        ds, None, target_depth_bounds, engine=engine, horizontal=horizontal
+    )
+    assert list(regridded.data_vars) == variables
+    assert regridded.thetao.dims == ("time", "lev", "x", "y")
+    np.testing.assert_array_equal(regridded.dz, np.diff(target_depth_bounds))
+
+    # same as separate passes (a block with any nan is nan, like in xesmf)
+    expected = (
+        vertical_regrid(ds, target_depth_bounds)
+        .reset_coords(drop=True)
+        .drop_vars(["x", "y"])
+        .isel(x=slice(0, 4))
+        .coarsen(x=2, y=2)
+        .reduce(np.mean)
+    )
+    for var in variables:
+        xr.testing.assert_allclose(
+            regridded[var].isel(x=slice(0, 2)).reset_coords(drop=True),
+            expected[var].transpose(*regridded[var].dims),
+        )
+        assert regridded[var].isel(x=2).isnull().all()
+        assert regridded[var].attrs == {"long_name": var}
@@ -0,0 +1,83 @@
+import json
+import os
+import pickle
+import numpy as np
+import pytest
+import xarray as xr
+from tests.data import input_data  # noqa # Might want to put these in conftest.py (see https://stackoverflow.com/questions/73191533/using-conftest-py-vs-importing-fixtures-from-dedicate-modules)
+from ocean_emulators.channels import ChannelLayout
+from ocean_emulators.samples import SampleStore, pack_samples
+
+
+@pytest.fixture
+def input_data_normalized(input_data):
+    ds = input_data
+    for var in ["thetao", "zos"]:
+        ds[f"{var}_mean"] = ds[var].mean()
+        ds[f"{var}_std"] = ds[var].std()
+    return ds
+
+
+@pytest.mark.parametrize("format", ["npy", "zarr"])
+def test_pack_samples(input_data_normalized, tmp_path, format):
+    if format == "zarr":
+        pytest.importorskip("zarr")
+    ds = input_data_normalized
+    layout = ChannelLayout.from_dataset(ds, ["thetao", "zos"])
+    pack_samples(ds, tmp_path, layout=layout, format=format)
+
+    with open(os.path.join(tmp_path, "samples.json")) as f:
+        metadata = json.load(f)
+    assert ChannelLayout(metadata["layout"]) == layout
+    if format == "npy":
+        samples = np.load(os.path.join(tmp_path, "samples.npy"), mmap_mode="r")
+    else:
+        samples = xr.open_zarr(os.path.join(tmp_path, "samples.zarr")).samples
+        assert samples.chunks[0] == (1, 1, 1)
+        samples = samples.values
+    assert samples.dtype == np.float32
+    assert samples.shape == (3, 20, 180, 360)
+    assert metadata["shape"] == list(samples.shape)
+
+    expected = ((ds.thetao - ds.thetao_mean) / ds.thetao_std).transpose(
+        "time", "lev", "y", "x"
+    )
+    expected = expected.fillna(0).astype(np.float32).values
+    np.testing.assert_allclose(samples[:, :19], expected, rtol=1e-6)
+    assert not np.isnan(samples).any()
+
+
+def test_sample_store(input_data_normalized, tmp_path):
+    ds = input_data_normalized
+    layout = ChannelLayout.from_dataset(ds, ["zos"])
+    pack_samples(ds, tmp_path, layout=layout)
+    store = SampleStore(tmp_path)
+    assert len(store) == 3
+    assert store.layout == layout
+    expected = np.load(os.path.join(tmp_path, "samples.npy"))
+
+    views = store.samples([2, 0])
+    np.testing.assert_array_equal(views[0], expected[2])
+    assert all(isinstance(v, np.memmap) for v in views)
+    pairs = store.pairs([0, 1])
+    assert pairs[1].shape == (2, 1, 180, 360)
+    np.testing.assert_array_equal(pairs[1], expected[1:3])
+    assert np.shares_memory(pairs[0], store.array)
+    with pytest.raises(IndexError):
+        store.pairs([2])
+
+    np.testing.assert_array_equal(store.time_index(ds.time.values[[1, 2]]), [1, 2])
+    # the raw file has a fixed stride per sample
+    with open(os.path.join(tmp_path, "samples.json")) as f:
+        metadata = json.load(f)
+    raw = np.fromfile(
+        os.path.join(tmp_path, "samples.npy"),
+        dtype=np.float32,
+        offset=metadata["offset"] + metadata["sample_nbytes"],
+        count=180 * 360,
+    )
+    np.testing.assert_array_equal(raw, expected[1].ravel())
+
+    # stores can be sent to worker processes
+    store_copy = pickle.loads(pickle.dumps(store))
+    np.testing.assert_array_equal(store_copy.sample(1), expected[1])
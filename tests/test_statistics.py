@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+import xarray as xr
+from tests.data import input_data  # noqa # Might want to put these in conftest.py (see https://stackoverflow.com/questions/73191533/using-conftest-py-vs-importing-fixtures-from-dedicate-modules)
+from ocean_emulators.statistics import (
+    attach_statistics,
+    compute_moments,
+    merge_moments,
+)
+
+
+@pytest.mark.parametrize("per_level", [False, True])
+def test_attach_statistics(input_data, per_level):
+    ds = input_data[["thetao", "zos"]]
+    ds_stats = attach_statistics(
+        ds, variables=["thetao", "zos"], per_level=per_level, time_chunk=2
+    )
+    dims = ["time", "x", "y"] if per_level else None
+    for var in ["thetao", "zos"]:
+        xr.testing.assert_allclose(
+            ds_stats[f"{var}_mean"].reset_coords(drop=True),
+            ds[var].mean(dims).reset_coords(drop=True),
+        )
+        xr.testing.assert_allclose(
+            ds_stats[f"{var}_std"].reset_coords(drop=True),
+            ds[var].std(dims).reset_coords(drop=True),
+        )
+
+    # partial results (e.g. from separate workers) can be merged
+    moments = merge_moments(
+        [
+            compute_moments(ds.isel(time=t), variables=["thetao"], per_level=per_level)
+            for t in [[0], [1, 2]]
+        ]
+    )
+    np.testing.assert_allclose(
+        attach_statistics(ds, moments=moments).thetao_std, ds_stats.thetao_std
+    )
@@ -1,7 +1,7 @@
 import xarray as xr
 import numpy as np
 from tests.data import input_data  # noqa # Might want to put these in conftest.py (see https://stackoverflow.com/questions/73191533/using-conftest-py-vs-importing-fixtures-from-dedicate-modules)
-from ocean_emulators.utils import assert_mask_match, apply_mask
+from ocean_emulators.utils import WetMask, assert_mask_match, apply_mask
 import pytest
 
 
@@ -41,3 +41,40 @@ def test_apply_mask(input_data):
         assert input_data[var].dims == input_data_masked[var].dims
         assert input_data[var].coords.keys() == input_data_masked[var].coords.keys()
         assert input_data[var].attrs.keys() == input_data_masked[var].attrs.keys()
+
+
+@pytest.mark.parametrize("chunks", [None, {"time": 1}])
+def test_wetmask_apply_mask(input_data, chunks):
+    ds = input_data.drop_vars("wetmask")
+    if chunks is not None:
+        ds = ds.chunk(chunks)
+    wetmask = WetMask(input_data.wetmask)
+    np.testing.assert_array_equal(wetmask.unpack(), input_data.wetmask.values)
+    ds_masked = apply_mask(ds, wetmask)
+    xr.testing.assert_identical(
+        ds_masked, apply_mask(ds, input_data.wetmask).drop_vars("wetmask")
+    )
+    assert_mask_match(ds_masked.isel(time=0), wetmask)
+
+
+def test_wetmask_assert_mask_match():
+    mask = xr.DataArray(np.random.random([2, 3, 4]) > 0.25, dims=["x", "y", "z"])
+    # make sure there is at least one dry and one wet cell at the surface
+    mask[0, 0, :] = False
+    mask[1, 1, :] = True
+    data = xr.DataArray(np.random.random([5, 4, 3, 2]), dims=["time", "z", "y", "x"])
+    wetmask = WetMask(mask)
+    ds_masked = xr.Dataset(
+        {"3d": data.where(mask), "2d": data.isel(z=0).where(mask.isel(z=0))}
+    )
+    assert_mask_match(ds_masked, wetmask)
+
+    # a single wet cell turned nan at a single time step should raise
+    ds_broken = ds_masked.copy(deep=True)
+    wet = [1, 1, 0]
+    ds_broken["3d"][{"time": 3, "x": wet[0], "y": wet[1], "z": wet[2]}] = np.nan
+    with pytest.raises(ValueError):
+        assert_mask_match(ds_broken, wetmask)
+
+    with pytest.raises(ValueError):
+        assert_mask_match(xr.Dataset({"2d": data.isel(z=0)}), wetmask)